@@ -0,0 +1,222 @@
+"""
+Batch allocation engine.
+
+Decides which physical batches supply a request for N units of a blood
+group, then applies the draw in one guarded bulk_write.
+
+Strategies (settings.BATCH_ALLOCATION_STRATEGY, overridable per call):
+    fifo         - oldest collectedDate first
+    fefo         - first-expiry-first-out (default)
+    fefo_margin  - FEFO, but skip batches expiring within
+                   settings.BATCH_EXPIRY_SAFETY_HOURS (e.g. transit time)
+
+Candidates come from one query on the
+hospitalId + bloodGroup + status + expiryDate index that only returns
+batches expiring after the cutoff, so expired stock is never read.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from django.conf import settings # type: ignore
+from pymongo import UpdateMany, UpdateOne # type: ignore
+
+STRATEGIES = ('fifo', 'fefo', 'fefo_margin')
+
+# Batches created before status was always set have no status field
+ALLOCATABLE_STATUSES = ["Active", None]
+
+# Allocation ids kept on a batch: enough to verify our draw right after the
+# bulk_write, without the array growing with every draw over the batch's life
+ALLOCATION_IDS_KEPT = 20
+
+
+def tag_allocation(allocation_id):
+    """
+    Pipeline-update expression for `allocationIds` that records a guarded
+    draw on a batch (keeping the last ALLOCATION_IDS_KEPT ids)
+    """
+    return {"$slice": [
+        {"$concatArrays": [{"$ifNull": ["$allocationIds", []]}, [allocation_id]]},
+        -ALLOCATION_IDS_KEPT
+    ]}
+
+
+def _candidate_cursor(db, hospital_id, blood_group, strategy, session=None, component_type=None):
+    now = datetime.datetime.now()
+    cutoff = now
+    if strategy == 'fefo_margin':
+        cutoff = now + datetime.timedelta(hours=settings.BATCH_EXPIRY_SAFETY_HOURS)
+
+    query = {
+        "hospitalId": hospital_id,
+        "bloodGroup": blood_group,
+        "status": {"$in": ALLOCATABLE_STATUSES},
+        "expiryDate": {"$gt": cutoff.isoformat()},
+        "units": {"$gt": 0}
+    }
+    if component_type:
+        query["componentType"] = component_type
+    sort_key = "collectedDate" if strategy == 'fifo' else "expiryDate"
+    return db.batches.find(query, session=session).sort([(sort_key, 1), ("_id", 1)])
+
+
+def plan_allocation(db, hospital_id, blood_group, units_needed, strategy=None, session=None,
+                    component_type=None, taken=None):
+    """
+    Compute which batches would supply `units_needed` without writing anything.
+    `component_type` restricts the draw to one component; `taken`
+    ({batchId: units}) is stock already claimed by other lines of the same
+    request and is not offered again.
+
+    Returns:
+        {
+            "strategy": str,
+            "requested": int,
+            "allocated": int,
+            "shortfall": int,
+            "lines": [{"batchId", "units", "available", "expiryDate", ...}, ...]
+        }
+    """
+    strategy = strategy or settings.BATCH_ALLOCATION_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown allocation strategy '{strategy}'")
+
+    taken = taken or {}
+    lines = []
+    remaining = units_needed
+    for batch in _candidate_cursor(db, hospital_id, blood_group, strategy, session=session, component_type=component_type):
+        if remaining <= 0:
+            break
+        available = batch.get('units', 0) - taken.get(str(batch['_id']), 0)
+        if available <= 0:
+            continue
+        to_take = min(available, remaining)
+        lines.append({
+            "batchId": str(batch['_id']),
+            "units": to_take,
+            "available": available,
+            "componentType": batch.get('componentType'),
+            "collectedDate": batch.get('collectedDate'),
+            "expiryDate": batch.get('expiryDate'),
+            "donorId": batch.get('donorId')
+        })
+        remaining -= to_take
+
+    allocated = units_needed - remaining
+    return {
+        "strategy": strategy,
+        "requested": units_needed,
+        "allocated": allocated,
+        "shortfall": units_needed - allocated,
+        "lines": lines
+    }
+
+
+def consume_batches(db, hospital_id, blood_group, units_needed, strategy=None, session=None, dry_run=False):
+    """
+    Deduct units from batches following the allocation strategy.
+
+    The plan is applied with ONE ordered bulk_write: each draw is a guarded
+    decrement (units >= take) that also marks the batch Depleted when it
+    hits zero. Each draw is tagged with an allocation id, so if a guard loses
+    to a concurrent writer we can tell which draws applied and re-plan only
+    the shortfall. Pass `session` to run inside a transaction, or
+    `dry_run=True` to get the plan back without mutating anything.
+    Errors are raised: without a transaction, draws applied before the
+    error stay applied.
+
+    Returns:
+        {
+            "consumed": int,
+            "source_batches": [{"batchId": str, "unitsUsed": int}, ...]
+        }
+    """
+    if dry_run:
+        return plan_allocation(db, hospital_id, blood_group, units_needed, strategy, session=session)
+
+    consumed = 0
+    source_batches = []
+
+    try:
+        for _attempt in range(3):
+            if consumed >= units_needed:
+                break
+            plan = plan_allocation(db, hospital_id, blood_group, units_needed - consumed, strategy, session=session)
+            if not plan['lines']:
+                break
+
+            allocation_id = str(ObjectId())
+            depleted_at = datetime.datetime.now().isoformat()
+            ops = [
+                UpdateOne(
+                    {"_id": ObjectId(line['batchId']), "units": {"$gte": line['units']}},
+                    [
+                        {"$set": {
+                            "units": {"$subtract": ["$units", line['units']]},
+                            "allocationIds": tag_allocation(allocation_id)
+                        }},
+                        {"$set": {
+                            "status": {"$cond": [{"$lte": ["$units", 0]}, "Depleted", "$status"]},
+                            "depletedAt": {"$cond": [{"$lte": ["$units", 0]}, depleted_at, "$depletedAt"]}
+                        }}
+                    ]
+                )
+                for line in plan['lines']
+            ]
+            result = db.batches.bulk_write(ops, ordered=True, session=session)
+
+            # Verify guards (only costs a round trip when something raced us)
+            applied = None
+            if result.matched_count < len(ops):
+                applied = {str(_id) for _id in db.batches.distinct(
+                    "_id",
+                    {"_id": {"$in": [ObjectId(l['batchId']) for l in plan['lines']]}, "allocationIds": allocation_id},
+                    session=session
+                )}
+
+            for line in plan['lines']:
+                if applied is not None and line['batchId'] not in applied:
+                    continue
+                consumed += line['units']
+                # Track source batch (merge repeat draws from a re-plan)
+                existing = next((s for s in source_batches if s['batchId'] == line['batchId']), None)
+                if existing:
+                    existing['unitsUsed'] += line['units']
+                    continue
+                source_batches.append({
+                    "batchId": line['batchId'],
+                    "unitsUsed": line['units'],
+                    "componentType": line['componentType'],
+                    "collectedDate": line['collectedDate'],
+                    "donorId": line['donorId']
+                })
+
+            if applied is None:
+                break
+
+    except Exception as e:
+        print(f"Batch Consumption Error ({consumed} of {units_needed} units drawn): {e}")
+        raise # a partial count would read as a shortfall; let the transaction abort / the caller fail
+
+    return {
+        "consumed": consumed,
+        "source_batches": source_batches
+    }
+
+
+def restore_batches(db, source_batches, session=None):
+    """
+    Put consumed units back into their batches (e.g. a cancelled transfer),
+    reactivating batches that were Depleted by the draw.
+    """
+    sources = [src for src in source_batches or [] if src.get('batchId') and src.get('unitsUsed', 0) > 0]
+    if not sources:
+        return
+    ops = [
+        UpdateOne({"_id": ObjectId(src['batchId'])}, {"$inc": {"units": src['unitsUsed']}})
+        for src in sources
+    ]
+    ops.append(UpdateMany(
+        {"_id": {"$in": [ObjectId(src['batchId']) for src in sources]}, "status": "Depleted", "units": {"$gt": 0}},
+        {"$set": {"status": "Active"}, "$unset": {"depletedAt": ""}}
+    ))
+    db.batches.bulk_write(ops, ordered=True, session=session)
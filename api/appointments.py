@@ -0,0 +1,136 @@
+"""
+Appointment status transitions for hospitals.
+
+Completing an appointment records the donation: a Whole Blood batch at
+the hospital, the inventory counter and the donor's cached stats.
+HospitalAppointmentsView.post does this for one appointment;
+transition_appointments does it for a whole session. It runs one
+update_many tagged with a transition id, one $in read of the
+appointments it moved and of their donors, one insert_many of batches,
+one inventory bulk_write, and one users bulk_write.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from .donor_stats import donation_op
+from .inventory import adjust_stock_many
+
+BULK_STATUSES = ('Completed', 'Rejected', 'Cancelled')
+MAX_BULK_APPOINTMENTS = 500
+DONATION_SHELF_LIFE_DAYS = 35
+
+
+def donation_type(appt):
+    """Donation type shown on the donor profile for a completed appointment"""
+    return "Hospital Request" if "Emergency" in (appt.get('type') or 'Voluntary') else "Voluntary"
+
+
+def donation_batch(hospital_id, blood_group, units, donor=None):
+    """Physical batch for units collected from a donor (None = walk-in)"""
+    now = datetime.datetime.now()
+    return {
+        "hospitalId": hospital_id,
+        "bloodGroup": blood_group,
+        "componentType": "Whole Blood", # Default from donation
+        "units": units,
+        "collectedDate": now.isoformat(),
+        "expiryDate": (now + datetime.timedelta(days=DONATION_SHELF_LIFE_DAYS)).isoformat(),
+        "sourceType": "Donation",
+        "sourceName": donor.get('name') if donor else "Walk-in Donor",
+        "donorDetails": {
+            "donorId": str(donor['_id']) if donor else None,
+            "name": donor.get('name') if donor else "Walk-in",
+            "email": donor.get('email') if donor else None,
+            "phone": donor.get('phone') if donor else None,
+        },
+        "location": "In-House",
+        "createdAt": now.isoformat(),
+        "status": "Active"
+    }
+
+
+def _object_id(value):
+    if isinstance(value, ObjectId):
+        return value
+    return ObjectId(value) if value and ObjectId.is_valid(str(value)) else None
+
+
+def transition_appointments(db, hospital_id, appointment_ids, new_status, reason=None):
+    """
+    Move many appointments of a hospital to `new_status`. Completed
+    appointments are immutable and are skipped.
+
+    Returns {"updated": [id], "errors": [{"id", "error"}], "batches": n, "units": n}
+    """
+    errors = []
+    oids = []
+    for appt_id in appointment_ids:
+        oid = _object_id(appt_id)
+        if oid is None:
+            errors.append({"id": appt_id, "error": "Invalid appointment ID"})
+        else:
+            oids.append(oid)
+
+    hospital = db.users.find_one({"_id": _object_id(hospital_id)}, {"name": 1}) if _object_id(hospital_id) else None
+    owner = [{"hospitalId": hospital_id}]
+    if hospital and hospital.get('name'):
+        owner.append({"center": hospital['name']}) # legacy appointments, as in the GET
+
+    transition_id = str(ObjectId())
+    update = {"status": new_status, "transitionId": transition_id}
+    if reason:
+        update['rejectionReason'] = reason
+    db.appointments.update_many(
+        {"_id": {"$in": oids}, "status": {"$ne": "Completed"}, "$or": owner},
+        {"$set": update}
+    )
+
+    moved = list(db.appointments.find({"_id": {"$in": oids}, "transitionId": transition_id}))
+    moved_ids = {appt['_id'] for appt in moved}
+    missed = [oid for oid in oids if oid not in moved_ids]
+    if missed:
+        found = {a['_id']: a for a in db.appointments.find({"_id": {"$in": missed}}, {"status": 1})}
+        for oid in missed:
+            if oid in found and found[oid].get('status') == 'Completed':
+                errors.append({"id": str(oid), "error": "Cannot modify a completed appointment"})
+            else:
+                errors.append({"id": str(oid), "error": "Appointment not found"})
+
+    result = {"updated": [str(a['_id']) for a in moved], "errors": errors, "batches": 0, "units": 0}
+    if new_status != 'Completed' or not moved:
+        return result
+
+    # Donors of the whole session in one read
+    donor_oids = {_object_id(a.get('donorId')) for a in moved} - {None}
+    donors = {str(d['_id']): d for d in db.users.find(
+        {"_id": {"$in": list(donor_oids)}}, {"name": 1, "email": 1, "phone": 1, "bloodGroup": 1}
+    )}
+
+    batches = []
+    deltas = {}
+    donor_updates = {}
+    for appt in moved:
+        donor_id = str(appt['donorId']) if appt.get('donorId') else None
+        donor = donors.get(donor_id)
+        bg = donor.get('bloodGroup') if donor else appt.get('bloodGroup')
+        units = int(appt.get('units', 1))
+        if bg:
+            batches.append(donation_batch(hospital_id, bg, units, donor))
+            key = (bg, "Whole Blood")
+            deltas[key] = deltas.get(key, 0) + units
+            result['units'] += units
+        if donor_id and _object_id(donor_id):
+            stats = donor_updates.setdefault(donor_id, {"count": 0, "type": None})
+            stats['count'] += 1
+            stats['type'] = donation_type(appt)
+
+    if batches:
+        db.batches.insert_many(batches, ordered=False)
+        result['batches'] = len(batches)
+    if deltas:
+        adjust_stock_many(db, hospital_id, deltas, source='donation', actor=hospital_id)
+    if donor_updates:
+        db.users.bulk_write([
+            donation_op(donor_id, stats['type'], count=stats['count'])
+            for donor_id, stats in donor_updates.items()
+        ], ordered=False)
+    return result
@@ -0,0 +1,98 @@
+"""
+Outgoing batch audit log (patient usage, transfers, discards).
+
+Every outgoing record carries `issuedOn`, a native datetime of when the
+units left (issuedAt / discardedAt are kept as the display strings), so
+date ranges and ordering use real dates instead of string comparison.
+Queries page with a keyset cursor on (issuedOn, _id), newest first, and
+every filter has a (hospitalId, <field>, issuedOn) index, so a patient or
+source-batch lookup is an index seek however large the log gets.
+"""
+import base64
+import datetime
+from bson import ObjectId # type: ignore
+
+# query param -> document field (exact match)
+AUDIT_FILTERS = {
+    "type": "type",
+    "ward": "ward",
+    "doctorName": "doctorName",
+    "patientId": "patientId",
+    "referenceId": "referenceId",
+    "sourceBatchId": "sourceBatchIds.batchId",
+}
+
+MAX_PAGE_SIZE = 500
+
+
+def issued_on(value=None):
+    """
+    Native UTC datetime for an outgoing record. Accepts the ISO string a
+    client sent (naive = server time, UTC) and falls back to now.
+    """
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00')) if value else None
+        except ValueError:
+            parsed = None
+    if parsed is None:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+def encode_cursor(doc):
+    at = doc['issuedOn']
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=datetime.timezone.utc)
+    raw = f"{at.isoformat()}|{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(issuedOn, ObjectId) of the last row of the previous page; ValueError if malformed"""
+    try:
+        at, oid = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        return datetime.datetime.fromisoformat(at), ObjectId(oid)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def audit_query(hospital_id, filters, since=None, until=None, cursor=None):
+    query = {"hospitalId": hospital_id}
+    for param, field in AUDIT_FILTERS.items():
+        if filters.get(param):
+            query[field] = filters[param]
+    issued = {}
+    if since is not None:
+        issued["$gte"] = since
+    if until is not None:
+        issued["$lt"] = until
+    if issued:
+        query["issuedOn"] = issued
+    if cursor:
+        at, oid = decode_cursor(cursor)
+        query["$or"] = [
+            {"issuedOn": {"$lt": at}},
+            {"issuedOn": at, "_id": {"$lt": oid}}
+        ]
+    return query
+
+
+def query_outgoing(db, hospital_id, filters, since=None, until=None, cursor=None, limit=100):
+    """
+    One page of the audit log, newest first.
+    Returns (rows, next_cursor or None).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = audit_query(hospital_id, filters, since, until, cursor)
+    rows = list(
+        db.outgoing_batches.find(query)
+        .sort([("issuedOn", -1), ("_id", -1)])
+        .limit(limit + 1)
+    )
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,110 @@
+"""
+Bulk batch intake (e.g. after a blood drive).
+
+Rows are the same documents BatchView.post accepts, sent as a JSON array
+or as NDJSON (one batch per line). Valid rows are inserted with one
+unordered insert_many and inventory gets one combined $inc per hospital /
+blood group / component, so an intake of hundreds of units is a handful of
+database operations however many rows it has. Invalid rows are reported
+by index and don't block the rest.
+"""
+import datetime
+import json
+from pymongo.errors import BulkWriteError # type: ignore
+from .inventory import BLOOD_GROUPS, DEFAULT_COMPONENT, adjust_stock_many
+
+MAX_INTAKE_ROWS = 1000
+
+
+def parse_ndjson(lines):
+    """
+    [(row, error)] from an iterable of NDJSON lines (bytes or str).
+    Blank lines are skipped.
+    """
+    rows = []
+    for raw in lines:
+        line = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        if not line.strip():
+            continue
+        try:
+            rows.append((json.loads(line), None))
+        except ValueError:
+            rows.append((None, "Invalid JSON"))
+    return rows
+
+
+def prepare_batch(row, hospital_id=None):
+    """
+    Validate one intake row and fill the defaults BatchView.post applies.
+    Returns (document, error).
+    """
+    if not isinstance(row, dict):
+        return None, "Row must be an object"
+    doc = dict(row)
+    doc.pop('_id', None)
+    doc['hospitalId'] = doc.get('hospitalId') or hospital_id
+    if not doc['hospitalId']:
+        return None, "hospitalId required"
+    if hospital_id and doc['hospitalId'] != hospital_id:
+        return None, "Batch belongs to a different hospital"
+    if doc.get('bloodGroup') not in BLOOD_GROUPS:
+        return None, "Invalid bloodGroup"
+    try:
+        doc['units'] = int(doc.get('units', 0))
+    except (ValueError, TypeError):
+        return None, "Invalid units"
+    if doc['units'] <= 0:
+        return None, "units must be at least 1"
+
+    now = datetime.datetime.now()
+    doc['createdAt'] = now.isoformat()
+    doc.setdefault('expiryDate', (now + datetime.timedelta(days=35)).isoformat())
+    doc.setdefault('status', 'Active')
+    return doc, None
+
+
+def intake_batches(db, rows, hospital_id=None, actor=None):
+    """
+    rows: [(row, parse_error)]. Returns
+        {"inserted": n, "units": n, "ids": [{"row", "id"}], "errors": [{"row", "error"}]}
+    """
+    errors = []
+    docs = []
+    positions = []
+    for i, (row, parse_error) in enumerate(rows):
+        if parse_error:
+            errors.append({"row": i, "error": parse_error})
+            continue
+        doc, error = prepare_batch(row, hospital_id)
+        if error:
+            errors.append({"row": i, "error": error})
+            continue
+        docs.append(doc)
+        positions.append(i)
+
+    failed = set()
+    if docs:
+        try:
+            db.batches.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                failed.add(write_error['index'])
+                errors.append({"row": positions[write_error['index']], "error": write_error.get('errmsg', 'Insert failed')})
+
+    # One combined counter update per hospital
+    deltas = {}
+    ids = []
+    units = 0
+    for index, doc in enumerate(docs):
+        if index in failed:
+            continue
+        key = (doc['bloodGroup'], doc.get('componentType') or DEFAULT_COMPONENT)
+        per_hospital = deltas.setdefault(doc['hospitalId'], {})
+        per_hospital[key] = per_hospital.get(key, 0) + doc['units']
+        ids.append({"row": positions[index], "id": str(doc['_id'])})
+        units += doc['units']
+    for hid, changes in deltas.items():
+        adjust_stock_many(db, hid, changes, source='batch_intake', actor=actor or hid)
+
+    errors.sort(key=lambda e: e['row'])
+    return {"inserted": len(ids), "units": units, "ids": ids, "errors": errors}
@@ -0,0 +1,270 @@
+"""
+Bulk issue / discard across several batches.
+
+A request is a list of lines, each either an explicit batch or a blood
+group to allocate automatically:
+
+    {"batchId": "...", "quantity": 2}
+    {"bloodGroup": "O+", "quantity": 4, "componentType": "Plasma"}
+
+Every line is validated (and auto lines are planned) before anything is
+written; if any line is invalid nothing is applied. The draw is then one
+unordered bulk_write of guarded decrements tagged with an allocation id,
+followed by one inventory bulk_write, one outgoing card that lists every
+source batch, and its lineage rows.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from pymongo import UpdateOne # type: ignore
+from .allocation import plan_allocation, tag_allocation, STRATEGIES
+from .audit import issued_on
+from .inventory import DEFAULT_COMPONENT, adjust_stock_many
+from .lineage import batch_donor_id, record_issue
+
+ACTIONS = ('use_unit', 'discard_unit')
+MAX_LINES = 50
+MAX_UNITS = 100 # same safety limit as a single BatchActionView call
+EXPIRY_WARNING_DAYS = 3
+
+
+def _parse_expiry(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def plan_bulk_action(db, hospital_id, action, lines, strategy=None):
+    """
+    Validate every line and resolve it to concrete batch draws.
+
+    Returns (draws, errors, warnings):
+        draws:    [{"line", "batchId", "units", "bloodGroup", "componentType",
+                    "collectedDate", "donorId"}]
+        errors:   [{"line", "error"}]   (empty when the request can be applied)
+        warnings: [{"line", "batchId", "warning"}]
+    """
+    errors = []
+    warnings = []
+    if action not in ACTIONS:
+        return [], [{"line": None, "error": "action must be use_unit or discard_unit"}], []
+    if strategy and strategy not in STRATEGIES:
+        return [], [{"line": None, "error": f"strategy must be one of {', '.join(STRATEGIES)}"}], []
+    if not isinstance(lines, list) or not lines:
+        return [], [{"line": None, "error": "lines must be a non-empty list"}], []
+    if len(lines) > MAX_LINES:
+        return [], [{"line": None, "error": f"At most {MAX_LINES} lines per request"}], []
+
+    parsed = []
+    total = 0
+    for i, line in enumerate(lines):
+        if not isinstance(line, dict):
+            errors.append({"line": i, "error": "Line must be an object"})
+            continue
+        try:
+            qty = int(line.get('quantity', 1))
+            if qty < 1:
+                raise ValueError
+        except (ValueError, TypeError):
+            errors.append({"line": i, "error": "Quantity must be a positive number"})
+            continue
+        if line.get('batchId'):
+            if not ObjectId.is_valid(str(line['batchId'])):
+                errors.append({"line": i, "error": "Invalid batch ID format"})
+                continue
+        elif not line.get('bloodGroup'):
+            errors.append({"line": i, "error": "batchId or bloodGroup required"})
+            continue
+        total += qty
+        parsed.append((i, line, qty))
+    if total > MAX_UNITS:
+        errors.append({"line": None, "error": f"Quantity exceeds maximum limit ({MAX_UNITS} units per transaction)"})
+
+    # Explicit batches: one query for all of them
+    explicit_ids = [ObjectId(str(line['batchId'])) for _, line, _ in parsed if line.get('batchId')]
+    batches = {
+        str(b['_id']): b
+        for b in db.batches.find({"_id": {"$in": explicit_ids}, "hospitalId": hospital_id})
+    } if explicit_ids else {}
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expired_ids = []
+    draws = []
+    taken = {}
+    for i, line, qty in parsed:
+        if not line.get('batchId'):
+            continue
+        batch_id = str(line['batchId'])
+        batch = batches.get(batch_id)
+        if not batch:
+            errors.append({"line": i, "error": "Batch not found or does not belong to this hospital"})
+            continue
+        if batch.get('status') in ('Depleted', 'Discarded', 'Expired'):
+            errors.append({"line": i, "error": f"Cannot use units from a {batch['status'].lower()} batch"})
+            continue
+        expiry = _parse_expiry(batch.get('expiryDate'))
+        if expiry and expiry < now:
+            expired_ids.append(batch['_id'])
+            errors.append({"line": i, "error": f"Batch expired on {expiry.strftime('%Y-%m-%d')}. Cannot use expired blood units."})
+            continue
+        if expiry and action == 'use_unit' and (expiry - now).days <= EXPIRY_WARNING_DAYS:
+            warnings.append({"line": i, "batchId": batch_id, "warning": f"Batch expires in {(expiry - now).days} day(s)"})
+        available = batch.get('units', 0) - taken.get(batch_id, 0)
+        if available < qty:
+            errors.append({"line": i, "error": f"Insufficient units. Requested: {qty}, Available: {available}"})
+            continue
+        taken[batch_id] = taken.get(batch_id, 0) + qty
+        draws.append({
+            "line": i,
+            "batchId": batch_id,
+            "units": qty,
+            "bloodGroup": batch.get('bloodGroup'),
+            "componentType": batch.get('componentType') or DEFAULT_COMPONENT,
+            "collectedDate": batch.get('collectedDate'),
+            "donorId": batch_donor_id(batch)
+        })
+
+    if expired_ids:
+        # Same as the single-batch path: expired batches are flagged when found
+        db.batches.update_many({"_id": {"$in": expired_ids}}, {"$set": {"status": "Expired"}})
+
+    # Auto lines: planned after explicit ones, never re-offering stock already claimed
+    for i, line, qty in parsed:
+        if line.get('batchId'):
+            continue
+        plan = plan_allocation(
+            db, hospital_id, line['bloodGroup'], qty, strategy,
+            component_type=line.get('componentType'), taken=taken
+        )
+        if plan['shortfall']:
+            errors.append({"line": i, "error": f"Insufficient units. Requested: {qty}, Available: {plan['allocated']}"})
+            continue
+        for planned in plan['lines']:
+            taken[planned['batchId']] = taken.get(planned['batchId'], 0) + planned['units']
+            draws.append({
+                "line": i,
+                "batchId": planned['batchId'],
+                "units": planned['units'],
+                "bloodGroup": line['bloodGroup'],
+                "componentType": planned.get('componentType') or DEFAULT_COMPONENT,
+                "collectedDate": planned.get('collectedDate'),
+                "donorId": planned.get('donorId')
+            })
+
+    return (draws if not errors else []), errors, warnings
+
+
+def apply_bulk_action(db, hospital_id, action, draws, details, session=None):
+    """
+    Apply validated draws. Returns (applied, failed, outgoing) where failed
+    lists draws whose guard lost to a concurrent writer.
+    details: patientId / referenceId / ward / doctorName / issueDateTime / reason
+    """
+    allocation_id = str(ObjectId())
+    now_iso = datetime.datetime.now().isoformat()
+    final_status = "Depleted" if action == 'use_unit' else "Discarded"
+
+    # Merge draws on the same batch into one guarded update
+    per_batch = {}
+    for draw in draws:
+        per_batch[draw['batchId']] = per_batch.get(draw['batchId'], 0) + draw['units']
+    ops = [
+        UpdateOne(
+            {"_id": ObjectId(batch_id), "hospitalId": hospital_id, "units": {"$gte": units}},
+            [
+                {"$set": {
+                    "units": {"$subtract": ["$units", units]},
+                    "allocationIds": tag_allocation(allocation_id)
+                }},
+                {"$set": {
+                    "status": {"$cond": [{"$lte": ["$units", 0]}, final_status, "$status"]},
+                    "depletedAt": {"$cond": [{"$lte": ["$units", 0]}, now_iso, "$depletedAt"]}
+                }}
+            ]
+        )
+        for batch_id, units in per_batch.items()
+    ]
+    result = db.batches.bulk_write(ops, ordered=False, session=session)
+
+    applied_ids = set(per_batch)
+    if result.matched_count < len(ops):
+        applied_ids = {str(_id) for _id in db.batches.distinct(
+            "_id",
+            {"_id": {"$in": [ObjectId(b) for b in per_batch]}, "allocationIds": allocation_id},
+            session=session
+        )}
+    applied = [d for d in draws if d['batchId'] in applied_ids]
+    failed = [d for d in draws if d['batchId'] not in applied_ids]
+    if not applied:
+        return applied, failed, None
+
+    deltas = {}
+    for draw in applied:
+        key = (draw['bloodGroup'], draw['componentType'])
+        deltas[key] = deltas.get(key, 0) - draw['units']
+    adjust_stock_many(
+        db, hospital_id, deltas, session=session,
+        source='use' if action == 'use_unit' else 'discard', actor=hospital_id
+    )
+
+    sources = {}
+    for draw in applied:
+        src = sources.get(draw['batchId'])
+        if src:
+            src['unitsUsed'] += draw['units']
+            continue
+        sources[draw['batchId']] = {
+            "batchId": draw['batchId'],
+            "unitsUsed": draw['units'],
+            "bloodGroup": draw['bloodGroup'],
+            "componentType": draw['componentType'],
+            "collectedDate": draw['collectedDate'],
+            "donorId": draw['donorId']
+        }
+    groups = sorted({d['bloodGroup'] for d in applied})
+    quantity = sum(d['units'] for d in applied)
+
+    if action == 'use_unit':
+        issue_datetime = details.get('issueDateTime')
+        outgoing = {
+            "type": "patient_usage",
+            "hospitalId": hospital_id,
+            "bloodGroup": groups[0] if len(groups) == 1 else None,
+            "bloodGroups": groups,
+            "quantity": quantity,
+            "issuedAt": issue_datetime if issue_datetime else now_iso,
+            "issuedOn": issued_on(issue_datetime),
+            "patientId": details.get('patientId'),
+            "referenceId": details.get('referenceId'),
+            "ward": details.get('ward'),
+            "doctorName": details.get('doctorName'),
+            "sourceBatchIds": list(sources.values()),
+            "createdAt": now_iso,
+            "performedBy": hospital_id,
+            "action": "use_unit"
+        }
+    else:
+        outgoing = {
+            "type": "discard",
+            "hospitalId": hospital_id,
+            "bloodGroup": groups[0] if len(groups) == 1 else None,
+            "bloodGroups": groups,
+            "quantity": quantity,
+            "discardedAt": now_iso,
+            "issuedOn": issued_on(),
+            "sourceBatchIds": list(sources.values()),
+            "reason": details.get('reason') or 'Not specified',
+            "performedBy": hospital_id,
+            "createdAt": now_iso
+        }
+    db.outgoing_batches.insert_one(outgoing, session=session)
+    record_issue(db, outgoing, session=session)
+    return applied, failed, outgoing
@@ -0,0 +1,274 @@
+"""
+Shared cache with tag-based invalidation.
+
+Slowly changing reference data (the hospital list, donor cities, user
+names for joins, report snapshots) is served from here instead of being
+recomputed from Mongo on every call.
+
+Each entry is stored with the versions of the tags it depends on.
+Writers call invalidate(tag, ...), which gives those tags new versions,
+and an entry whose tag versions moved is a miss. Versions are read before
+the value is computed, so a write that lands during the compute makes the
+stored entry stale at once instead of hiding behind it. Every entry also
+has a TTL, which bounds freshness for writes that don't invalidate.
+
+Backends (CACHE_BACKEND):
+    local  in-process LRU with CACHE_MAX_ENTRIES entries. Invalidations
+           are seen by this process only; other workers converge within
+           the TTL.
+    redis  any Redis-protocol server at CACHE_REDIS_URL (needs the
+           `redis` package). Invalidations are seen by every process.
+configure() swaps the backend, e.g. for a stand-in server in tests.
+
+Tags used by the API:
+    users:<role>   a user of that role was added, changed or removed
+    user:<id>      one user's profile changed
+    reports:<id>   a hospital's report snapshot was invalidated
+    stock:<group>  free stock of a blood group moved at any hospital (ledger)
+
+A cache that can't be reached is skipped: values are computed as if
+nothing was cached.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from bson import ObjectId # type: ignore
+from django.conf import settings # type: ignore
+from django.core.exceptions import ImproperlyConfigured # type: ignore
+
+try:
+    import redis # type: ignore
+except ImportError: # optional: only needed for CACHE_BACKEND=redis
+    redis = None
+
+TAG_PREFIX = 'tag:'
+
+
+class LocalCache:
+    """In-process LRU. Values are the serialized strings, so callers never share objects."""
+
+    shared = False # invalidations reach this process only
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict() # key -> (expires at (monotonic) or None, value)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    continue
+                expires_at, value = item
+                if expires_at is not None and expires_at <= now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Any Redis-protocol client (redis.Redis or a stand-in with get/set/mget/pipeline)"""
+
+    shared = True
+
+    def __init__(self, client, prefix='blood:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = self.client.mget([self.prefix + k for k in keys]) if keys else []
+        return {k: v for k, v in zip(keys, values) if v is not None}
+
+    def set_many(self, mapping, ttl=None):
+        pipe = self.client.pipeline()
+        for key, value in mapping.items():
+            pipe.set(self.prefix + key, value, ex=ttl or None)
+        pipe.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _create_backend():
+    if settings.CACHE_BACKEND == 'local':
+        return LocalCache(settings.CACHE_MAX_ENTRIES)
+    if settings.CACHE_BACKEND == 'redis':
+        if redis is None:
+            raise ImproperlyConfigured("CACHE_BACKEND=redis needs the 'redis' package")
+        return RedisCache(redis.Redis.from_url(settings.CACHE_REDIS_URL, socket_timeout=0.5))
+    raise ImproperlyConfigured(f"Unknown CACHE_BACKEND '{settings.CACHE_BACKEND}'")
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend()
+    return _backend
+
+
+def configure(new_backend):
+    """Replace the backend (None = rebuild from settings on next use)"""
+    global _backend
+    _backend = new_backend
+
+
+def is_shared():
+    """
+    True when invalidations reach every process. Data that must never be
+    served stale after a write (rather than within the TTL) is only cached then.
+    """
+    try:
+        return backend().shared
+    except Exception:
+        return False
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def _tag_keys(tags):
+    return [TAG_PREFIX + t for t in tags]
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def get_many(items):
+    """
+    items: {key: tags}. Returns (hits {key: value}, versions) where
+    versions is what set_many needs to store the misses.
+    """
+    if not items:
+        return {}, {}
+    tags = {t for entry_tags in items.values() for t in entry_tags}
+    try:
+        found = backend().get_many(list(items) + _tag_keys(tags))
+        # Tags never seen (or evicted) get a version now, so entries can record one
+        fresh = {TAG_PREFIX + t: _new_version() for t in tags if TAG_PREFIX + t not in found}
+        if fresh:
+            backend().set_many(fresh)
+            found.update(fresh)
+    except Exception as e:
+        print(f"Cache unavailable: {e}")
+        return {}, None
+
+    versions = {t: _to_str(found[TAG_PREFIX + t]) for t in tags}
+    hits = {}
+    for key, entry_tags in items.items():
+        raw = found.get(key)
+        if raw is None:
+            continue
+        entry = json.loads(raw)
+        if all(entry['t'].get(t) == versions[t] for t in entry_tags):
+            hits[key] = entry['v']
+    return hits, versions
+
+
+def set_many(values, items, versions, ttl=None):
+    """Store {key: value} with the tag versions read (before computing) by get_many"""
+    if not values or versions is None:
+        return
+    try:
+        backend().set_many({
+            key: json.dumps({"v": value, "t": {t: versions[t] for t in items[key]}}, default=str)
+            for key, value in values.items()
+        }, ttl or settings.CACHE_DEFAULT_TTL_SECONDS)
+    except Exception as e:
+        print(f"Cache unavailable: {e}")
+
+
+def get_or_set(key, compute, tags=(), ttl=None):
+    """Cached compute() (a JSON-serializable value)"""
+    items = {key: tuple(tags)}
+    hits, versions = get_many(items)
+    if key in hits:
+        return hits[key]
+    value = compute()
+    set_many({key: value}, items, versions, ttl)
+    return value
+
+
+def invalidate(*tags):
+    """Make every entry depending on any of these tags stale"""
+    tags = [t for t in tags if t]
+    if not tags:
+        return
+    try:
+        backend().set_many({TAG_PREFIX + t: _new_version() for t in tags})
+    except Exception as e:
+        print(f"Cache invalidation failed for {tags}: {e}")
+
+
+# Cached lookups
+
+def invalidate_user(user_id, role=None):
+    """Hook for writes to a user document (role unknown = every role's lists)"""
+    roles = [role] if role else ['donor', 'hospital']
+    invalidate(f"user:{user_id}", *[f"users:{r}" for r in roles])
+
+
+def hospital_list(db):
+    """All hospitals, as HospitalListView returns them"""
+    def compute():
+        return [
+            {"id": str(h['_id']), "name": h.get('name'), "location": h.get('location'), "phone": h.get('phone')}
+            for h in db.users.find({"role": "hospital"}, {"name": 1, "location": 1, "phone": 1})
+        ]
+    return get_or_set("hospitals:list", compute, tags=("users:hospital",))
+
+
+def donor_locations(db):
+    """Distinct non-empty donor cities"""
+    def compute():
+        return [loc for loc in db.users.distinct("location", {"role": "donor"}) if loc]
+    return get_or_set("locations:donor", compute, tags=("users:donor",))
+
+
+def user_summaries(db, user_ids):
+    """
+    {userId: {"name", "location"}} for joins, one $in read for the misses.
+    Unknown / invalid ids are left out.
+    """
+    ids = {str(u) for u in user_ids if u and ObjectId.is_valid(str(u))}
+    items = {f"user:{u}:summary": (f"user:{u}",) for u in ids}
+    hits, versions = get_many(items)
+    result = {key.split(':')[1]: value for key, value in hits.items()}
+
+    missing = [ObjectId(u) for u in ids if u not in result]
+    if missing:
+        fetched = {}
+        for user in db.users.find({"_id": {"$in": missing}}, {"name": 1, "location": 1}):
+            fetched[f"user:{user['_id']}:summary"] = {"name": user.get('name'), "location": user.get('location')}
+        set_many(fetched, items, versions)
+        result.update({key.split(':')[1]: value for key, value in fetched.items()})
+    return result
@@ -11,7 +11,134 @@ try:
 except Exception as e:
     print(f"Error connecting to MongoDB: {e}")
     # In production, we might want to fail hard, but for dev we'll carry on
+    client = None
     db = None
 
 def get_db():
     return db
+
+_transactions_supported = None
+
+def supports_transactions():
+    """
+    Multi-document transactions need a replica set or sharded cluster
+    (Atlas always is one). A standalone dev mongod is not.
+    """
+    global _transactions_supported
+    if _transactions_supported is None:
+        try:
+            hello = client.admin.command('hello')
+            _transactions_supported = bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+        except Exception:
+            _transactions_supported = False
+    return _transactions_supported
+
+# Post-commit hooks of the transactions in progress, by id(session)
+_commit_hooks = {}
+
+def on_commit(session, fn):
+    """
+    Run fn() once the transaction `session` belongs to has committed, e.g. to
+    invalidate caches only when other readers can see the new data. Without a
+    session (no transaction) the writes are already visible, so fn runs now.
+    """
+    hooks = _commit_hooks.get(id(session)) if session is not None else None
+    if hooks is None:
+        fn()
+    else:
+        hooks.append(fn)
+
+def run_in_transaction(callback):
+    """
+    Run callback(session) inside a transaction when the deployment supports it,
+    otherwise run callback(None) directly. The callback may be retried on
+    transient transaction errors, so it must not keep state between calls.
+    Hooks registered with on_commit() run after the commit (not at all on abort).
+    """
+    if db is None or not supports_transactions():
+        return callback(None)
+    with client.start_session() as session:
+        def attempt(s):
+            _commit_hooks[id(s)] = [] # a retried attempt starts over
+            return callback(s)
+        try:
+            result = session.with_transaction(attempt)
+        finally:
+            hooks = _commit_hooks.pop(id(session), [])
+        for fn in hooks:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Post-commit hook failed: {e}")
+        return result
+
+def ensure_indexes():
+    """
+    Create the indexes the API relies on. Safe to run repeatedly
+    (create_index is a no-op when the index already exists).
+    Run from build.sh via scripts/ensure_indexes.py.
+    """
+    if db is None:
+        return
+
+    # Broadcast notifications (one doc per alert, read-time audience match)
+    db.broadcasts.create_index([("status", 1), ("audience.bloodGroup", 1), ("timestamp", -1)])
+    db.broadcasts.create_index("relatedRequestId")
+    # Per-user read/dismiss state for broadcasts
+    db.notification_states.create_index([("userId", 1), ("broadcastId", 1)], unique=True)
+    # Retention: read / acted-on notifications carry expireAt (TTL, expires at that time)
+    db.notifications.create_index("expireAt", expireAfterSeconds=0)
+    db.broadcasts.create_index("expireAt", expireAfterSeconds=0)
+    db.notification_states.create_index("expireAt", expireAfterSeconds=0)
+    # Notifications: one schema (see notifications.normalize_notification) so a single
+    # recipientId+timestamp index serves every read with an index-only sort
+    db.notifications.create_index([("recipientId", 1), ("timestamp", -1)])
+    db.notifications.create_index("relatedRequestId")
+    # Batch allocation: equality on hospital/group/status, range + sort on expiryDate
+    db.batches.create_index([("hospitalId", 1), ("bloodGroup", 1), ("status", 1), ("expiryDate", 1)])
+    # Inventory: one counter document per hospital / blood group / component
+    db.inventory.create_index([("hospitalId", 1), ("bloodGroup", 1), ("componentType", 1)], unique=True)
+    # Hospital search: equality on bloodGroup, range on units
+    db.inventory.create_index([("bloodGroup", 1), ("units", -1)])
+    # Stock holds (embedded in inventory documents): lookup by request, expiry sweep
+    db.inventory.create_index("holds.requestId", sparse=True)
+    db.inventory.create_index("holds.expiresAt", sparse=True)
+    # Inventory ledger (append-only) and periodic balances for point-in-time queries
+    db.inventory_ledger.create_index([("hospitalId", 1), ("at", -1)])
+    db.inventory_ledger.create_index([("hospitalId", 1), ("bloodGroup", 1), ("at", -1)])
+    db.inventory_ledger.create_index("requestId", sparse=True)
+    db.inventory_ledger.create_index("batchId", sparse=True)
+    db.inventory_snapshots.create_index([("hospitalId", 1), ("at", -1)])
+    # Daily report rollups: one document per hospital / day / blood group
+    db.report_rollups.create_index([("hospitalId", 1), ("day", 1), ("bloodGroup", 1)], unique=True)
+    # Audit exports: per-hospital date-ordered scans
+    db.outgoing_batches.create_index([("hospitalId", 1), ("createdAt", 1)])
+    db.batches.create_index([("hospitalId", 1), ("createdAt", 1)])
+    db.appointments.create_index([("hospitalId", 1), ("date", 1)])
+    # Outgoing audit log: keyset paging on issuedOn, one index per filter
+    db.outgoing_batches.create_index([("hospitalId", 1), ("issuedOn", -1), ("_id", -1)])
+    db.outgoing_batches.create_index([("hospitalId", 1), ("type", 1), ("issuedOn", -1)])
+    for field in ("patientId", "referenceId", "ward", "doctorName"):
+        db.outgoing_batches.create_index(
+            [("hospitalId", 1), (field, 1), ("issuedOn", -1)],
+            partialFilterExpression={field: {"$type": "string"}}
+        )
+    db.outgoing_batches.create_index([("sourceBatchIds.batchId", 1), ("issuedOn", -1)])
+    # Lineage (lookback): one row per issue and source batch; each hop is batchId -> rows,
+    # then transfer requestId -> the receiver's batches
+    db.lineage.create_index([("outgoingId", 1), ("batchId", 1)], unique=True)
+    db.lineage.create_index("batchId")
+    db.lineage.create_index("donorId", sparse=True)
+    db.lineage.create_index("patientId", sparse=True)
+    db.batches.create_index("donorId", sparse=True)
+    db.batches.create_index("donorDetails.donorId", sparse=True)
+    db.batches.create_index("sourceRequestId", sparse=True)
+    # Outbox: due pending events in order, expired leases, TTL on applied events
+    db.outbox.create_index([("status", 1), ("availableAt", 1)])
+    db.outbox.create_index([("status", 1), ("lockedUntil", 1)])
+    db.outbox.create_index("expireAt", expireAfterSeconds=0)
+    # Outbox handlers upsert on the event id, so a redelivered event writes nothing twice
+    for collection in (db.notifications, db.batches, db.appointments):
+        collection.create_index("eventId", unique=True, sparse=True)
+    # Idempotency keys: _id is the scoped key; stored responses expire (TTL)
+    db.idempotency_keys.create_index("expireAt", expireAfterSeconds=0)
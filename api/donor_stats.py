@@ -0,0 +1,132 @@
+"""
+Donor stats, maintained at write time.
+
+Every path that records a donation calls record_donation (or
+donation_op inside a bulk_write), which keeps these fields on the donor's
+user document in step:
+
+    totalDonations, lastDonationDate, lastDonationType, nextEligibleDate
+
+DonorStatsView reads them straight off the user document the auth
+decorator already loaded. scripts/rebuild_donor_stats.py recomputes them
+from completed appointments to fix historical drift.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from pymongo import UpdateOne # type: ignore
+
+# Minimum gap between donations shown on the donor dashboard (4 months)
+ELIGIBILITY_DAYS = 120
+LIVES_PER_DONATION = 3
+
+
+def _parse(value):
+    """Aware datetime from a stored date (ISO string, naive = UTC); None if unreadable"""
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime.datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def next_eligible(last_donation):
+    """ISO date string of the next eligible day after a donation (datetime or ISO string)"""
+    last_donation = _parse(last_donation)
+    if last_donation is None:
+        return None
+    return (last_donation + datetime.timedelta(days=ELIGIBILITY_DAYS)).isoformat()
+
+
+def donation_update(donation_type, at=None, count=1):
+    """The users update that records `count` donations made at `at`"""
+    at = at or datetime.datetime.now()
+    return {
+        "$inc": {"totalDonations": count},
+        "$set": {
+            "lastDonationDate": at.isoformat(),
+            "lastDonationType": donation_type,
+            "nextEligibleDate": next_eligible(at)
+        }
+    }
+
+
+def record_donation(db, donor_id, donation_type, at=None, count=1, session=None):
+    """Bump a donor's stats for a donation just recorded. No-op for unknown ids."""
+    if not donor_id or not ObjectId.is_valid(str(donor_id)):
+        return
+    db.users.update_one({"_id": ObjectId(str(donor_id))}, donation_update(donation_type, at, count), session=session)
+
+
+def donation_op(donor_id, donation_type, at=None, count=1):
+    """record_donation as a bulk_write operation"""
+    return UpdateOne({"_id": ObjectId(str(donor_id))}, donation_update(donation_type, at, count))
+
+
+def stats_response(user):
+    """DonorStatsView payload from a user document"""
+    donations = (user or {}).get('totalDonations', 0)
+    next_date = "Available Now"
+    # Profiles not yet touched by rebuild_donor_stats may only have the donation date
+    eligible_at = _parse((user or {}).get('nextEligibleDate') or next_eligible((user or {}).get('lastDonationDate')))
+    if eligible_at and eligible_at > datetime.datetime.now(datetime.timezone.utc):
+        next_date = eligible_at.strftime("%d %b %Y")
+    return {
+        "livesSaved": donations * LIVES_PER_DONATION,
+        "bloodUnits": donations,
+        "nextDonationDate": next_date
+    }
+
+
+def rebuild_donor_stats(db, donor_ids=None):
+    """
+    Recompute stats from completed appointments. Like the old read-time
+    self-healing, counts and dates never go backwards: the profile keeps its
+    own values when they are higher / newer (e.g. donations recorded before
+    appointments were kept). Returns the number of donors updated.
+    """
+    match = {"status": "Completed", "donorId": {"$ne": None}}
+    if donor_ids:
+        match["donorId"] = {"$in": [str(d) for d in donor_ids] + [ObjectId(str(d)) for d in donor_ids if ObjectId.is_valid(str(d))]}
+    history = {}
+    for row in db.appointments.aggregate([
+        {"$match": match},
+        {"$sort": {"date": -1}},
+        {"$group": {
+            "_id": {"$toString": "$donorId"},
+            "count": {"$sum": 1},
+            "lastDate": {"$first": "$date"},
+            "lastType": {"$first": "$type"}
+        }}
+    ]):
+        history[row['_id']] = row
+
+    query = {"role": "donor"}
+    if donor_ids:
+        query["_id"] = {"$in": [ObjectId(str(d)) for d in donor_ids if ObjectId.is_valid(str(d))]}
+    ops = []
+    updated = 0
+    for user in db.users.find(query, {"totalDonations": 1, "lastDonationDate": 1, "lastDonationType": 1, "nextEligibleDate": 1}):
+        row = history.get(str(user['_id']), {})
+        total = max(user.get('totalDonations', 0), row.get('count', 0))
+        last_date = user.get('lastDonationDate')
+        last_type = user.get('lastDonationType')
+        history_at, profile_at = _parse(row.get('lastDate')), _parse(last_date)
+        if history_at and (profile_at is None or history_at > profile_at):
+            last_date, last_type = row['lastDate'], row.get('lastType') or 'Voluntary'
+        stats = {
+            "totalDonations": total,
+            "lastDonationDate": last_date,
+            "lastDonationType": last_type,
+            "nextEligibleDate": next_eligible(last_date)
+        }
+        if any(user.get(k) != v for k, v in stats.items()):
+            ops.append(UpdateOne({"_id": user['_id']}, {"$set": stats}))
+        if len(ops) >= 1000:
+            updated += db.users.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += db.users.bulk_write(ops, ordered=False).modified_count
+    return updated
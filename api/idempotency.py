@@ -0,0 +1,144 @@
+"""
+Idempotency-Key support for mutating endpoints.
+
+Mobile clients on flaky networks retry POSTs whose response they never
+saw. A client that sends an `Idempotency-Key` header (any unique string,
+e.g. a UUID per user action) gets the first response replayed for every
+retry instead of the action running again:
+
+    first call   -> claims the key in db.idempotency_keys, runs the view,
+                    stores the response (anything below 500)
+    retry        -> same response, with `Idempotent-Replayed: true`
+    while running-> 409, the client retries later
+    5xx / crash  -> the key is released so a retry runs the view again
+
+Keys are scoped to the endpoint, method and caller (Authorization header)
+and bound to the request body: reusing a key with a different body is a
+client bug and gets a 422. Stored responses expire through a TTL index
+after IDEMPOTENCY_KEY_TTL_HOURS. Requests without the header are not
+affected.
+"""
+import datetime
+import hashlib
+import json
+from functools import wraps
+from django.conf import settings # type: ignore
+from pymongo.errors import DuplicateKeyError # type: ignore
+from rest_framework.response import Response # type: ignore
+from rest_framework import status # type: ignore
+from .db import get_db
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+
+def _digest(*parts):
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _fingerprint(request):
+    try:
+        body = json.dumps(request.data, sort_keys=True, default=str)
+    except Exception:
+        body = ''
+    return _digest(body, json.dumps(sorted(request.query_params.lists()), default=str))
+
+
+def _claim(db, scope, fingerprint):
+    """
+    Claim a key. Returns (record, claimed): the stored record when someone
+    else holds it, or (None, True) when this request should run the view.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    doc = {
+        "_id": scope,
+        "status": "processing",
+        "fingerprint": fingerprint,
+        "createdAt": now,
+        "lockedUntil": now + datetime.timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS),
+        "expireAt": now + datetime.timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+    }
+    try:
+        db.idempotency_keys.insert_one(doc)
+        return None, True
+    except DuplicateKeyError:
+        pass
+    # A claim whose holder died (lock ran out without a stored response) can be taken over
+    stale = db.idempotency_keys.find_one_and_update(
+        {"_id": scope, "status": "processing", "fingerprint": fingerprint, "lockedUntil": {"$lt": now}},
+        {"$set": {"lockedUntil": doc['lockedUntil']}}
+    )
+    if stale:
+        return None, True
+    return db.idempotency_keys.find_one({"_id": scope}), False
+
+
+def _replay(record):
+    response = Response(record.get('response'), status=record.get('responseStatus', 200))
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(view_func):
+    """
+    Decorator for APIView methods: replay the first response for a repeated
+    Idempotency-Key.
+
+    Usage:
+        @idempotent
+        def post(self, request):
+            ...
+    """
+    @wraps(view_func)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        db = get_db()
+        if not key or db is None:
+            return view_func(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        scope = _digest(request.method, request.path, request.headers.get('Authorization', ''), key)
+        fingerprint = _fingerprint(request)
+        record, claimed = _claim(db, scope, fingerprint)
+        if not claimed:
+            if record is None:
+                # Released between our insert and read: treat as in progress, the retry will win
+                return Response({"error": "A request with this Idempotency-Key is in progress"}, status=status.HTTP_409_CONFLICT)
+            if record.get('fingerprint') != fingerprint:
+                return Response(
+                    {"error": f"{HEADER} was already used for a different request"},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+            if record.get('status') == 'completed':
+                return _replay(record)
+            response = Response({"error": "A request with this Idempotency-Key is in progress"}, status=status.HTTP_409_CONFLICT)
+            response['Retry-After'] = '1'
+            return response
+
+        try:
+            response = view_func(self, request, *args, **kwargs)
+        except Exception:
+            db.idempotency_keys.delete_one({"_id": scope, "status": "processing"})
+            raise
+
+        data = getattr(response, 'data', None)
+        if response.status_code >= 500 or getattr(response, 'streaming', False):
+            # Failed (or not replayable): let a retry run the view again
+            db.idempotency_keys.delete_one({"_id": scope, "status": "processing"})
+            return response
+        db.idempotency_keys.update_one({"_id": scope}, {
+            "$set": {
+                "status": "completed",
+                "responseStatus": response.status_code,
+                # Round-trip through JSON so ObjectIds / datetimes store as the client saw them
+                "response": json.loads(json.dumps(data, default=str)) if data is not None else None
+            },
+            "$unset": {"lockedUntil": ""}
+        })
+        return response
+    return wrapper
@@ -0,0 +1,197 @@
+"""
+Inventory (aggregate stock counters).
+
+One document per (hospitalId, bloodGroup, componentType):
+    {"hospitalId": "...", "bloodGroup": "O-", "componentType": "Whole Blood", "units": 4}
+
+Stock lookups are index seeks on (bloodGroup, units) and concurrent stock
+movements for different groups/components touch different documents.
+Every counter change goes through this module and is appended to the
+inventory ledger (api/ledger.py) with the same session.
+
+Legacy documents ({"hospitalId": ..., "A+": 5, "O-": 2}) are converted by
+scripts/migrate_inventory_documents.py.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from pymongo import ReturnDocument, UpdateOne # type: ignore
+from .db import run_in_transaction
+from .ledger import movement, record_movements
+
+BLOOD_GROUPS = ['A+', 'A-', 'B+', 'B-', 'O+', 'O-', 'AB+', 'AB-']
+DEFAULT_COMPONENT = "Whole Blood"
+
+# Movement ids kept on a counter, to tell which guarded updates of a
+# bulk_write applied (see allocation.ALLOCATION_IDS_KEPT)
+MOVEMENT_IDS_KEPT = 20
+
+
+def stock_key(hospital_id, blood_group, component_type=None):
+    return {
+        "hospitalId": hospital_id,
+        "bloodGroup": blood_group,
+        "componentType": component_type or DEFAULT_COMPONENT
+    }
+
+
+def adjust_stock(db, hospital_id, blood_group, delta, component_type=None, session=None,
+                 source=None, request_id=None, batch_id=None, actor=None):
+    """
+    $inc one stock counter and append the movement to the ledger.
+    Increments create the document if needed. Decrements are guarded like
+    place_hold: a counter that doesn't exist or holds fewer than -delta
+    units is left alone. Returns True when the change was applied.
+    """
+    if not hospital_id or not blood_group or not delta:
+        return False
+    key = stock_key(hospital_id, blood_group, component_type)
+    guard = {"units": {"$gte": -delta}} if delta < 0 else {}
+    res = db.inventory.update_one(
+        {**key, **guard},
+        {"$inc": {"units": delta}, "$set": {"updatedAt": datetime.datetime.now().isoformat()}},
+        upsert=delta > 0,
+        session=session
+    )
+    if not (res.matched_count or res.upserted_id):
+        print(f"Stock change refused for {hospital_id} {blood_group} {key['componentType']}: {delta} (not enough units)")
+        return False
+    record_movements(db, [movement(
+        hospital_id, blood_group, key['componentType'], delta,
+        source=source, request_id=request_id, batch_id=batch_id, actor=actor
+    )], session=session)
+    return True
+
+
+def adjust_stock_many(db, hospital_id, deltas, session=None, source=None, request_id=None, actor=None):
+    """
+    Apply several counter changes for one hospital in a single bulk_write
+    (plus one ledger insert). Decrements are guarded as in adjust_stock.
+    deltas: {(bloodGroup, componentType): delta}
+    Returns the changes that were refused ({} when everything applied).
+    """
+    now_iso = datetime.datetime.now().isoformat()
+    changes = [
+        (stock_key(hospital_id, bg, component), delta)
+        for (bg, component), delta in deltas.items() if bg and delta
+    ]
+    if not changes:
+        return {}
+    movement_id = str(ObjectId())
+    ops = [
+        UpdateOne(
+            {**key, **({"units": {"$gte": -delta}} if delta < 0 else {})},
+            {
+                "$inc": {"units": delta},
+                "$set": {"updatedAt": now_iso},
+                "$push": {"movementIds": {"$each": [movement_id], "$slice": -MOVEMENT_IDS_KEPT}}
+            },
+            upsert=delta > 0
+        )
+        for key, delta in changes
+    ]
+    res = db.inventory.bulk_write(ops, ordered=False, session=session)
+
+    refused = {}
+    if res.matched_count + len(res.upserted_ids) < len(ops):
+        # Some decrement found too few units (or no counter): only log what was applied
+        applied = {
+            (doc['bloodGroup'], doc['componentType'])
+            for doc in db.inventory.find(
+                {"$or": [key for key, _delta in changes], "movementIds": movement_id},
+                {"bloodGroup": 1, "componentType": 1}, session=session
+            )
+        }
+        refused = {
+            (key['bloodGroup'], key['componentType']): delta
+            for key, delta in changes if (key['bloodGroup'], key['componentType']) not in applied
+        }
+        changes = [(key, delta) for key, delta in changes if (key['bloodGroup'], key['componentType']) in applied]
+        print(f"Stock changes refused for {hospital_id}: {refused} (not enough units)")
+    record_movements(db, [
+        movement(hospital_id, key['bloodGroup'], key['componentType'], delta,
+                 source=source, request_id=request_id, actor=actor)
+        for key, delta in changes
+    ], session=session)
+    return refused
+
+
+def units_by_component(blood_group, source_batches, units):
+    """
+    Split `units` of a blood group by the components of the batches they were
+    drawn from: {(bloodGroup, componentType): units}. Units not backed by a
+    batch are attributed to the default component.
+    """
+    split = {}
+    drawn = 0
+    for src in source_batches or []:
+        key = (blood_group, src.get('componentType') or DEFAULT_COMPONENT)
+        split[key] = split.get(key, 0) + src.get('unitsUsed', 0)
+        drawn += src.get('unitsUsed', 0)
+    if units > drawn:
+        key = (blood_group, DEFAULT_COMPONENT)
+        split[key] = split.get(key, 0) + units - drawn
+    return split
+
+
+def set_stock(db, hospital_id, blood_group, units, component_type=None, actor=None):
+    """
+    Overwrite one stock counter (manual stock entry); the difference is
+    logged in the same transaction.
+    """
+    key = stock_key(hospital_id, blood_group, component_type)
+
+    def apply(session):
+        before = db.inventory.find_one_and_update(
+            key,
+            {"$set": {"units": units, "updatedAt": datetime.datetime.now().isoformat()}},
+            projection={"units": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        previous = before.get('units', 0) if before else 0
+        record_movements(db, [movement(
+            hospital_id, blood_group, key['componentType'], units - previous, source='manual', actor=actor
+        )], session=session)
+
+    run_in_transaction(apply)
+
+
+def get_levels(db, hospital_id, session=None):
+    """
+    Stock for one hospital:
+        {bloodGroup: {"total": int, "held": int, "components": {componentType: int}}}
+    `total` is free stock; units reserved for accepted transfers are in `held`.
+    """
+    levels = {}
+    for doc in db.inventory.find({"hospitalId": hospital_id, "bloodGroup": {"$ne": None}}, session=session):
+        entry = levels.setdefault(doc['bloodGroup'], {"total": 0, "held": 0, "components": {}})
+        units = doc.get('units', 0)
+        entry['total'] += units
+        entry['held'] += doc.get('held', 0)
+        entry['components'][doc.get('componentType') or DEFAULT_COMPONENT] = units
+    return levels
+
+
+def get_stock(db, hospital_id, blood_group, session=None):
+    """Total units of a blood group at a hospital (all components)"""
+    return sum(
+        doc.get('units', 0)
+        for doc in db.inventory.find({"hospitalId": hospital_id, "bloodGroup": blood_group}, {"units": 1}, session=session)
+    )
+
+
+def hospitals_with_stock(db, blood_group, min_units, exclude_hospital_id=None):
+    """
+    [(hospitalId, units)] for hospitals holding at least `min_units` of a group
+    (summed across components). Served by the (bloodGroup, units) index.
+    """
+    match = {"bloodGroup": blood_group, "units": {"$gt": 0}}
+    if exclude_hospital_id:
+        match["hospitalId"] = {"$ne": exclude_hospital_id}
+    rows = db.inventory.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$hospitalId", "units": {"$sum": "$units"}}},
+        {"$match": {"units": {"$gte": min_units}}}
+    ])
+    return [(row['_id'], row['units']) for row in rows]
@@ -0,0 +1,194 @@
+"""
+Inventory ledger.
+
+Every change to an inventory counter appends one movement to
+`db.inventory_ledger`:
+
+    {"hospitalId", "bloodGroup", "componentType",
+     "delta": -2,          # change to free stock (inventory.units)
+     "heldDelta": 2,       # change to reserved stock (inventory.held)
+     "source": "hold",     # what moved it (see SOURCES)
+     "batchId", "requestId", "actor", "at": datetime}
+
+Movements are written by api/inventory.py and api/reservations.py with the
+same session as the counter update, so inside a transaction they commit
+together. The ledger is never updated or deleted from. Each insert also
+bumps the daily report rollups (api/rollups.py).
+
+`db.inventory_snapshots` holds periodic per-hospital balances
+(scripts/snapshot_inventory.py). Stock at a point in time is the nearest
+snapshot before it plus the ledger movements in between, so the cost is
+bounded by the snapshot interval rather than the age of the hospital.
+"""
+import datetime
+from . import cache
+from .db import on_commit
+from .reports import invalidate_reports
+from .rollups import record_rollups
+from .regional_stock import apply_movements as apply_regional_movements
+
+SOURCES = (
+    'manual',         # BloodInventoryView POST (set_stock)
+    'batch_intake',   # BatchView POST
+    'donation',       # completed appointment / donor request
+    'transfer_in',    # completed transfer, receiving side
+    'transfer_out',   # transfer consumed at the sender (legacy accept path)
+    'receive',        # BloodReceiveView
+    'use',            # BatchActionView use_unit
+    'discard',        # BatchActionView discard_unit
+    'expiry',         # expired batches removed by the inventory sync
+    'hold',           # stock reserved for an accepted transfer
+    'release',        # reservation cancelled / timed out
+    'dispatch',       # reservation converted into batch consumption
+    'refund',         # dispatched transfer cancelled
+    'reconcile',      # repair from batch totals
+)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def movement(hospital_id, blood_group, component_type, delta=0, held_delta=0,
+             source=None, batch_id=None, request_id=None, actor=None):
+    """Build one ledger entry"""
+    return {
+        "hospitalId": hospital_id,
+        "bloodGroup": blood_group,
+        "componentType": component_type,
+        "delta": delta,
+        "heldDelta": held_delta,
+        "source": source or 'manual',
+        "batchId": str(batch_id) if batch_id else None,
+        "requestId": str(request_id) if request_id else None,
+        "actor": str(actor) if actor else None,
+        "at": _now()
+    }
+
+
+def record_movements(db, entries, session=None):
+    """Append movements (skipping no-ops) in one insert"""
+    entries = [e for e in entries if e.get('delta') or e.get('heldDelta')]
+    if entries:
+        db.inventory_ledger.insert_many(entries, ordered=False, session=session)
+        record_rollups(db, entries, session=session)
+        # Stock moved, so batch-based report metrics changed too
+        invalidate_reports(db, [e['hospitalId'] for e in entries], session=session)
+        # ... and so did cached searches for the blood groups whose free stock moved. Only once
+        # committed: a search recomputed before that would be stored under the new tag version.
+        stock_tags = {f"stock:{e['bloodGroup']}" for e in entries if e.get('delta')}
+        on_commit(session, lambda: cache.invalidate(*stock_tags))
+        # Regional stock map (locations/stock-map/) follows free stock incrementally
+        apply_regional_movements(db, entries, session=session)
+
+
+def _level_key(blood_group, component_type):
+    return f"{blood_group}|{component_type}"
+
+
+def _sum_movements(db, hospital_id, after=None, until=None, sign=1):
+    """{"bg|component": {"units", "held"}} of the movements in (after, until]"""
+    at = {}
+    if after is not None:
+        at["$gt"] = after
+    if until is not None:
+        at["$lte"] = until
+    match = {"hospitalId": hospital_id}
+    if at:
+        match["at"] = at
+    totals = {}
+    for row in db.inventory_ledger.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"bloodGroup": "$bloodGroup", "componentType": "$componentType"},
+            "units": {"$sum": "$delta"},
+            "held": {"$sum": "$heldDelta"}
+        }}
+    ]):
+        key = _level_key(row['_id']['bloodGroup'], row['_id']['componentType'])
+        totals[key] = {"units": sign * row['units'], "held": sign * row['held']}
+    return totals
+
+
+def _apply(levels, totals):
+    for key, change in totals.items():
+        entry = levels.setdefault(key, {"units": 0, "held": 0})
+        entry['units'] += change['units']
+        entry['held'] += change['held']
+    return levels
+
+
+def current_levels(db, hospital_id):
+    """{"bg|component": {"units", "held"}} straight from the inventory counters"""
+    return {
+        _level_key(doc['bloodGroup'], doc.get('componentType')): {
+            "units": doc.get('units', 0), "held": doc.get('held', 0)
+        }
+        for doc in db.inventory.find(
+            {"hospitalId": hospital_id, "bloodGroup": {"$ne": None}},
+            {"bloodGroup": 1, "componentType": 1, "units": 1, "held": 1}
+        )
+    }
+
+
+def stock_at(db, hospital_id, when):
+    """
+    Stock of a hospital at `when` (aware or naive-UTC datetime):
+        {bloodGroup: {"total", "held", "components": {componentType: units}}}
+
+    Rolls forward from the latest snapshot at or before `when`; without one
+    (e.g. before the first snapshot) it rolls back from the live counters.
+    """
+    snapshot = db.inventory_snapshots.find_one(
+        {"hospitalId": hospital_id, "at": {"$lte": when}}, sort=[("at", -1)]
+    )
+    if snapshot:
+        levels = {k: dict(v) for k, v in snapshot.get('levels', {}).items()}
+        _apply(levels, _sum_movements(db, hospital_id, after=snapshot['at'], until=when))
+    else:
+        levels = current_levels(db, hospital_id)
+        _apply(levels, _sum_movements(db, hospital_id, after=when, sign=-1))
+
+    result = {}
+    for key, level in levels.items():
+        bg, component = key.split('|', 1)
+        entry = result.setdefault(bg, {"total": 0, "held": 0, "components": {}})
+        entry['total'] += level['units']
+        entry['held'] += level['held']
+        entry['components'][component] = level['units']
+    return result
+
+
+def take_snapshot(db, hospital_id, at=None):
+    """
+    Store the balance of a hospital at `at` (default now), derived from the
+    previous snapshot plus the ledger since, or from the live counters for
+    the first snapshot.
+    """
+    at = at or _now()
+    previous = db.inventory_snapshots.find_one(
+        {"hospitalId": hospital_id, "at": {"$lte": at}}, sort=[("at", -1)]
+    )
+    if previous:
+        levels = {k: dict(v) for k, v in previous.get('levels', {}).items()}
+        _apply(levels, _sum_movements(db, hospital_id, after=previous['at'], until=at))
+    else:
+        levels = current_levels(db, hospital_id)
+        _apply(levels, _sum_movements(db, hospital_id, after=at, sign=-1))
+    db.inventory_snapshots.insert_one({"hospitalId": hospital_id, "at": at, "levels": levels})
+    return levels
+
+
+def movement_history(db, hospital_id, blood_group=None, since=None, until=None, limit=100):
+    """Most recent movements first, served by the (hospitalId, bloodGroup, at) indexes"""
+    query = {"hospitalId": hospital_id}
+    if blood_group:
+        query["bloodGroup"] = blood_group
+    at = {}
+    if since is not None:
+        at["$gte"] = since
+    if until is not None:
+        at["$lt"] = until
+    if at:
+        query["at"] = at
+    return list(db.inventory_ledger.find(query).sort([("at", -1), ("_id", -1)]).limit(limit))
@@ -0,0 +1,133 @@
+"""
+Donor -> batch -> issue lineage (lookback / recall).
+
+`db.lineage` holds one row per (outgoing record, source batch):
+
+    {"outgoingId", "batchId", "donorId", "hospitalId", "type",
+     "patientId", "referenceId", "receivingHospitalId", "requestId",
+     "units", "issuedOn"}
+
+Rows are written whenever units leave a batch for a patient
+(BatchActionView) or another hospital (transfer dispatch). A transfer's
+units arrive as a new batch at the receiver tagged with `sourceRequestId`,
+which is how a lookback follows them downstream. Every hop is two indexed
+queries, and hops are capped at MAX_HOPS.
+"""
+from bson import ObjectId # type: ignore
+from pymongo import UpdateOne # type: ignore
+
+LINEAGE_TYPES = ('patient_usage', 'transfer')
+MAX_HOPS = 4
+
+
+def batch_donor_id(batch):
+    """Donor of a batch (manual entries use donorId, donations donorDetails.donorId)"""
+    return batch.get('donorId') or (batch.get('donorDetails') or {}).get('donorId')
+
+
+def record_issue(db, outgoing, session=None):
+    """
+    Index an outgoing record's source batches. Upserts by (outgoingId,
+    batchId), so recording the same issue twice is harmless.
+    """
+    if outgoing.get('type') not in LINEAGE_TYPES or not outgoing.get('sourceBatchIds'):
+        return
+    sources = [s for s in outgoing['sourceBatchIds'] if s.get('batchId')]
+    batch_ids = []
+    for src in sources:
+        try:
+            batch_ids.append(ObjectId(src['batchId']))
+        except Exception:
+            continue
+    donors = {
+        str(b['_id']): batch_donor_id(b)
+        for b in db.batches.find({"_id": {"$in": batch_ids}}, {"donorId": 1, "donorDetails.donorId": 1}, session=session)
+    }
+
+    outgoing_id = str(outgoing['_id'])
+    ops = [
+        UpdateOne(
+            {"outgoingId": outgoing_id, "batchId": src['batchId']},
+            {"$set": {
+                "donorId": donors.get(src['batchId']) or src.get('donorId'),
+                "hospitalId": outgoing.get('hospitalId'),
+                "type": outgoing.get('type'),
+                "bloodGroup": outgoing.get('bloodGroup'),
+                "patientId": outgoing.get('patientId'),
+                "referenceId": outgoing.get('referenceId'),
+                "receivingHospitalId": outgoing.get('receivingHospitalId'),
+                "requestId": (outgoing.get('dispatchDetails') or {}).get('requestId'),
+                "units": src.get('unitsUsed', 0),
+                "issuedOn": outgoing.get('issuedOn')
+            }},
+            upsert=True
+        )
+        for src in sources
+    ]
+    if ops:
+        db.lineage.bulk_write(ops, ordered=False, session=session)
+
+
+def forget_issue(db, outgoing_id, session=None):
+    """Drop lineage for an issue whose units were returned (cancelled transfer)"""
+    db.lineage.delete_many({"outgoingId": str(outgoing_id)}, session=session)
+
+
+def lookback(db, donor_id=None, batch_id=None):
+    """
+    Everything downstream of a donor (or a single batch): their batches,
+    the patients who received units, and the hospitals units were
+    transferred to, following transfers for up to MAX_HOPS.
+    Rows reached through a transfer are marked with the hop they were found
+    at; a received batch may mix units from several donors, so those are
+    possible rather than certain exposures.
+    """
+    if batch_id:
+        batch_query = {"_id": ObjectId(batch_id)}
+    else:
+        batch_query = {"$or": [{"donorId": donor_id}, {"donorDetails.donorId": donor_id}]}
+
+    projection = {"hospitalId": 1, "bloodGroup": 1, "componentType": 1, "units": 1, "status": 1,
+                  "collectedDate": 1, "expiryDate": 1, "sourceRequestId": 1}
+    batches = []
+    recipients = []
+    transfers = []
+    frontier = list(db.batches.find(batch_query, projection))
+    seen = set()
+    hops = 0
+
+    while frontier and hops <= MAX_HOPS:
+        ids = []
+        for b in frontier:
+            if str(b['_id']) in seen:
+                continue
+            seen.add(str(b['_id']))
+            ids.append(str(b['_id']))
+            batches.append({**b, "_id": str(b['_id']), "hop": hops})
+        if not ids:
+            break
+
+        request_ids = []
+        for row in db.lineage.find({"batchId": {"$in": ids}}, {"_id": 0}):
+            row['hop'] = hops
+            if row.get('type') == 'transfer':
+                transfers.append(row)
+                if row.get('requestId'):
+                    request_ids.append(row['requestId'])
+            else:
+                recipients.append(row)
+
+        hops += 1
+        if not request_ids or hops > MAX_HOPS:
+            break
+        frontier = list(db.batches.find({"sourceRequestId": {"$in": request_ids}}, projection))
+
+    return {
+        "donorId": donor_id,
+        "batchId": batch_id,
+        "hops": hops,
+        "truncated": bool(frontier) and hops > MAX_HOPS,
+        "batches": batches,
+        "patients": recipients,
+        "transfers": transfers
+    }
@@ -0,0 +1,348 @@
+"""
+Notification helpers.
+
+Broadcast alerts (e.g. EMERGENCY_ALERT sent to every matching donor) are
+stored ONCE in `db.broadcasts` together with the audience they target.
+Each user's interaction with a broadcast (read / accepted / dismissed) is
+kept as a tiny row in `db.notification_states`. NotificationView merges
+personal notifications and relevant broadcasts at read time, so an alert
+to thousands of donors costs one insert instead of thousands.
+
+Retention: once a notification is read or acted on it gets a native
+`expireAt` datetime and is removed by a TTL index after
+NOTIFICATION_RETENTION_DAYS. Unread notifications never expire.
+Per-user unread counts are kept in `db.notification_counters`
+({_id: userId, unread: n}) and maintained by the writers below, so the
+app badge doesn't need the full list.
+"""
+import datetime
+from collections import Counter
+from bson import ObjectId # type: ignore
+from django.conf import settings # type: ignore
+from pymongo import ReturnDocument, UpdateOne # type: ignore
+
+# Broadcast items are exposed to clients with an id of "<broadcastId>:<userId>"
+# so the existing PUT /notifications/ contract (id + status) keeps working.
+BROADCAST_ID_SEPARATOR = ':'
+
+
+def retention_expiry():
+    """expireAt value for a notification that was just read / acted on"""
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        days=settings.NOTIFICATION_RETENTION_DAYS
+    )
+
+
+def _bump_unread(db, counts):
+    """
+    Apply {recipientId: delta} to the unread counters (called after the
+    notifications were written). Existing counters move in one round trip;
+    a user without one is seeded from their UNREAD notifications, which
+    already include this change, so legacy unread rows are counted.
+    """
+    counts = {r: d for r, d in counts.items() if r and d}
+    if not counts:
+        return
+    existing = set(db.notification_counters.distinct("_id", {"_id": {"$in": list(counts)}}))
+    ops = [
+        UpdateOne({"_id": recipient_id}, {"$inc": {"unread": delta}})
+        for recipient_id, delta in counts.items() if recipient_id in existing
+    ]
+    if ops:
+        db.notification_counters.bulk_write(ops, ordered=False)
+    for recipient_id, delta in counts.items():
+        if recipient_id in existing:
+            continue
+        seeded = db.notifications.count_documents({"recipientId": recipient_id, "status": "UNREAD"})
+        res = db.notification_counters.update_one(
+            {"_id": recipient_id}, {"$setOnInsert": {"unread": seeded}}, upsert=True
+        )
+        if res.upserted_id is None:
+            # Seeded concurrently in the meantime: apply our change on top
+            db.notification_counters.update_one({"_id": recipient_id}, {"$inc": {"unread": delta}})
+
+
+def normalize_notification(doc):
+    """
+    Coerce a notification into the canonical schema:
+        recipientId, type, title, message, relatedRequestId, status, timestamp
+    Legacy shapes (userId / date / read) are mapped onto it.
+    """
+    status = doc.get('status')
+    if not status:
+        status = 'READ' if doc.get('read') else 'UNREAD'
+
+    normalized = {
+        "recipientId": str(doc.get('recipientId') or doc.get('userId') or ''),
+        "type": doc.get('type') or 'info',
+        "title": doc.get('title', ''),
+        "message": doc.get('message', ''),
+        "relatedRequestId": str(doc['relatedRequestId']) if doc.get('relatedRequestId') else None,
+        "status": status,
+        "timestamp": doc.get('timestamp') or doc.get('date') or datetime.datetime.now().isoformat(),
+    }
+    if status != 'UNREAD':
+        normalized['expireAt'] = retention_expiry()
+    return normalized
+
+
+def notify(db, recipient_id, notif_type, title, message, related_request_id=None, event_id=None):
+    """
+    Single writer for personal notifications. Every view goes through here
+    so all documents share one schema (and one recipientId+timestamp index).
+
+    With an event_id (outbox delivery) the insert is an upsert on it, so a
+    redelivered event neither duplicates the notification nor bumps the
+    unread count twice. Returns the notification id, or None when it
+    already existed.
+    """
+    doc = normalize_notification({
+        "recipientId": recipient_id,
+        "type": notif_type,
+        "title": title,
+        "message": message,
+        "relatedRequestId": related_request_id,
+    })
+    if event_id:
+        doc['eventId'] = event_id
+        res = db.notifications.update_one({"eventId": event_id}, {"$setOnInsert": doc}, upsert=True)
+        if res.upserted_id is None:
+            return None
+        _bump_unread(db, {doc['recipientId']: 1})
+        return res.upserted_id
+    res = db.notifications.insert_one(doc)
+    _bump_unread(db, {doc['recipientId']: 1})
+    return res.inserted_id
+
+
+def record_notifications(db, docs):
+    """Insert many personal notifications with one counter update per recipient"""
+    docs = [normalize_notification(d) for d in docs]
+    db.notifications.insert_many(docs)
+    _bump_unread(db, Counter(
+        d.get('recipientId') for d in docs if d.get('status', 'UNREAD') == 'UNREAD'
+    ))
+
+
+def update_notification_status(db, notif_id, new_status):
+    """
+    Change a personal notification's status.
+    Read / acted-on notifications start their retention countdown.
+    Returns the updated document (or None).
+    """
+    if new_status == 'UNREAD':
+        update = {"$set": {"status": new_status}, "$unset": {"expireAt": ""}}
+    else:
+        update = {"$set": {"status": new_status, "expireAt": retention_expiry()}}
+
+    before = db.notifications.find_one_and_update(
+        {"_id": ObjectId(notif_id)}, update, return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        return None
+
+    was_unread = before.get('status', 'UNREAD') == 'UNREAD'
+    is_unread = new_status == 'UNREAD'
+    if was_unread != is_unread:
+        _bump_unread(db, {before.get('recipientId'): 1 if is_unread else -1})
+
+    before['status'] = new_status
+    return before
+
+
+def mark_notifications_read(db, recipient_id, related_request_id):
+    """Mark a user's unread notifications for a request as READ"""
+    res = db.notifications.update_many(
+        {"recipientId": recipient_id, "relatedRequestId": related_request_id, "status": "UNREAD"},
+        {"$set": {"status": "READ", "expireAt": retention_expiry()}}
+    )
+    if res.modified_count:
+        _bump_unread(db, {recipient_id: -res.modified_count})
+
+
+def delete_notifications(db, query):
+    """Delete personal notifications, releasing their unread counts first"""
+    unread = db.notifications.aggregate([
+        {"$match": {**query, "status": "UNREAD"}},
+        {"$group": {"_id": "$recipientId", "n": {"$sum": 1}}}
+    ])
+    _bump_unread(db, {row['_id']: -row['n'] for row in unread})
+    return db.notifications.delete_many(query)
+
+
+def unread_count(db, user_id):
+    """Unread personal notifications (counter) + unseen relevant broadcasts"""
+    counter = db.notification_counters.find_one({"_id": user_id})
+    if counter is None:
+        # First use for this user: seed the counter from existing data
+        seeded = db.notifications.count_documents({"recipientId": user_id, "status": "UNREAD"})
+        db.notification_counters.update_one(
+            {"_id": user_id}, {"$setOnInsert": {"unread": seeded}}, upsert=True
+        )
+        personal = seeded
+    else:
+        personal = max(0, counter.get('unread', 0))
+
+    user = _load_audience_user(db, user_id)
+    if not user:
+        return personal
+    active_ids = [str(b['_id']) for b in db.broadcasts.find(_audience_query(user), {"_id": 1})]
+    if not active_ids:
+        return personal
+    seen = db.notification_states.count_documents({"userId": user_id, "broadcastId": {"$in": active_ids}})
+    return personal + max(0, len(active_ids) - seen)
+
+
+def create_broadcast(db, notif_type, title, message, related_request_id, audience):
+    """
+    Store a single broadcast notification.
+
+    audience: {"role": "donor", "bloodGroup": "O+", "cities": [...] or None}
+    """
+    now_iso = datetime.datetime.now().isoformat()
+    doc = {
+        "type": notif_type,
+        "title": title,
+        "message": message,
+        "relatedRequestId": related_request_id,
+        "audience": {
+            "role": audience.get('role'),
+            "bloodGroup": audience.get('bloodGroup'),
+            "cities": audience.get('cities') or None,
+        },
+        "timestamp": now_iso,
+        "createdAt": now_iso,
+        "status": "ACTIVE"
+    }
+    return db.broadcasts.insert_one(doc).inserted_id
+
+
+def close_broadcasts(db, related_request_id):
+    """Stop showing broadcasts for a request (accepted / cancelled)"""
+    return db.broadcasts.update_many(
+        {"relatedRequestId": related_request_id, "status": "ACTIVE"},
+        {"$set": {
+            "status": "CLOSED",
+            "closedAt": datetime.datetime.now().isoformat(),
+            "expireAt": retention_expiry()
+        }}
+    )
+
+
+def set_broadcast_state(db, user_id, broadcast_id, state):
+    """Record a user's READ / ACCEPTED / DISMISSED state for a broadcast"""
+    db.notification_states.update_one(
+        {"userId": user_id, "broadcastId": str(broadcast_id)},
+        {"$set": {
+            "status": state,
+            "updatedAt": datetime.datetime.now().isoformat(),
+            "expireAt": retention_expiry()
+        }},
+        upsert=True
+    )
+
+
+def mark_request_broadcasts(db, user_id, related_request_id, state):
+    """Apply a state to every broadcast of a request for one user"""
+    ids = db.broadcasts.distinct("_id", {"relatedRequestId": related_request_id})
+    for b_id in ids:
+        set_broadcast_state(db, user_id, b_id, state)
+
+
+def parse_broadcast_item_id(item_id):
+    """Split a client-facing broadcast item id into (broadcastId, userId), or None"""
+    if not item_id or BROADCAST_ID_SEPARATOR not in str(item_id):
+        return None
+    broadcast_id, user_id = str(item_id).split(BROADCAST_ID_SEPARATOR, 1)
+    return broadcast_id, user_id
+
+
+def _load_audience_user(db, user_id):
+    try:
+        return db.users.find_one(
+            {"_id": ObjectId(user_id)},
+            {"role": 1, "bloodGroup": 1, "location": 1, "createdAt": 1}
+        )
+    except Exception:
+        return None
+
+
+def _audience_query(user):
+    """
+    Active broadcasts targeting this user's role, blood group and city, sent
+    since they registered (like a per-user fan-out, an account never receives
+    alerts from before it existed). Users without createdAt predate the
+    field and see every matching broadcast.
+    """
+    query = {
+        "status": "ACTIVE",
+        "audience.role": user.get('role'),
+        "audience.bloodGroup": user.get('bloodGroup'),
+        "$or": [
+            {"audience.cities": None},
+            {"audience.cities": user.get('location')}
+        ]
+    }
+    if user.get('createdAt'):
+        query["createdAt"] = {"$gte": user['createdAt']}
+    return query
+
+
+def visible_broadcast(db, user, broadcast_id):
+    """
+    The broadcast if it is shown to `user` (a users document): in its
+    audience (see _audience_query) or accepted by them. None otherwise.
+    """
+    if not ObjectId.is_valid(str(broadcast_id)):
+        return None
+    accepted = db.notification_states.find_one(
+        {"userId": str(user['_id']), "broadcastId": str(broadcast_id), "status": "ACCEPTED"}, {"_id": 1}
+    )
+    query = {"_id": ObjectId(str(broadcast_id))}
+    if not accepted:
+        query.update(_audience_query(user))
+    return db.broadcasts.find_one(query)
+
+
+def broadcasts_for_user(db, user_id):
+    """
+    Render the broadcasts relevant to a user as notification-shaped dicts.
+
+    A broadcast is relevant while ACTIVE, sent after the user registered
+    and matching their current role, blood group and city. Unlike copies
+    fanned out at send time, a user who changes city or blood group stops
+    seeing the old audience's open alerts (they only concerned that
+    audience). Broadcasts the user ACCEPTED stay visible after they are
+    closed, or no longer match, so the donor keeps their history.
+    """
+    user = _load_audience_user(db, user_id)
+    if not user:
+        return []
+
+    states = {
+        s['broadcastId']: s.get('status')
+        for s in db.notification_states.find({"userId": user_id}, {"broadcastId": 1, "status": 1})
+    }
+    accepted_ids = [ObjectId(b_id) for b_id, st in states.items() if st == 'ACCEPTED']
+
+    audience_query = _audience_query(user)
+    query = {"$or": [audience_query, {"_id": {"$in": accepted_ids}}]} if accepted_ids else audience_query
+
+    items = []
+    for b in db.broadcasts.find(query):
+        b_id = str(b['_id'])
+        state = states.get(b_id, 'UNREAD')
+        if state == 'DISMISSED':
+            continue
+        items.append({
+            "id": f"{b_id}{BROADCAST_ID_SEPARATOR}{user_id}",
+            "recipientId": user_id,
+            "type": b.get('type'),
+            "title": b.get('title'),
+            "message": b.get('message'),
+            "relatedRequestId": b.get('relatedRequestId'),
+            "timestamp": b.get('timestamp'),
+            "status": state,
+            "isBroadcast": True
+        })
+    return items
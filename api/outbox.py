@@ -0,0 +1,380 @@
+"""
+Transactional outbox for request side effects.
+
+A handler that moves a request (accept, dispatch, complete) records what
+should follow from it - notifications and pushes, the receiver's batch and
+stock, the donor's history and stats - as events in `db.outbox`, in the
+same transaction as the status change (transition_with_events). The HTTP
+call only pays for those writes; the side effects can't be half-applied
+or lost when something fails midway.
+
+Events are applied by a worker pool: OUTBOX_WORKERS threads in the web
+process, kicked after each commit and every OUTBOX_POLL_SECONDS (for
+backed-off retries and events left behind by a restart), and optionally
+scripts/outbox_worker.py as a separate worker or cron job. Delivery is
+at-least-once, so every handler is idempotent: its writes are upserts
+keyed by the event id, and counters / stock only move when the upsert
+inserted.
+
+    pending -> processing (leased for OUTBOX_LEASE_SECONDS) -> done
+            <- retried with backoff, failed after OUTBOX_MAX_ATTEMPTS
+
+Done events are purged by a TTL index after OUTBOX_RETENTION_DAYS.
+"""
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId # type: ignore
+from django.conf import settings # type: ignore
+from pymongo import ReturnDocument # type: ignore
+from pymongo.errors import DuplicateKeyError # type: ignore
+from .db import get_db, run_in_transaction
+from .donor_stats import record_donation
+from .inventory import adjust_stock
+from .notifications import notify
+from .push import send_push_multicast
+from .request_states import transition
+
+MAX_BACKOFF_SECONDS = 600
+
+HANDLERS = {}
+
+
+def handler(event_type):
+    """Register the function that applies events of `event_type`: fn(db, event_id, payload)"""
+    def register(fn):
+        HANDLERS[event_type] = fn
+        return fn
+    return register
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def record_event(db, event_type, payload, session=None):
+    """Queue an event. Pass the session of the state change it belongs to."""
+    now = _utcnow()
+    doc = {
+        "type": event_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "availableAt": now,
+        "createdAt": now
+    }
+    db.outbox.insert_one(doc, session=session)
+    return doc['_id']
+
+
+def transition_with_events(db, req_id, to_status, events, writes=None, **kwargs):
+    """
+    transition() plus the events it implies, committed together.
+    events(post_image) -> [(event_type, payload)]; writes(post_image, session),
+    optional, makes further writes that must commit (or abort) with the
+    status change. Returns the post-image (None when the guard didn't
+    match, and nothing is queued or written).
+    """
+    def apply(session):
+        req = transition(db, req_id, to_status, session=session, **kwargs)
+        if req is not None:
+            if writes is not None:
+                writes(req, session)
+            for event_type, payload in events(req):
+                record_event(db, event_type, payload, session=session)
+        return req
+
+    req = run_in_transaction(apply)
+    if req is not None:
+        kick()
+    return req
+
+
+def notify_event(recipient_id, notif_type, title, message, related_request_id=None,
+                 actor_id=None, actor_fallback=None, push=None):
+    """
+    ('notify', payload) for a personal notification and optional push.
+    "{actor}" in the message / push body is replaced by the name of
+    actor_id when the event is applied, so the caller doesn't pay for the
+    lookup. push: {"title", "body", "data"}.
+    """
+    return "notify", {
+        "recipientId": str(recipient_id) if recipient_id else None,
+        "notifType": notif_type,
+        "title": title,
+        "message": message,
+        "relatedRequestId": related_request_id,
+        "actorId": str(actor_id) if actor_id else None,
+        "actorFallback": actor_fallback,
+        "push": push
+    }
+
+
+def _find_user(db, user_id, fields):
+    if not user_id or not ObjectId.is_valid(str(user_id)):
+        return None
+    return db.users.find_one({"_id": ObjectId(str(user_id))}, fields)
+
+
+@handler("notify")
+def apply_notify(db, event_id, payload):
+    recipient = _find_user(db, payload.get('recipientId'), {"fcmToken": 1})
+    if not recipient:
+        return
+    actor_name = payload.get('actorFallback') or ''
+    if payload.get('actorId'):
+        actor = _find_user(db, payload['actorId'], {"name": 1})
+        if actor and actor.get('name'):
+            actor_name = actor['name']
+
+    notify(
+        db,
+        payload['recipientId'],
+        payload.get('notifType'),
+        payload.get('title', ''),
+        (payload.get('message') or '').replace('{actor}', actor_name),
+        related_request_id=payload.get('relatedRequestId'),
+        event_id=event_id
+    )
+
+    push = payload.get('push')
+    if push and recipient.get('fcmToken'):
+        # Claim the push on the notification so a redelivered event doesn't send it twice
+        claimed = db.notifications.find_one_and_update(
+            {"eventId": event_id, "pushedAt": None},
+            {"$set": {"pushedAt": _utcnow()}}
+        )
+        if claimed:
+            send_push_multicast(
+                [recipient['fcmToken']],
+                push.get('title', ''),
+                (push.get('body') or '').replace('{actor}', actor_name),
+                push.get('data')
+            )
+
+
+def record_history(db, event_id, record, stats_type):
+    """
+    Completed appointment (donation history) for a donor plus their stats,
+    once per event.
+    """
+    def apply(session):
+        res = db.appointments.update_one(
+            {"eventId": event_id}, {"$setOnInsert": {**record, "eventId": event_id}},
+            upsert=True, session=session
+        )
+        if res.upserted_id is not None:
+            record_donation(db, record.get('donorId'), stats_type, session=session)
+
+    try:
+        run_in_transaction(apply)
+    except DuplicateKeyError:
+        pass # a concurrent delivery of the same event got there first
+
+
+@handler("request_completed")
+def apply_request_completed(db, event_id, payload):
+    """The receiver's side of a completed request: batch + stock, donor history"""
+    req_id = payload['requestId']
+    req = db.requests.find_one({"_id": ObjectId(req_id)})
+    if not req:
+        return
+    req_type = req.get('type')
+    units = int(req.get('units', 1))
+    bg = req.get('bloodGroup')
+    is_transfer = req_type in ['P2P', 'StockTransfer']
+
+    # Determine Who is Who
+    if req_type == 'P2P':
+        # P2P: Requester is the Hospital receiving blood. acceptedBy is the Donor.
+        donor_id = req.get('acceptedDonorId') or req.get('acceptedBy')
+        requester_id = req.get('requesterId')
+    elif req_type == 'StockTransfer':
+        # Transfer: Requester is Receiver. acceptedBy is the Sending Hospital.
+        donor_id = req.get('acceptedBy')
+        requester_id = req.get('requesterId')
+    else:
+        # Emergency/Broadcast: hospitalId is the SOURCE (Need), acceptedBy is the DONOR
+        donor_id = req.get('acceptedBy')
+        requester_id = req.get('hospitalId') or req.get('requesterId')
+
+    donor = _find_user(db, donor_id, {"name": 1, "email": 1, "phone": 1, "bloodGroup": 1, "role": 1})
+    donor_details = {}
+    if donor:
+        donor_details = {
+            "donorId": str(donor['_id']),
+            "name": donor.get('name'),
+            "email": donor.get('email'),
+            "phone": donor.get('phone'),
+            "bloodGroup": donor.get('bloodGroup')
+        }
+
+    # 1. Batch + stock for the Requester (they received it), once per event
+    if requester_id and bg:
+        now = datetime.datetime.now()
+        batch = {
+            "hospitalId": requester_id,
+            "bloodGroup": bg,
+            "componentType": "Whole Blood",
+            "units": units,
+            "collectedDate": now.isoformat(),
+            "expiryDate": (now + datetime.timedelta(days=35)).isoformat(),
+            "sourceType": "Transfer" if is_transfer else "Donation",
+            "sourceName": donor.get('name', 'Unknown') if donor else "External Source",
+            "donorDetails": donor_details,
+            "sourceRequestId": req_id, # links back to the sender's lineage rows
+            "location": "Incoming Setup",
+            "createdAt": now.isoformat(),
+            "status": "Active",
+            "eventId": event_id
+        }
+
+        def receive(session):
+            res = db.batches.update_one({"eventId": event_id}, {"$setOnInsert": batch}, upsert=True, session=session)
+            if res.upserted_id is not None:
+                adjust_stock(
+                    db, requester_id, bg, units, session=session,
+                    source='transfer_in' if is_transfer else 'donation',
+                    request_id=req_id, batch_id=res.upserted_id, actor=donor_id
+                )
+
+        try:
+            run_in_transaction(receive)
+        except DuplicateKeyError:
+            pass
+
+    # 2. Donation history + stats when a donor gave the blood
+    if donor and donor.get('role') == 'donor':
+        record_history(db, event_id, {
+            "donorId": donor_id,
+            "hospitalId": requester_id,
+            "hospitalName": req.get('hospitalName') or 'Emergency Request',
+            "date": (req.get('completedAt') or datetime.datetime.now().isoformat()),
+            "units": units,
+            "bloodGroup": bg,
+            "type": "Emergency Donation",
+            "status": "Completed",
+            "requestId": req_id
+        }, "Emergency Request")
+
+
+@handler("donation_recorded")
+def apply_donation_recorded(db, event_id, payload):
+    """History + stats for a donation recorded outside an emergency request (P2P)"""
+    record_history(db, event_id, payload['record'], payload['statsType'])
+
+
+def claim(db):
+    """Lease the next due event (or one whose worker's lease ran out), or None"""
+    now = _utcnow()
+    return db.outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "availableAt": {"$lte": now}},
+            {"status": "processing", "lockedUntil": {"$lt": now}}
+        ]},
+        {
+            "$set": {"status": "processing", "lockedUntil": now + datetime.timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("availableAt", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def process(db, event):
+    """
+    Apply one claimed event. Returns True when it is done. The outcome is
+    only written while our lease holds: if it ran out and another worker
+    re-claimed the event, that worker's result counts.
+    """
+    fn = HANDLERS.get(event.get('type'))
+    leased = {"_id": event['_id'], "status": "processing", "lockedUntil": event.get('lockedUntil')}
+    try:
+        if fn is None:
+            raise LookupError(f"No handler for event type '{event.get('type')}'")
+        fn(db, str(event['_id']), event.get('payload') or {})
+    except Exception as e:
+        attempts = event.get('attempts', 1)
+        give_up = attempts >= settings.OUTBOX_MAX_ATTEMPTS
+        db.outbox.update_one(leased, {
+            "$set": {
+                "status": "failed" if give_up else "pending",
+                "availableAt": _utcnow() + datetime.timedelta(seconds=min(2 ** attempts, MAX_BACKOFF_SECONDS)),
+                "error": str(e)
+            },
+            "$unset": {"lockedUntil": ""}
+        })
+        print(f"Outbox event {event['_id']} ({event.get('type')}) failed (attempt {attempts}): {e}")
+        return False
+
+    now = _utcnow()
+    db.outbox.update_one(leased, {
+        "$set": {
+            "status": "done",
+            "processedAt": now,
+            "expireAt": now + datetime.timedelta(days=settings.OUTBOX_RETENTION_DAYS)
+        },
+        "$unset": {"lockedUntil": "", "error": ""}
+    })
+    return True
+
+
+def drain(db=None, limit=100):
+    """Apply due events until none are left (or `limit`). Returns (done, failed)."""
+    db = db if db is not None else get_db()
+    done = failed = 0
+    while done + failed < limit:
+        event = claim(db)
+        if event is None:
+            break
+        if process(db, event):
+            done += 1
+        else:
+            failed += 1
+    return done, failed
+
+
+_executor = None
+_poller = None
+_executor_lock = threading.Lock()
+
+
+def _drain_in_background():
+    try:
+        drain()
+    except Exception as e:
+        print(f"Outbox worker error: {e}")
+
+
+def kick():
+    """Wake the in-process worker pool after queuing events (no-op when OUTBOX_WORKERS is 0)"""
+    global _executor
+    if settings.OUTBOX_WORKERS <= 0 or get_db() is None:
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.OUTBOX_WORKERS, thread_name_prefix='outbox')
+    _executor.submit(_drain_in_background)
+
+
+def _poll():
+    while True:
+        time.sleep(settings.OUTBOX_POLL_SECONDS)
+        kick()
+
+
+def start_poller():
+    """
+    Kick the worker pool every OUTBOX_POLL_SECONDS so retries that backed
+    off (and events queued before a restart) are applied without waiting for
+    the next commit. Started once per web process from config/wsgi.py;
+    no-op when OUTBOX_WORKERS or OUTBOX_POLL_SECONDS is 0.
+    """
+    global _poller
+    if settings.OUTBOX_WORKERS <= 0 or settings.OUTBOX_POLL_SECONDS <= 0 or get_db() is None:
+        return
+    with _executor_lock:
+        if _poller is None:
+            _poller = threading.Thread(target=_poll, name='outbox-poller', daemon=True)
+            _poller.start()
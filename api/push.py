@@ -0,0 +1,38 @@
+"""
+FCM push delivery. Firebase is initialised once at import; without
+credentials pushes are skipped (the in-app notification still exists).
+"""
+import os
+import firebase_admin # type: ignore
+from firebase_admin import credentials, messaging # type: ignore
+
+# Initialize Firebase App (Lazy Singleton)
+try:
+    if not firebase_admin._apps:
+        cred_path = os.getenv('FIREBASE_CREDENTIALS', 'serviceAccountKey.json')
+        if os.path.exists(cred_path):
+             cred = credentials.Certificate(cred_path)
+             firebase_admin.initialize_app(cred)
+        else:
+             print("Warning: Firebase Credentials not found. Push Notifications will not send.")
+except Exception as e:
+    print(f"Firebase Init Error: {e}")
+
+# Push Notification Helper
+def send_push_multicast(tokens, title, body, data=None):
+    if not tokens or not firebase_admin._apps:
+        return
+    try:
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            data=data or {},
+            tokens=tokens,
+        )
+        # Use send_each_for_multicast (correct method for firebase-admin v6+)
+        response = messaging.send_each_for_multicast(message)
+        print(f"Push sent successfully: {response.success_count} succeeded, {response.failure_count} failed")
+        return response
+    except Exception as e:
+        print(f"Push Error: {e}")
+        import traceback
+        traceback.print_exc()
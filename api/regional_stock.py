@@ -0,0 +1,173 @@
+"""
+Regional stock map.
+
+`db.regional_stock` holds one document per region (a hospital's
+`location` city) with the free units per blood group across its
+hospitals, and the per-hospital breakdown for drill-down:
+
+    {"_id": "Pune", "groups": {"O+": 12, "A-": 3},
+     "hospitals": {"<hospitalId>": {"name": "City Hospital", "groups": {"O+": 5}}},
+     "updatedAt": datetime}
+
+ledger.record_movements applies every free-stock movement here with $inc
+(one bulk_write, same session as the counter update), so StockMapView
+reads a handful of region documents however many hospitals and inventory
+rows there are. A hospital that changes city or name, or is deleted, is
+moved with refresh_hospital(); scripts/rebuild_regional_stock.py
+recomputes the whole collection from inventory to repair drift.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from pymongo import UpdateOne # type: ignore
+from .db import run_in_transaction
+
+UNKNOWN_REGION = "Unknown"
+
+
+def region_of(location):
+    """Region a hospital's stock is counted under"""
+    return (location or '').strip() or UNKNOWN_REGION
+
+
+def _hospitals(db, hospital_ids, session=None):
+    oids = [ObjectId(str(h)) for h in hospital_ids if ObjectId.is_valid(str(h))]
+    return {str(u['_id']): u for u in db.users.find(
+        {"_id": {"$in": oids}}, {"name": 1, "location": 1}, session=session
+    )}
+
+
+def apply_movements(db, entries, session=None):
+    """Add ledger movements' free-stock deltas to their hospitals' regions"""
+    deltas = {}
+    for e in entries:
+        if e.get('delta'):
+            key = (str(e['hospitalId']), e['bloodGroup'])
+            deltas[key] = deltas.get(key, 0) + e['delta']
+    deltas = {k: d for k, d in deltas.items() if d}
+    if not deltas:
+        return
+
+    hospitals = _hospitals(db, {hid for hid, _bg in deltas}, session=session)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ops = []
+    for (hid, bg), delta in deltas.items():
+        hospital = hospitals.get(hid, {})
+        ops.append(UpdateOne(
+            {"_id": region_of(hospital.get('location'))},
+            {
+                "$inc": {f"groups.{bg}": delta, f"hospitals.{hid}.groups.{bg}": delta},
+                "$set": {f"hospitals.{hid}.name": hospital.get('name'), "updatedAt": now}
+            },
+            upsert=True
+        ))
+    db.regional_stock.bulk_write(ops, ordered=False, session=session)
+
+
+def _free_stock(db, hospital_ids=None, session=None):
+    """{hospitalId: {bloodGroup: free units}} from the inventory counters"""
+    match = {"units": {"$gt": 0}}
+    if hospital_ids is not None:
+        match["hospitalId"] = {"$in": list(hospital_ids)}
+    stock = {}
+    for row in db.inventory.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"h": "$hospitalId", "bg": "$bloodGroup"}, "units": {"$sum": "$units"}}}
+    ], session=session):
+        stock.setdefault(str(row['_id']['h']), {})[row['_id']['bg']] = row['units']
+    return stock
+
+
+def refresh_hospital(db, hospital_id):
+    """
+    Re-home one hospital: take its counts out of whichever region holds
+    them and add its current free stock under its current region (nothing,
+    if it no longer exists). Runs in one transaction, so a stock movement
+    applied meanwhile either lands before the read or retries after it;
+    without transactions rebuild_regional_stock repairs any drift.
+    """
+    hid = str(hospital_id)
+
+    def rehome(session):
+        for doc in db.regional_stock.find(
+            {f"hospitals.{hid}": {"$exists": True}}, {f"hospitals.{hid}": 1}, session=session
+        ):
+            groups = doc['hospitals'][hid].get('groups') or {}
+            update = {"$unset": {f"hospitals.{hid}": ""}}
+            if groups:
+                update["$inc"] = {f"groups.{bg}": -units for bg, units in groups.items()}
+            db.regional_stock.update_one({"_id": doc['_id']}, update, session=session)
+
+        hospital = _hospitals(db, [hid], session=session).get(hid)
+        if not hospital:
+            return
+        groups = _free_stock(db, [hid], session=session).get(hid, {})
+        if groups:
+            db.regional_stock.update_one(
+                {"_id": region_of(hospital.get('location'))},
+                {
+                    "$inc": {f"groups.{bg}": units for bg, units in groups.items()},
+                    "$set": {
+                        f"hospitals.{hid}": {"name": hospital.get('name'), "groups": groups},
+                        "updatedAt": datetime.datetime.now(datetime.timezone.utc)
+                    }
+                },
+                upsert=True,
+                session=session
+            )
+
+    run_in_transaction(rehome)
+
+
+def rebuild_regional_stock(db):
+    """Recompute every region from inventory. Returns the number of regions."""
+    stock = _free_stock(db)
+    hospitals = _hospitals(db, stock)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    regions = {}
+    for hid, groups in stock.items():
+        hospital = hospitals.get(hid, {})
+        doc = regions.setdefault(region_of(hospital.get('location')), {"groups": {}, "hospitals": {}, "updatedAt": now})
+        doc['hospitals'][hid] = {"name": hospital.get('name'), "groups": groups}
+        for bg, units in groups.items():
+            doc['groups'][bg] = doc['groups'].get(bg, 0) + units
+
+    db.regional_stock.delete_many({})
+    if regions:
+        db.regional_stock.insert_many([{"_id": region, **doc} for region, doc in regions.items()])
+    return len(regions)
+
+
+def _row(groups, blood_groups):
+    units = {bg: max(0, (groups or {}).get(bg, 0)) for bg in blood_groups}
+    return units, sum(units.values())
+
+
+def stock_map(db, blood_groups, region=None):
+    """
+    Region x blood group matrix of free units. With `region`, that region
+    only, plus its hospitals (most stock first). None if the region has
+    no stock document.
+    """
+    if region:
+        doc = db.regional_stock.find_one({"_id": region})
+        if not doc:
+            return None
+        units, total = _row(doc.get('groups'), blood_groups)
+        hospitals = []
+        for hid, entry in (doc.get('hospitals') or {}).items():
+            h_units, h_total = _row(entry.get('groups'), blood_groups)
+            if h_total:
+                hospitals.append({"id": hid, "name": entry.get('name'), "units": h_units, "total": h_total})
+        hospitals.sort(key=lambda h: -h['total'])
+        return {"region": doc['_id'], "units": units, "total": total, "hospitals": hospitals}
+
+    regions = []
+    totals = {bg: 0 for bg in blood_groups}
+    for doc in db.regional_stock.find({}, {"groups": 1}).sort("_id", 1):
+        units, total = _row(doc.get('groups'), blood_groups)
+        if not total:
+            continue
+        regions.append({"region": doc['_id'], "units": units, "total": total})
+        for bg, n in units.items():
+            totals[bg] += n
+    return {"bloodGroups": list(blood_groups), "regions": regions, "totals": totals}
@@ -0,0 +1,144 @@
+"""
+Hospital report metrics.
+
+Each collection's metrics come from ONE aggregation with a $facet per
+metric, and the batches / requests pipelines run concurrently, so a report
+is two parallel round trips instead of four sequential ones.
+
+Computed reports are cached per hospital in `db.report_snapshots`:
+
+    {"_id": hospitalId, "gen": 3, "data": {...}, "computedAt": datetime}
+
+Writers that change a hospital's batches or request states call
+invalidate_reports(), which bumps `gen` and drops the data. A report
+computed while an invalidation happened is only stored if `gen` is still
+the one it started from, so a stale result never overwrites a newer
+invalidation. Snapshots also go stale after REPORT_SNAPSHOT_TTL_SECONDS
+because "expiring soon" depends on the clock. With a shared cache backend
+(api/cache.py, tag reports:<hospitalId>) a warm report is served from it
+without a database round trip; the in-process backend is skipped, since
+an invalidation in one worker wouldn't reach the others.
+"""
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings # type: ignore
+from pymongo import ReturnDocument # type: ignore
+from . import cache
+from .db import on_commit
+
+# Shared by all requests; each report submits its two pipelines here
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='reports')
+
+
+def _first(facet, field, default=0):
+    return facet[0][field] if facet else default
+
+
+def batch_metrics(db, hospital_id, now=None):
+    now = now or datetime.datetime.now()
+    next_week = (now + datetime.timedelta(days=7)).isoformat()
+    result = list(db.batches.aggregate([
+        {"$match": {"hospitalId": hospital_id}},
+        {"$facet": {
+            "collected": [
+                {"$group": {"_id": None, "total": {"$sum": "$units"}}}
+            ],
+            "expiringSoon": [
+                {"$match": {"units": {"$gt": 0}, "expiryDate": {"$gt": now.isoformat(), "$lt": next_week}}},
+                {"$count": "n"}
+            ]
+        }}
+    ]))
+    facets = result[0] if result else {}
+    return {
+        "total_units_collected": _first(facets.get('collected'), 'total'),
+        "batches_expiring_soon": _first(facets.get('expiringSoon'), 'n')
+    }
+
+
+def request_metrics(db, hospital_id):
+    result = list(db.requests.aggregate([
+        {"$match": {"acceptedBy": hospital_id}},
+        {"$facet": {
+            "dispatched": [
+                {"$match": {"status": "Completed"}},
+                {"$group": {"_id": None, "total": {"$sum": "$units"}}}
+            ],
+            "emergencyFulfilled": [
+                {"$match": {"type": "EMERGENCY_ALERT", "status": {"$in": ["Accepted", "Completed"]}}},
+                {"$count": "n"}
+            ]
+        }}
+    ]))
+    facets = result[0] if result else {}
+    return {
+        "total_units_dispatched": _first(facets.get('dispatched'), 'total'),
+        "emergency_requests_fulfilled": _first(facets.get('emergencyFulfilled'), 'n')
+    }
+
+
+def compute_report(db, hospital_id):
+    """Run the per-collection pipelines concurrently and merge them"""
+    batches = _executor.submit(batch_metrics, db, hospital_id)
+    requests = _executor.submit(request_metrics, db, hospital_id)
+    return {**batches.result(), **requests.result()}
+
+
+def _is_fresh(snapshot):
+    computed_at = snapshot.get('computedAt')
+    if not snapshot.get('data') or not computed_at:
+        return False
+    if computed_at.tzinfo is None:
+        computed_at = computed_at.replace(tzinfo=datetime.timezone.utc)
+    age = datetime.datetime.now(datetime.timezone.utc) - computed_at
+    return age.total_seconds() < settings.REPORT_SNAPSHOT_TTL_SECONDS
+
+
+def get_report(db, hospital_id):
+    """Cached report for a hospital (recomputed on a miss or after invalidation)"""
+    if not cache.is_shared():
+        # A per-process cache would keep serving a report other workers invalidated
+        return _snapshot_report(db, hospital_id)
+    return cache.get_or_set(
+        f"report:{hospital_id}", lambda: _snapshot_report(db, hospital_id), tags=(f"reports:{hospital_id}",)
+    )
+
+
+def _snapshot_report(db, hospital_id):
+    snapshot = db.report_snapshots.find_one({"_id": hospital_id})
+    if snapshot and _is_fresh(snapshot):
+        return snapshot['data']
+
+    if snapshot is None:
+        # Create the document first so invalidations during the compute are seen
+        snapshot = db.report_snapshots.find_one_and_update(
+            {"_id": hospital_id},
+            {"$setOnInsert": {"gen": 0}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    data = compute_report(db, hospital_id)
+    db.report_snapshots.update_one(
+        {"_id": hospital_id, "gen": snapshot.get('gen', 0)},
+        {"$set": {"data": data, "computedAt": datetime.datetime.now(datetime.timezone.utc)}}
+    )
+    return data
+
+
+def invalidate_reports(db, hospital_ids, session=None):
+    """
+    Drop cached reports for hospitals whose batches / requests changed.
+    get_report() creates the snapshot document before computing, so there
+    is nothing to do for hospitals without one.
+    """
+    hospital_ids = [h for h in set(hospital_ids) if h]
+    if hospital_ids:
+        # The cached copy goes once the change is committed (a report recomputed
+        # before that would be stored under the new tag version)
+        on_commit(session, lambda: cache.invalidate(*[f"reports:{h}" for h in hospital_ids]))
+        db.report_snapshots.update_many(
+            {"_id": {"$in": hospital_ids}},
+            {"$inc": {"gen": 1}, "$unset": {"data": ""}},
+            session=session
+        )
@@ -0,0 +1,117 @@
+"""
+Request state machine.
+
+Every status change of a request goes through transition(): one
+find_one_and_update whose filter carries the legal source statuses (and,
+where it matters, who may act), so two concurrent callers can't both win.
+Handlers only run side effects (holds, refunds, notifications, stock) when
+transition() returned a document; otherwise explain_failure() says why,
+at the cost of one read on the failure path only.
+
+    Active / Pending -> Accepted | Rejected | Cancelled | Expired | Completed
+    Accepted         -> Dispatched | Completed | Cancelled
+                        | Active / Pending (acceptance released: hold failed or expired)
+    Dispatched       -> Completed | Cancelled
+
+Completed, Cancelled, Rejected and Expired are terminal.
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from pymongo import ReturnDocument # type: ignore
+
+OPEN_STATUSES = ('Active', 'Pending')
+TERMINAL_STATUSES = ('Completed', 'Cancelled', 'Rejected', 'Expired')
+
+TRANSITIONS = {
+    'Active': ('Accepted', 'Rejected', 'Cancelled', 'Expired', 'Completed'),
+    'Pending': ('Accepted', 'Rejected', 'Cancelled', 'Expired', 'Completed'),
+    'Accepted': ('Dispatched', 'Completed', 'Cancelled', 'Active', 'Pending'),
+    'Dispatched': ('Completed', 'Cancelled'),
+    'Completed': (),
+    'Cancelled': (),
+    'Rejected': (),
+    'Expired': (),
+}
+
+STATUSES = tuple(TRANSITIONS)
+
+
+def sources_for(to_status):
+    """Statuses a request may move to `to_status` from"""
+    return [s for s, targets in TRANSITIONS.items() if to_status in targets]
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def transition(db, req_id, to_status, from_statuses=None, acceptor=None, unaccepted=False,
+               match=None, set_fields=None, unset_fields=None, session=None):
+    """
+    Move a request to `to_status` in one guarded update.
+
+    from_statuses: allowed current statuses (default: every legal source,
+                   narrowed further by the caller when needed)
+    acceptor:      the request must be unassigned or already assigned to
+                   this user (acceptedBy)
+    unaccepted:    the request must have no acceptedBy / acceptedDonorId
+    match:         extra filter conditions (e.g. ownership)
+
+    Returns the post-image with `previousStatus` (not stored) set to the
+    status it moved from, or None when the guard didn't match.
+    """
+    allowed = [s for s in (from_statuses or sources_for(to_status)) if to_status in TRANSITIONS.get(s, ())]
+    if not allowed or not ObjectId.is_valid(str(req_id)):
+        return None
+    query = {"_id": ObjectId(str(req_id)), "status": {"$in": allowed}}
+    conditions = []
+    if acceptor:
+        conditions.append({"$or": [{"acceptedBy": None}, {"acceptedBy": acceptor}]})
+    if unaccepted:
+        conditions.append({"acceptedBy": None})
+        conditions.append({"acceptedDonorId": None})
+    if match:
+        conditions.append(match)
+    if conditions:
+        query["$and"] = conditions
+
+    fields = {"status": to_status, "statusChangedAt": _now(), **(set_fields or {})}
+    update = {"$set": fields}
+    if unset_fields:
+        update["$unset"] = {f: "" for f in unset_fields}
+
+    before = db.requests.find_one_and_update(
+        query, update, return_document=ReturnDocument.BEFORE, session=session
+    )
+    if before is None:
+        return None
+    # The update is plain $set / $unset, so the post-image follows from the pre-image
+    after = {k: v for k, v in before.items() if k not in (unset_fields or ())}
+    after.update(fields)
+    after['previousStatus'] = before.get('status')
+    return after
+
+
+def explain_failure(db, req_id, to_status, acceptor=None, session=None):
+    """
+    (message, http_status, current document or None) for a transition that
+    didn't match. Only called on the failure path.
+    """
+    try:
+        req = db.requests.find_one({"_id": ObjectId(str(req_id))}, session=session)
+    except Exception:
+        return "Invalid request ID", 400, None
+    if not req:
+        return "Request not found", 404, None
+    current = req.get('status')
+    if current == 'Completed':
+        return "Cannot modify a completed request", 409, req
+    if to_status == 'Accepted' and current == 'Accepted':
+        if acceptor and req.get('acceptedBy') not in (None, acceptor):
+            return "Request already accepted by another user", 409, req
+        return "Request is already accepted.", 409, req
+    if acceptor and req.get('acceptedBy') not in (None, acceptor):
+        return "Request already accepted by another user", 409, req
+    if current == to_status:
+        return f"Request is already {current.lower()}", 409, req
+    return f"Cannot move a {current or 'new'} request to {to_status}", 409, req
@@ -0,0 +1,245 @@
+"""
+Stock reservation holds.
+
+Accepting a transfer reserves the units instead of consuming batches:
+a hold is moved out of the free `units` counter of an inventory document
+into `held`, and recorded on the same document:
+
+    {"hospitalId", "bloodGroup", "componentType", "units": 3, "held": 2,
+     "holds": [{"holdId", "requestId", "units": 2, "createdAt", "expiresAt"}]}
+
+Placing a hold is one guarded find_one_and_update (units >= n), so two
+concurrent acceptances can never both get the same units. The hold is
+converted into batch consumption on dispatch (or completion), released on
+cancel, and released automatically once it passes STOCK_HOLD_TTL_HOURS.
+Every step is logged to the inventory ledger (sources hold / release / dispatch).
+"""
+import datetime
+from bson import ObjectId # type: ignore
+from django.conf import settings # type: ignore
+from pymongo import ReturnDocument # type: ignore
+from .allocation import consume_batches
+from .db import run_in_transaction
+from .inventory import DEFAULT_COMPONENT, adjust_stock_many, units_by_component
+from .ledger import movement, record_movements
+from .request_states import transition
+
+
+class HoldUnavailable(Exception):
+    """Raised to abort the transaction of an acceptance whose stock couldn't be reserved"""
+
+    def __init__(self, request):
+        super().__init__(f"No stock to hold for request {request.get('_id')}")
+        self.request = request
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _take(db, hospital_id, blood_group, units, hold, session=None):
+    """
+    Move up to `units` from free stock into a hold on the fullest component
+    document. Returns (componentType, units taken) or None.
+    """
+    doc = db.inventory.find_one(
+        {"hospitalId": hospital_id, "bloodGroup": blood_group, "units": {"$gt": 0}},
+        {"units": 1},
+        sort=[("units", -1)],
+        session=session
+    )
+    if not doc:
+        return None
+    take = min(units, doc['units'])
+    updated = db.inventory.find_one_and_update(
+        {"_id": doc['_id'], "units": {"$gte": take}},
+        {"$inc": {"units": -take, "held": take}, "$push": {"holds": {**hold, "units": take}}},
+        projection={"componentType": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if not updated:
+        return None
+    record_movements(db, [movement(
+        hospital_id, blood_group, updated.get('componentType'), -take, take, source='hold', request_id=hold['requestId']
+    )], session=session)
+    return updated.get('componentType'), take
+
+
+def place_hold(db, hospital_id, blood_group, units, request_id, session=None):
+    """
+    Reserve `units` of a blood group at a hospital for a request.
+
+    The common case (one component document covers the request) is a single
+    guarded find_one_and_update. Otherwise the hold is split across component
+    documents, each draw guarded the same way; a partial hold is released
+    again. Returns the hold ({"holdId", "expiresAt", "lines"}) or None when
+    there isn't enough free stock.
+    """
+    hold = {
+        "holdId": str(ObjectId()),
+        "requestId": str(request_id),
+        "createdAt": _now(),
+        "expiresAt": _now() + datetime.timedelta(hours=settings.STOCK_HOLD_TTL_HOURS)
+    }
+
+    # Fast path: one guarded update on the first document that covers it all
+    updated = db.inventory.find_one_and_update(
+        {"hospitalId": hospital_id, "bloodGroup": blood_group, "units": {"$gte": units}},
+        {"$inc": {"units": -units, "held": units}, "$push": {"holds": {**hold, "units": units}}},
+        projection={"componentType": 1},
+        sort=[("units", -1)],
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if updated:
+        record_movements(db, [movement(
+            hospital_id, blood_group, updated.get('componentType'), -units, units, source='hold', request_id=request_id
+        )], session=session)
+        lines = [{"componentType": updated.get('componentType'), "units": units}]
+        return {"holdId": hold['holdId'], "expiresAt": hold['expiresAt'], "lines": lines}
+
+    # Split across components
+    lines = []
+    remaining = units
+    for _attempt in range(8):
+        if remaining <= 0:
+            break
+        taken = _take(db, hospital_id, blood_group, remaining, hold, session=session)
+        if not taken:
+            break
+        lines.append({"componentType": taken[0], "units": taken[1]})
+        remaining -= taken[1]
+
+    if remaining > 0:
+        release_holds(db, request_id, session=session)
+        return None
+    return {"holdId": hold['holdId'], "expiresAt": hold['expiresAt'], "lines": lines}
+
+
+def _settle(db, request_id, restock, session=None):
+    """
+    Remove every hold of a request. With `restock` the units go back to free
+    stock (release), otherwise they leave the hospital (conversion).
+    Each document is only updated while it still carries the hold, so
+    settling twice is a no-op. Returns the units settled per componentType.
+    """
+    settled = {}
+    entries = []
+    projection = {"holds": 1, "hospitalId": 1, "bloodGroup": 1, "componentType": 1}
+    for doc in db.inventory.find({"holds.requestId": str(request_id)}, projection, session=session):
+        for hold in doc.get('holds', []):
+            if hold.get('requestId') != str(request_id):
+                continue
+            inc = {"held": -hold['units']}
+            if restock:
+                inc["units"] = hold['units']
+            res = db.inventory.update_one(
+                {"_id": doc['_id'], "holds.holdId": hold['holdId']},
+                {"$inc": inc, "$pull": {"holds": {"holdId": hold['holdId']}}},
+                session=session
+            )
+            if res.modified_count:
+                component = doc.get('componentType') or DEFAULT_COMPONENT
+                settled[component] = settled.get(component, 0) + hold['units']
+                entries.append(movement(
+                    doc.get('hospitalId'), doc.get('bloodGroup'), component,
+                    inc.get('units', 0), -hold['units'],
+                    source='release' if restock else 'dispatch', request_id=request_id
+                ))
+    record_movements(db, entries, session=session)
+    return settled
+
+
+def release_holds(db, request_id, session=None):
+    """Return a request's held units to free stock (cancel / timeout). Returns units released."""
+    return sum(_settle(db, request_id, restock=True, session=session).values())
+
+
+def convert_holds(db, hospital_id, blood_group, request_id, session=None):
+    """
+    Turn a request's hold into consumption: drop the held units and draw the
+    same number of units from physical batches. If the allocator drew a
+    different component mix than was held, the per-component counters are
+    rebalanced (the total doesn't change).
+    Returns the consume_batches result ({"consumed": 0, ...} if nothing was held).
+    """
+    held = _settle(db, request_id, restock=False, session=session)
+    units = sum(held.values())
+    if not units:
+        return {"consumed": 0, "source_batches": []}
+
+    result = consume_batches(db, hospital_id, blood_group, units, session=session)
+    drawn = units_by_component(blood_group, result['source_batches'], units)
+    rebalance = {
+        (blood_group, component): held.get(component, 0) - drawn.get((blood_group, component), 0)
+        for component in set(held) | {c for _bg, c in drawn}
+    }
+    adjust_stock_many(db, hospital_id, rebalance, session=session, source='dispatch', request_id=request_id)
+    return result
+
+
+def list_holds(db, hospital_id):
+    """Active holds at a hospital, soonest expiry first"""
+    holds = []
+    for doc in db.inventory.find({"hospitalId": hospital_id, "holds.0": {"$exists": True}}):
+        for hold in doc.get('holds', []):
+            holds.append({
+                "holdId": hold.get('holdId'),
+                "requestId": hold.get('requestId'),
+                "bloodGroup": doc.get('bloodGroup'),
+                "componentType": doc.get('componentType'),
+                "units": hold.get('units', 0),
+                "createdAt": hold['createdAt'].isoformat() if hold.get('createdAt') else None,
+                "expiresAt": hold['expiresAt'].isoformat() if hold.get('expiresAt') else None
+            })
+    holds.sort(key=lambda h: h['expiresAt'] or '')
+    return holds
+
+
+def expire_holds(db, hospital_id=None):
+    """
+    Release holds past their expiry and put their requests back to Pending
+    so another hospital can accept them. Each request's transition, release
+    and outgoing-card update commit together, and only if the request was
+    still Accepted. Returns the released request ids.
+    """
+    now = _now()
+    query = {"holds.expiresAt": {"$lt": now}}
+    if hospital_id:
+        query["hospitalId"] = hospital_id
+
+    request_ids = set()
+    for doc in db.inventory.find(query, {"holds": 1}):
+        for hold in doc.get('holds', []):
+            expires_at = hold.get('expiresAt')
+            if expires_at and expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+            if expires_at and expires_at < now:
+                request_ids.add(hold['requestId'])
+
+    released = []
+    for request_id in request_ids:
+        def release(session, request_id=request_id):
+            # The request goes back to Pending first: if a dispatch (or cancel) got there
+            # before us, the transition doesn't match and its hold is left to that path
+            if transition(
+                db, request_id, 'Pending', from_statuses=['Accepted'],
+                set_fields={"holdExpiredAt": now.isoformat()}, unset_fields=['acceptedBy', 'acceptedAt'],
+                session=session
+            ) is None:
+                return False
+            release_holds(db, request_id, session=session) # (invalidates the holder's report via the ledger)
+            db.outgoing_batches.update_many(
+                {"type": "transfer", "dispatchDetails.requestId": request_id, "status": "Transferred"},
+                {"$set": {"status": "Released"}},
+                session=session
+            )
+            return True
+
+        try:
+            if run_in_transaction(release):
+                released.append(request_id)
+        except Exception as e:
+            print(f"Hold Expiry Error ({request_id}): {e}")
+    return sorted(released)
@@ -0,0 +1,122 @@
+"""
+Daily report rollups.
+
+One document per hospital, UTC day and blood group in `db.report_rollups`:
+
+    {"hospitalId", "day": "2026-10-19", "bloodGroup": "O+",
+     "collected": 4, "issued": 1, "transferredOut": 2,
+     "received": 0, "discarded": 0, "expired": 1}
+
+Counters are bumped from the inventory ledger (record_movements), so every
+write path that moves stock also updates its day in the same session.
+Time-series reports read at most one document per day and blood group,
+whatever the size of the underlying history.
+scripts/backfill_report_rollups.py rebuilds the collection.
+"""
+import datetime
+from pymongo import UpdateOne # type: ignore
+
+ROLLUP_FIELDS = ('collected', 'issued', 'transferredOut', 'received', 'discarded', 'expired')
+
+# ledger source -> (rollup counter, sign applied to the on-hand change)
+SOURCE_COUNTERS = {
+    'batch_intake': ('collected', 1),
+    'donation': ('collected', 1),
+    'use': ('issued', -1),
+    'transfer_out': ('transferredOut', -1),
+    'dispatch': ('transferredOut', -1),
+    'refund': ('transferredOut', -1),   # a refund reduces what went out
+    'transfer_in': ('received', 1),
+    'receive': ('received', 1),
+    'discard': ('discarded', -1),
+    'expiry': ('expired', -1),
+}
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def day_of(at):
+    """UTC day key for a datetime"""
+    if at.tzinfo is not None:
+        at = at.astimezone(datetime.timezone.utc)
+    return at.date().isoformat()
+
+
+def rollup_increments(entries):
+    """{(hospitalId, day, bloodGroup): {counter: n}} for a list of ledger entries"""
+    increments = {}
+    for entry in entries:
+        mapping = SOURCE_COUNTERS.get(entry.get('source'))
+        if not mapping:
+            continue
+        counter, sign = mapping
+        # On-hand change: free + held (a hold alone moves nothing out)
+        amount = sign * (entry.get('delta', 0) + entry.get('heldDelta', 0))
+        if not amount:
+            continue
+        key = (entry['hospitalId'], day_of(entry['at']), entry['bloodGroup'])
+        counters = increments.setdefault(key, {})
+        counters[counter] = counters.get(counter, 0) + amount
+    return increments
+
+
+def apply_increments(db, increments, session=None):
+    ops = [
+        UpdateOne(
+            {"hospitalId": hospital_id, "day": day, "bloodGroup": bg},
+            {"$inc": counters},
+            upsert=True
+        )
+        for (hospital_id, day, bg), counters in increments.items() if counters
+    ]
+    if ops:
+        db.report_rollups.bulk_write(ops, ordered=False, session=session)
+
+
+def record_rollups(db, entries, session=None):
+    """Fold ledger entries into the daily rollups (one bulk_write)"""
+    apply_increments(db, rollup_increments(entries), session=session)
+
+
+def _bucket(day, granularity):
+    """Start day of the bucket a day falls in"""
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday()) # ISO week, Monday start
+    return day
+
+
+def _next_bucket(start, granularity):
+    if granularity == 'month':
+        return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start + datetime.timedelta(days=7 if granularity == 'week' else 1)
+
+
+def timeseries(db, hospital_id, start, end, granularity='day', blood_group=None):
+    """
+    Counters per bucket between two dates (inclusive), zero-filled:
+        [{"period": "2026-10-13", "collected": .., ..., "byBloodGroup": {bg: {...}}}]
+    """
+    query = {"hospitalId": hospital_id, "day": {"$gte": start.isoformat(), "$lte": end.isoformat()}}
+    if blood_group:
+        query["bloodGroup"] = blood_group
+
+    buckets = {}
+    cursor = _bucket(start, granularity)
+    while cursor <= end:
+        buckets[cursor.isoformat()] = {
+            "period": cursor.isoformat(), **{f: 0 for f in ROLLUP_FIELDS}, "byBloodGroup": {}
+        }
+        cursor = _next_bucket(cursor, granularity)
+
+    for doc in db.report_rollups.find(query, {"_id": 0, "hospitalId": 0}):
+        period = _bucket(datetime.date.fromisoformat(doc['day']), granularity).isoformat()
+        bucket = buckets.get(period)
+        if bucket is None:
+            continue
+        per_group = bucket['byBloodGroup'].setdefault(doc['bloodGroup'], {f: 0 for f in ROLLUP_FIELDS})
+        for field in ROLLUP_FIELDS:
+            bucket[field] += doc.get(field, 0)
+            per_group[field] += doc.get(field, 0)
+    return list(buckets.values())
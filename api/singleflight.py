@@ -0,0 +1,112 @@
+"""
+Request coalescing ("single-flight") for identical expensive reads.
+
+During an emergency many staff and donors ask the same question at the
+same moment (same blood group, same cities). Within a process, the first
+caller for a key runs the computation and every identical call that
+arrives while it is in flight waits for that result instead of querying
+Mongo again:
+
+    sf = Group('hospital_search')
+    rows = sf.do(key(blood_group, units), lambda: expensive(...))
+
+Results are shared between callers, so treat them as read-only (copy
+before adding per-caller fields). If the computation raises, every
+waiter gets the same exception. Nothing is kept once the call finishes:
+this flattens spikes, it isn't a cache.
+
+stats() reports per group how many calls ran and how many were coalesced;
+SingleFlightStatsView exposes it.
+"""
+import threading
+
+
+def key(*parts, **params):
+    """
+    Normalized key: positional parts as given, keyword params sorted by
+    name, list values sorted (order of e.g. selected cities doesn't matter).
+    """
+    normalized = []
+    for name in sorted(params):
+        value = params[name]
+        if isinstance(value, (list, tuple, set)):
+            value = tuple(sorted(str(v) for v in value))
+        normalized.append((name, value))
+    return (tuple(parts), tuple(normalized))
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class Group:
+    """One namespace of coalesced calls (typically one per endpoint)"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.max_waiters = 0
+        _groups[name] = self
+
+    def do(self, call_key, fn):
+        with self._lock:
+            call = self._calls.get(call_key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+                leader = False
+            else:
+                call = self._calls[call_key] = _Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(call_key, None)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            calls = self.executed + self.coalesced
+            return {
+                "calls": calls,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "coalescingRatio": round(self.coalesced / calls, 4) if calls else 0.0,
+                "errors": self.errors,
+                "inFlight": len(self._calls),
+                "maxWaiters": self.max_waiters
+            }
+
+
+_groups = {}
+
+
+def stats():
+    """{group name: counters} for every group in this process"""
+    return {name: group.stats() for name, group in sorted(_groups.items())}
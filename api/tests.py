@@ -1,3 +1,1033 @@
-from django.test import TestCase
+import datetime
+import fnmatch
+import inspect
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import pymongo
+import jwt
+from bson import ObjectId
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from . import allocation
+from . import cache
+from . import db as db_module
+from . import singleflight
+from .allocation import consume_batches, plan_allocation
+from .batch_intake import intake_batches, parse_ndjson
+from .batch_issue import apply_bulk_action, plan_bulk_action
+from .appointments import transition_appointments
+from .audit import decode_cursor, issued_on, query_outgoing
+from .idempotency import REPLAYED_HEADER, idempotent
+from .inventory import adjust_stock
+from .notifications import (
+    broadcasts_for_user, close_broadcasts, create_broadcast, set_broadcast_state, unread_count, visible_broadcast
+)
+from .outbox import HANDLERS, claim, drain, notify_event, process, record_event
+from .request_states import explain_failure, sources_for, transition
+from .rollups import day_of, record_rollups, timeseries
+from .regional_stock import UNKNOWN_REGION, rebuild_regional_stock, refresh_hospital, stock_map
+from .reservations import convert_holds, expire_holds, place_hold, release_holds
+from .views import NotificationView
+
+try:
+    import mongomock
+except ImportError: # reported by MongoTestCase rather than skipping the database tests
+    mongomock = None
+
+
+def _allow_bulk_sort():
+    """
+    pymongo 4.9+ passes sort= to bulk operations, which mongomock 4.3 doesn't take.
+    Only patched for that pairing; a mongomock that accepts sort= is left alone.
+    """
+    from mongomock import collection
+    if pymongo.version_tuple < (4, 9):
+        return
+    for name in ('add_update', 'add_replace', 'add_delete'):
+        original = getattr(collection.BulkOperationBuilder, name)
+        if getattr(original, 'drops_sort', False) or 'sort' in inspect.signature(original).parameters:
+            continue
+
+        def wrapper(self, *args, _original=original, **kwargs):
+            kwargs.pop('sort', None)
+            return _original(self, *args, **kwargs)
+        wrapper.drops_sort = True
+        setattr(collection.BulkOperationBuilder, name, wrapper)
+
+
+class MongoTestCase(SimpleTestCase):
+    """Runs against a fresh in-memory database (mongomock: no transactions)"""
+
+    @classmethod
+    def setUpClass(cls):
+        if mongomock is None:
+            raise ImportError("mongomock is required for the database tests: pip install -r requirements-dev.txt")
+        super().setUpClass()
+        _allow_bulk_sort()
+
+    def setUp(self):
+        self.db = mongomock.MongoClient()['test']
+        for name, value in (('db', self.db), ('_transactions_supported', False)):
+            patcher = mock.patch.object(db_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache.configure(cache.LocalCache())
+        self.addCleanup(cache.configure, None)
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis.Redis calls RedisCache makes (bytes values, ex= TTLs)"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.data = {} # key -> (expires at or None, bytes)
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at <= self.now:
+            del self.data[key]
+            return None
+        return value
+
+    def mget(self, keys):
+        return [self._get(k) for k in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (self.now + ex if ex else None, value.encode('utf-8'))
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [k for k in list(self.data) if fnmatch.fnmatchcase(k, pattern)]
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def set(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def execute(self):
+        for args, kwargs in self.calls:
+            self.client.set(*args, **kwargs)
+        self.calls = []
+
+
+class RedisCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        cache.configure(cache.RedisCache(self.redis))
+        self.addCleanup(cache.configure, None)
+        self.computed = 0
+
+    def compute(self, value='v1'):
+        def fn():
+            self.computed += 1
+            return value
+        return fn
+
+    def test_get_or_set_computes_once(self):
+        self.assertEqual(cache.get_or_set('k', self.compute(), tags=('t',)), 'v1')
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('t',)), 'v1')
+        self.assertEqual(self.computed, 1)
+        self.assertIn('blood:k', self.redis.data)
+
+    def test_invalidate_makes_entry_stale(self):
+        cache.get_or_set('k', self.compute(), tags=('a', 'b'))
+        cache.invalidate('b')
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('a', 'b')), 'v2')
+        self.assertEqual(cache.get_or_set('k', self.compute('v3'), tags=('a', 'b')), 'v2')
+        self.assertEqual(self.computed, 2)
+
+    def test_invalidate_other_tag_keeps_entry(self):
+        cache.get_or_set('k', self.compute(), tags=('a',))
+        cache.invalidate('other')
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('a',)), 'v1')
+
+    def test_invalidation_during_compute_is_not_hidden(self):
+        def racing():
+            self.computed += 1
+            cache.invalidate('t') # a writer lands while we compute
+            return 'old'
+        self.assertEqual(cache.get_or_set('k', racing, tags=('t',)), 'old')
+        self.assertEqual(cache.get_or_set('k', self.compute('new'), tags=('t',)), 'new')
+
+    def test_entry_expires_after_ttl(self):
+        cache.get_or_set('k', self.compute(), tags=('t',), ttl=30)
+        self.redis.now += 29
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('t',), ttl=30), 'v1')
+        self.redis.now += 2
+        self.assertEqual(cache.get_or_set('k', self.compute('v3'), tags=('t',), ttl=30), 'v3')
+
+    def test_evicted_tag_version_is_a_miss(self):
+        cache.get_or_set('k', self.compute(), tags=('t',))
+        self.redis.delete('blood:tag:t')
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('t',)), 'v2')
+
+    def test_unreachable_cache_computes(self):
+        class Down:
+            shared = True
+
+            def get_many(self, keys):
+                raise ConnectionError('down')
+
+            def set_many(self, mapping, ttl=None):
+                raise ConnectionError('down')
+        cache.configure(Down())
+        self.assertEqual(cache.get_or_set('k', self.compute(), tags=('t',)), 'v1')
+        self.assertEqual(cache.get_or_set('k', self.compute('v2'), tags=('t',)), 'v2')
+        cache.invalidate('t') # logged, not raised
+
+    def test_clear_removes_prefixed_keys_only(self):
+        cache.get_or_set('k', self.compute(), tags=('t',))
+        self.redis.set('other:key', 'x')
+        cache.backend().clear()
+        self.assertEqual(list(self.redis.data), ['other:key'])
+
+    def test_is_shared(self):
+        self.assertTrue(cache.is_shared())
+        cache.configure(cache.LocalCache())
+        self.assertFalse(cache.is_shared())
+
+
+class LocalCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.local = cache.LocalCache(max_entries=2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.local.set_many({'a': '1', 'b': '2'})
+        self.local.get_many(['a'])
+        self.local.set_many({'c': '3'})
+        self.assertEqual(self.local.get_many(['a', 'b', 'c']), {'a': '1', 'c': '3'})
+
+    def test_entries_expire(self):
+        with mock.patch('api.cache.time.monotonic', return_value=100.0):
+            self.local.set_many({'a': '1'}, ttl=10)
+        with mock.patch('api.cache.time.monotonic', return_value=109.0):
+            self.assertEqual(self.local.get_many(['a']), {'a': '1'})
+        with mock.patch('api.cache.time.monotonic', return_value=111.0):
+            self.assertEqual(self.local.get_many(['a']), {})
+
+
+class CachedLookupTests(MongoTestCase):
+    def test_user_summaries_read_only_the_misses(self):
+        ann = self.db.users.insert_one({"name": "Ann", "location": "Pune"}).inserted_id
+        bob = self.db.users.insert_one({"name": "Bob", "location": "Agra"}).inserted_id
+        self.assertEqual(cache.user_summaries(self.db, [ann, 'bad-id'])[str(ann)]['name'], "Ann")
+
+        self.db.users.update_one({"_id": ann}, {"$set": {"name": "Ann B"}})
+        summaries = cache.user_summaries(self.db, [ann, bob])
+        self.assertEqual((summaries[str(ann)]['name'], summaries[str(bob)]['name']), ("Ann", "Bob"))
+
+        cache.invalidate_user(ann)
+        self.assertEqual(cache.user_summaries(self.db, [ann])[str(ann)]['name'], "Ann B")
+
+    def test_hospital_list_follows_invalidation(self):
+        self.db.users.insert_one({"role": "hospital", "name": "City"})
+        self.assertEqual(len(cache.hospital_list(self.db)), 1)
+        self.db.users.insert_one({"role": "hospital", "name": "General"})
+        self.assertEqual(len(cache.hospital_list(self.db)), 1)
+        cache.invalidate_user('new', 'hospital')
+        self.assertEqual(len(cache.hospital_list(self.db)), 2)
+
+class StockInvalidationTests(MongoTestCase):
+    def test_stock_movement_invalidates_its_blood_group(self):
+        adjust_stock(self.db, 'h1', 'O+', 5)
+        self.assertEqual(cache.get_or_set('search:O+', lambda: 5, tags=('stock:O+',)), 5)
+        self.assertEqual(cache.get_or_set('search:A+', lambda: 1, tags=('stock:A+',)), 1)
+        adjust_stock(self.db, 'h1', 'O+', -2)
+        self.assertEqual(cache.get_or_set('search:O+', lambda: 3, tags=('stock:O+',)), 3)
+        self.assertEqual(cache.get_or_set('search:A+', lambda: 0, tags=('stock:A+',)), 1)
+
+    def test_on_commit_waits_for_the_transaction(self):
+        session, ran = object(), []
+        db_module._commit_hooks[id(session)] = []
+        self.addCleanup(db_module._commit_hooks.pop, id(session), None)
+        db_module.on_commit(session, lambda: ran.append('hook'))
+        self.assertEqual(ran, [])
+        self.assertEqual(len(db_module._commit_hooks[id(session)]), 1)
+        db_module.on_commit(None, lambda: ran.append('now'))
+        self.assertEqual(ran, ['now'])
+
+class RequestStateTests(MongoTestCase):
+    def request(self, **fields):
+        return str(self.db.requests.insert_one({"status": "Active", **fields}).inserted_id)
+
+    def test_transition_returns_post_image(self):
+        req_id = self.request(units=2)
+        req = transition(self.db, req_id, 'Accepted', acceptor='h1', set_fields={"acceptedBy": 'h1'})
+        self.assertEqual((req['status'], req['previousStatus'], req['acceptedBy'], req['units']), ('Accepted', 'Active', 'h1', 2))
+        self.assertEqual(self.db.requests.find_one()['status'], 'Accepted')
+        self.assertNotIn('previousStatus', self.db.requests.find_one())
+
+    def test_only_one_acceptor_wins(self):
+        req_id = self.request()
+        self.assertIsNotNone(transition(self.db, req_id, 'Accepted', acceptor='h1', set_fields={"acceptedBy": 'h1'}))
+        self.assertIsNone(transition(self.db, req_id, 'Accepted', acceptor='h2', set_fields={"acceptedBy": 'h2'}))
+        self.assertEqual(explain_failure(self.db, req_id, 'Accepted', 'h2')[:2], ("Request already accepted by another user", 409))
+        self.assertEqual(explain_failure(self.db, req_id, 'Accepted', 'h1')[:2], ("Request is already accepted.", 409))
+        self.assertEqual(self.db.requests.find_one()['acceptedBy'], 'h1')
+
+    def test_illegal_transitions_are_refused(self):
+        req_id = self.request(status='Completed')
+        self.assertIsNone(transition(self.db, req_id, 'Cancelled'))
+        self.assertEqual(explain_failure(self.db, req_id, 'Cancelled')[:2], ("Cannot modify a completed request", 409))
+        req_id = self.request()
+        self.assertIsNone(transition(self.db, req_id, 'Dispatched'))
+        self.assertEqual(explain_failure(self.db, req_id, 'Dispatched')[:2], ("Cannot move a Active request to Dispatched", 409))
+
+    def test_from_statuses_narrows_the_sources(self):
+        req_id = self.request()
+        self.assertIsNone(transition(self.db, req_id, 'Cancelled', from_statuses=['Accepted']))
+        self.assertIsNotNone(transition(self.db, req_id, 'Cancelled', from_statuses=['Active']))
+        self.assertEqual(explain_failure(self.db, req_id, 'Cancelled')[:2], ("Request is already cancelled", 409))
+
+    def test_release_unsets_fields(self):
+        req_id = self.request(status='Accepted', acceptedBy='h1', acceptedAt='x')
+        req = transition(self.db, req_id, 'Pending', from_statuses=['Accepted'], unset_fields=['acceptedBy', 'acceptedAt'])
+        self.assertNotIn('acceptedBy', req)
+        self.assertNotIn('acceptedBy', self.db.requests.find_one())
+
+    def test_unaccepted_and_match_guards(self):
+        req_id = self.request(acceptedDonorId='d1', requesterId='h1')
+        self.assertIsNone(transition(self.db, req_id, 'Cancelled', unaccepted=True))
+        self.assertIsNone(transition(self.db, req_id, 'Cancelled', match={"requesterId": 'h2'}))
+        self.assertIsNotNone(transition(self.db, req_id, 'Cancelled', match={"requesterId": 'h1'}))
+
+    def test_unknown_requests(self):
+        self.assertIsNone(transition(self.db, 'nope', 'Accepted'))
+        self.assertEqual(explain_failure(self.db, 'nope', 'Accepted')[:2], ("Invalid request ID", 400))
+        self.assertEqual(explain_failure(self.db, str(ObjectId()), 'Accepted')[:2], ("Request not found", 404))
+
+    def test_sources_for(self):
+        self.assertEqual(sources_for('Dispatched'), ['Accepted'])
+        self.assertEqual(sources_for('Active'), ['Accepted'])
+        self.assertNotIn('Completed', sources_for('Cancelled'))
+
+
+class StockHoldTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.req_id = str(self.db.requests.insert_one({"status": "Accepted", "acceptedBy": 'h1'}).inserted_id)
+
+    def stock(self, component='Whole Blood', units=5):
+        self.db.inventory.insert_one({"hospitalId": 'h1', "bloodGroup": 'O+', "componentType": component, "units": units})
+
+    def counters(self):
+        return {
+            doc['componentType']: (doc['units'], doc.get('held', 0), len(doc.get('holds', [])))
+            for doc in self.db.inventory.find({"hospitalId": 'h1'})
+        }
+
+    def test_place_hold_moves_units_into_held(self):
+        self.stock(units=5)
+        hold = place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        self.assertEqual(hold['lines'], [{"componentType": 'Whole Blood', "units": 3}])
+        self.assertEqual(self.counters(), {'Whole Blood': (2, 3, 1)})
+
+    def test_place_hold_splits_across_components(self):
+        self.stock('Whole Blood', 2)
+        self.stock('Plasma', 2)
+        hold = place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        self.assertEqual(sum(line['units'] for line in hold['lines']), 3)
+        self.assertEqual(sum(units for units, _held, _n in self.counters().values()), 1)
+
+    def test_place_hold_without_enough_stock_holds_nothing(self):
+        self.stock('Whole Blood', 2)
+        self.stock('Plasma', 1)
+        self.assertIsNone(place_hold(self.db, 'h1', 'O+', 4, self.req_id))
+        self.assertEqual(self.counters(), {'Whole Blood': (2, 0, 0), 'Plasma': (1, 0, 0)})
+
+    def test_release_is_idempotent(self):
+        self.stock(units=5)
+        place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        self.assertEqual(release_holds(self.db, self.req_id), 3)
+        self.assertEqual(release_holds(self.db, self.req_id), 0)
+        self.assertEqual(self.counters(), {'Whole Blood': (5, 0, 0)})
+
+    def expire(self):
+        self.db.inventory.update_many({}, {"$set": {
+            "holds.0.expiresAt": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+        }})
+
+    def test_expired_hold_puts_request_back_to_pending(self):
+        self.stock(units=5)
+        place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        self.expire()
+        self.assertEqual(expire_holds(self.db), [self.req_id])
+        req = self.db.requests.find_one()
+        self.assertEqual(req['status'], 'Pending')
+        self.assertNotIn('acceptedBy', req)
+        self.assertEqual(self.counters(), {'Whole Blood': (5, 0, 0)})
+
+    def test_expiry_leaves_dispatched_requests_alone(self):
+        self.stock(units=5)
+        place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        self.db.requests.update_one({}, {"$set": {"status": "Dispatched"}})
+        self.expire()
+        self.assertEqual(expire_holds(self.db), [])
+        self.assertEqual(self.counters(), {'Whole Blood': (2, 3, 1)})
+
+    def test_convert_draws_batches(self):
+        self.stock(units=5)
+        expiry = (datetime.datetime.now() + datetime.timedelta(days=10)).isoformat()
+        batch_id = self.db.batches.insert_one({
+            "hospitalId": 'h1', "bloodGroup": 'O+', "componentType": 'Whole Blood', "status": 'Active',
+            "units": 5, "collectedDate": '2026-01-01', "expiryDate": expiry
+        }).inserted_id
+        place_hold(self.db, 'h1', 'O+', 3, self.req_id)
+        result = convert_holds(self.db, 'h1', 'O+', self.req_id)
+        self.assertEqual(result['consumed'], 3)
+        self.assertEqual(result['source_batches'][0]['batchId'], str(batch_id))
+        self.assertEqual(self.db.batches.find_one()['units'], 2)
+        self.assertEqual(self.counters(), {'Whole Blood': (2, 0, 0)})
+        self.assertEqual(convert_holds(self.db, 'h1', 'O+', self.req_id)['consumed'], 0)
+
+
+class BatchTestCase(MongoTestCase):
+    """Helpers for tests that draw from physical batches of O+ whole blood at hospital h1"""
+
+    def batch(self, units, days=10):
+        expiry = (datetime.datetime.now() + datetime.timedelta(days=days)).isoformat()
+        return str(self.db.batches.insert_one({
+            "hospitalId": 'h1', "bloodGroup": 'O+', "componentType": 'Whole Blood', "status": 'Active',
+            "units": units, "collectedDate": '2026-01-01', "expiryDate": expiry
+        }).inserted_id)
+
+    def units(self):
+        return {str(b['_id']): (b['units'], b['status']) for b in self.db.batches.find()}
+
+
+class ConsumeBatchesTests(BatchTestCase):
+    def drain_after_planning(self, batch_id):
+        """Let another writer empty `batch_id` between planning and the bulk_write (once)"""
+        drained = []
+
+        def plan(*args, **kwargs):
+            result = plan_allocation(*args, **kwargs)
+            if not drained:
+                self.db.batches.update_one({"_id": ObjectId(batch_id)}, {"$set": {"units": 0}})
+                drained.append(batch_id)
+            return result
+        patcher = mock.patch.object(allocation, 'plan_allocation', side_effect=plan)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_draws_first_expiry_first_and_depletes(self):
+        late = self.batch(5, days=20)
+        soon = self.batch(2, days=5)
+        result = consume_batches(self.db, 'h1', 'O+', 3)
+        self.assertEqual(result['consumed'], 3)
+        self.assertEqual([(s['batchId'], s['unitsUsed']) for s in result['source_batches']], [(soon, 2), (late, 1)])
+        self.assertEqual(self.units(), {soon: (0, 'Depleted'), late: (4, 'Active')})
+
+    def test_batch_drained_after_planning_is_not_consumed(self):
+        only = self.batch(3)
+        self.drain_after_planning(only)
+        result = consume_batches(self.db, 'h1', 'O+', 2)
+        self.assertEqual((result['consumed'], result['source_batches']), (0, []))
+        self.assertEqual(self.units(), {only: (0, 'Active')})
+
+    def test_refused_draw_is_replanned_from_other_batches(self):
+        soon = self.batch(2, days=5)
+        late = self.batch(5, days=20)
+        self.drain_after_planning(soon)
+        result = consume_batches(self.db, 'h1', 'O+', 3)
+        self.assertEqual(result['consumed'], 3)
+        self.assertEqual([(s['batchId'], s['unitsUsed']) for s in result['source_batches']], [(late, 3)])
+        self.assertEqual(self.units()[late], (2, 'Active'))
+
+    def test_failed_verification_is_raised(self):
+        soon = self.batch(2, days=5)
+        self.batch(5, days=20)
+        self.drain_after_planning(soon)
+        with mock.patch.object(type(self.db.batches), 'distinct', side_effect=RuntimeError('lost')):
+            with self.assertRaises(RuntimeError):
+                consume_batches(self.db, 'h1', 'O+', 3)
+
+    def test_write_errors_are_raised(self):
+        self.batch(5)
+        with mock.patch.object(type(self.db.batches), 'bulk_write', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                consume_batches(self.db, 'h1', 'O+', 2)
+        self.assertEqual(list(self.units().values()), [(5, 'Active')])
+
+    def test_dry_run_writes_nothing(self):
+        self.batch(5)
+        plan = consume_batches(self.db, 'h1', 'O+', 7, dry_run=True)
+        self.assertEqual((plan['allocated'], plan['shortfall']), (5, 2))
+        self.assertEqual(list(self.units().values()), [(5, 'Active')])
+
+
+class BulkIssueTests(BatchTestCase):
+    def stock(self, units):
+        self.db.inventory.insert_one({"hospitalId": 'h1', "bloodGroup": 'O+', "componentType": 'Whole Blood', "units": units})
+
+    def test_invalid_line_blocks_the_whole_request(self):
+        batch_id = self.batch(2)
+        draws, errors, _warnings = plan_bulk_action(self.db, 'h1', 'use_unit', [
+            {"batchId": batch_id, "quantity": 1},
+            {"batchId": batch_id, "quantity": 2}
+        ])
+        self.assertEqual(draws, [])
+        self.assertEqual(errors, [{"line": 1, "error": "Insufficient units. Requested: 2, Available: 1"}])
+
+    def test_explicit_and_auto_lines_share_stock(self):
+        explicit = self.batch(2, days=20)
+        soon = self.batch(3, days=5)
+        self.stock(5)
+        draws, errors, _warnings = plan_bulk_action(self.db, 'h1', 'use_unit', [
+            {"batchId": explicit, "quantity": 1},
+            {"bloodGroup": 'O+', "quantity": 4}
+        ])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted((d['batchId'], d['units']) for d in draws), sorted([(explicit, 1), (soon, 3), (explicit, 1)]))
+
+        applied, failed, outgoing = apply_bulk_action(self.db, 'h1', 'use_unit', draws, {"patientId": 'p1'})
+        self.assertEqual((len(applied), failed), (3, []))
+        self.assertEqual(self.units(), {explicit: (0, 'Depleted'), soon: (0, 'Depleted')})
+        self.assertEqual(self.db.inventory.find_one()['units'], 0)
+        self.assertEqual((outgoing['quantity'], outgoing['patientId']), (5, 'p1'))
+        self.assertEqual({s['batchId']: s['unitsUsed'] for s in outgoing['sourceBatchIds']}, {explicit: 2, soon: 3})
+
+    def test_draw_that_lost_its_guard_is_reported(self):
+        first = self.batch(2)
+        second = self.batch(2)
+        self.stock(4)
+        draws, _errors, _warnings = plan_bulk_action(self.db, 'h1', 'discard_unit', [
+            {"batchId": first, "quantity": 2}, {"batchId": second, "quantity": 2}
+        ])
+        self.db.batches.update_one({"_id": ObjectId(first)}, {"$set": {"units": 1}})
+        applied, failed, outgoing = apply_bulk_action(self.db, 'h1', 'discard_unit', draws, {})
+        self.assertEqual(([d['batchId'] for d in applied], [d['batchId'] for d in failed]), ([second], [first]))
+        self.assertEqual(self.units()[second], (0, 'Discarded'))
+        self.assertEqual((self.db.inventory.find_one()['units'], outgoing['quantity']), (2, 2))
+
+    def test_allocation_ids_are_capped(self):
+        batch_id = self.batch(allocation.ALLOCATION_IDS_KEPT + 5)
+        self.stock(allocation.ALLOCATION_IDS_KEPT + 5)
+        for _ in range(allocation.ALLOCATION_IDS_KEPT + 2):
+            draws, _errors, _warnings = plan_bulk_action(self.db, 'h1', 'use_unit', [{"batchId": batch_id, "quantity": 1}])
+            apply_bulk_action(self.db, 'h1', 'use_unit', draws, {})
+        self.assertEqual(len(self.db.batches.find_one()['allocationIds']), allocation.ALLOCATION_IDS_KEPT)
+
+
+class BatchIntakeTests(MongoTestCase):
+    def counters(self):
+        return {(d['hospitalId'], d['bloodGroup'], d['componentType']): d['units'] for d in self.db.inventory.find()}
+
+    def test_invalid_rows_do_not_block_the_rest(self):
+        rows = parse_ndjson([
+            b'{"bloodGroup": "O+", "units": 2}',
+            b'',
+            b'not json',
+            b'{"bloodGroup": "XX", "units": 1}',
+            b'{"bloodGroup": "O+", "units": 3, "componentType": "Plasma"}',
+            b'{"bloodGroup": "O+", "units": 1, "hospitalId": "h2"}'
+        ])
+        result = intake_batches(self.db, rows, hospital_id='h1')
+        self.assertEqual((result['inserted'], result['units']), (2, 5))
+        self.assertEqual([e['row'] for e in result['errors']], [1, 2, 4])
+        self.assertEqual([i['row'] for i in result['ids']], [0, 3])
+        self.assertEqual(self.counters(), {('h1', 'O+', 'Whole Blood'): 2, ('h1', 'O+', 'Plasma'): 3})
+
+    def test_rows_the_database_rejects_are_not_counted(self):
+        self.db.batches.create_index('batchNumber', unique=True)
+        self.db.batches.insert_one({"batchNumber": 'B2'})
+        rows = [(row, None) for row in (
+            {"bloodGroup": 'A+', "units": 2, "batchNumber": 'B1'},
+            {"bloodGroup": 'A+', "units": 4, "batchNumber": 'B2'},
+            {"bloodGroup": 'A+', "units": 1, "batchNumber": 'B3'}
+        )]
+        result = intake_batches(self.db, rows, hospital_id='h1')
+        self.assertEqual((result['inserted'], result['units']), (2, 3))
+        self.assertEqual([e['row'] for e in result['errors']], [1])
+        self.assertEqual([i['row'] for i in result['ids']], [0, 2])
+        self.assertEqual(self.counters(), {('h1', 'A+', 'Whole Blood'): 3})
+
+
+class AppointmentTransitionTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hospital_id = str(self.db.users.insert_one({"name": 'City Hospital', "role": 'hospital'}).inserted_id)
+        self.donor_id = str(self.db.users.insert_one({"name": 'Asha', "bloodGroup": 'B+', "totalDonations": 1}).inserted_id)
+
+    def appointment(self, **fields):
+        return str(self.db.appointments.insert_one({"hospitalId": self.hospital_id, "status": 'Scheduled', **fields}).inserted_id)
+
+    def test_completing_a_session_records_every_donation(self):
+        ids = [
+            self.appointment(donorId=self.donor_id),
+            self.appointment(donorId=self.donor_id, type='Emergency', units=2),
+            self.appointment(bloodGroup='O-') # walk-in
+        ]
+        result = transition_appointments(self.db, self.hospital_id, ids, 'Completed')
+        self.assertEqual((sorted(result['updated']), result['errors']), (sorted(ids), []))
+        self.assertEqual((result['batches'], result['units']), (3, 4))
+        self.assertEqual(
+            {(d['bloodGroup'], d['units']) for d in self.db.inventory.find()},
+            {('B+', 3), ('O-', 1)}
+        )
+        donor = self.db.users.find_one({"_id": ObjectId(self.donor_id)})
+        self.assertEqual((donor['totalDonations'], donor['lastDonationType']), (3, 'Hospital Request'))
+        self.assertIsNotNone(donor['nextEligibleDate'])
+
+    def test_completed_foreign_and_invalid_ids_are_reported(self):
+        done = self.appointment(status='Completed')
+        foreign = str(self.db.appointments.insert_one({"hospitalId": 'other', "status": 'Scheduled'}).inserted_id)
+        legacy = str(self.db.appointments.insert_one({"center": 'City Hospital', "status": 'Scheduled'}).inserted_id)
+        result = transition_appointments(self.db, self.hospital_id, [done, foreign, legacy, 'bad'], 'Rejected', reason='Low Hb')
+        self.assertEqual(result['updated'], [legacy])
+        self.assertEqual({e['id']: e['error'] for e in result['errors']}, {
+            'bad': "Invalid appointment ID",
+            done: "Cannot modify a completed appointment",
+            foreign: "Appointment not found"
+        })
+        self.assertEqual(self.db.appointments.find_one({"_id": ObjectId(legacy)})['rejectionReason'], 'Low Hb')
+        self.assertEqual(self.db.appointments.find_one({"_id": ObjectId(foreign)})['status'], 'Scheduled')
+        self.assertEqual((result['batches'], self.db.batches.count_documents({})), (0, 0))
+
+
+class RollupTests(MongoTestCase):
+    def entry(self, day, source, delta, bg='O+', held=0):
+        at = datetime.datetime.fromisoformat(day).replace(hour=12, tzinfo=datetime.timezone.utc)
+        return {"hospitalId": 'h1', "bloodGroup": bg, "source": source, "delta": delta, "heldDelta": held, "at": at}
+
+    def test_ledger_entries_fold_into_daily_counters(self):
+        record_rollups(self.db, [
+            self.entry('2026-10-05', 'donation', 2),
+            self.entry('2026-10-05', 'batch_intake', 3),
+            self.entry('2026-10-05', 'dispatch', 0, held=-2), # held units leaving
+            self.entry('2026-10-05', 'refund', 1),
+            self.entry('2026-10-05', 'hold', -2, held=2), # moves nothing out
+            self.entry('2026-10-05', 'use', -1, bg='A+')
+        ])
+        rows = {d['bloodGroup']: d for d in self.db.report_rollups.find({}, {"_id": 0, "hospitalId": 0, "day": 0})}
+        self.assertEqual(rows, {
+            'O+': {"bloodGroup": 'O+', "collected": 5, "transferredOut": 1},
+            'A+': {"bloodGroup": 'A+', "issued": 1}
+        })
+
+    def test_day_is_taken_in_utc(self):
+        late = datetime.datetime(2026, 10, 5, 23, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-5)))
+        self.assertEqual(day_of(late), '2026-10-06')
+
+    def test_buckets_are_zero_filled_and_grouped(self):
+        record_rollups(self.db, [
+            self.entry('2026-09-30', 'donation', 1), # before the range
+            self.entry('2026-10-05', 'donation', 2), # Monday
+            self.entry('2026-10-11', 'use', -1, bg='A+'), # Sunday, same ISO week
+            self.entry('2026-10-20', 'discard', -3)
+        ])
+        start, end = datetime.date(2026, 10, 1), datetime.date(2026, 10, 21)
+
+        days = timeseries(self.db, 'h1', start, end)
+        self.assertEqual(len(days), 21)
+        self.assertEqual(days[4]['collected'], 2)
+        self.assertEqual(sum(d['collected'] for d in days), 2)
+
+        weeks = timeseries(self.db, 'h1', start, end, granularity='week')
+        self.assertEqual([w['period'] for w in weeks], ['2026-09-28', '2026-10-05', '2026-10-12', '2026-10-19'])
+        self.assertEqual([(w['collected'], w['issued'], w['discarded']) for w in weeks], [(0, 0, 0), (2, 1, 0), (0, 0, 0), (0, 0, 3)])
+        self.assertEqual(sorted(weeks[1]['byBloodGroup']), ['A+', 'O+'])
+
+        months = timeseries(self.db, 'h1', datetime.date(2026, 9, 15), end, granularity='month', blood_group='O+')
+        self.assertEqual([(m['period'], m['collected'], m['issued']) for m in months], [('2026-09-01', 1, 0), ('2026-10-01', 2, 0)])
+
+    def test_stock_changes_reach_the_rollups(self):
+        adjust_stock(self.db, 'h1', 'O+', 4, source='donation')
+        today = day_of(datetime.datetime.now(datetime.timezone.utc))
+        self.assertEqual(self.db.report_rollups.find_one({"day": today})['collected'], 4)
+
+
+class RegionalStockTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.h1 = str(self.db.users.insert_one({"name": 'City Hospital', "location": 'Pune'}).inserted_id)
+        self.h2 = str(self.db.users.insert_one({"name": 'Ruby Hall', "location": ' Pune '}).inserted_id)
+
+    def regions(self):
+        return {
+            doc['_id']: ({bg: n for bg, n in doc['groups'].items() if n}, sorted(doc.get('hospitals', {})))
+            for doc in self.db.regional_stock.find()
+        }
+
+    def test_movements_follow_free_stock(self):
+        adjust_stock(self.db, self.h1, 'O+', 5)
+        adjust_stock(self.db, self.h2, 'O+', 2)
+        adjust_stock(self.db, self.h2, 'A-', 1)
+        adjust_stock(self.db, 'not-a-user', 'B+', 4)
+        req_id = str(self.db.requests.insert_one({"status": "Accepted"}).inserted_id)
+        place_hold(self.db, self.h1, 'O+', 3, req_id) # held units are not free
+        self.assertEqual(self.regions(), {
+            'Pune': ({'O+': 4, 'A-': 1}, sorted([self.h1, self.h2])),
+            UNKNOWN_REGION: ({'B+': 4}, ['not-a-user'])
+        })
+        pune = stock_map(self.db, ['O+', 'A-'], region='Pune')
+        self.assertEqual((pune['total'], [h['name'] for h in pune['hospitals']]), (5, ['Ruby Hall', 'City Hospital']))
+
+    def test_refresh_moves_a_hospital_between_regions(self):
+        adjust_stock(self.db, self.h1, 'O+', 5)
+        adjust_stock(self.db, self.h2, 'O+', 2)
+        self.db.users.update_one({"_id": ObjectId(self.h1)}, {"$set": {"location": 'Mumbai', "name": 'City General'}})
+        refresh_hospital(self.db, self.h1)
+        self.assertEqual(self.regions(), {'Pune': ({'O+': 2}, [self.h2]), 'Mumbai': ({'O+': 5}, [self.h1])})
+        self.assertEqual(self.db.regional_stock.find_one({"_id": 'Mumbai'})['hospitals'][self.h1]['name'], 'City General')
+
+        self.db.users.delete_one({"_id": ObjectId(self.h1)})
+        refresh_hospital(self.db, self.h1)
+        self.assertEqual(self.regions(), {'Pune': ({'O+': 2}, [self.h2]), 'Mumbai': ({}, [])})
+
+    def test_rebuild_matches_incremental_updates(self):
+        adjust_stock(self.db, self.h1, 'O+', 5)
+        adjust_stock(self.db, self.h1, 'O+', -2)
+        adjust_stock(self.db, self.h2, 'AB+', 3)
+        incremental = self.regions()
+        self.db.regional_stock.update_one({"_id": 'Pune'}, {"$inc": {"groups.O+": 40}}) # drift
+        self.assertEqual(rebuild_regional_stock(self.db), 1)
+        self.assertEqual(self.regions(), incremental)
+
+
+@override_settings(OUTBOX_WORKERS=0)
+class BroadcastTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.donor_id = self.user(location='Pune')
+        self.requester_id = self.user(role='hospital')
+        self.req_id = str(self.db.requests.insert_one({"status": "Active", "requesterId": self.requester_id}).inserted_id)
+
+    def user(self, role='donor', blood_group='O+', location=None, created_at='2026-10-01T00:00:00'):
+        return str(self.db.users.insert_one({
+            "role": role, "bloodGroup": blood_group, "location": location, "createdAt": created_at
+        }).inserted_id)
+
+    def broadcast(self, blood_group='O+', cities=None, created_at=None):
+        b_id = create_broadcast(self.db, 'EMERGENCY_ALERT', 'Need O+', 'Urgent', self.req_id, {
+            "role": 'donor', "bloodGroup": blood_group, "cities": cities
+        })
+        if created_at:
+            self.db.broadcasts.update_one({"_id": b_id}, {"$set": {"createdAt": created_at}})
+        return str(b_id)
+
+    def shown(self, user_id=None):
+        return {item['id'].split(':')[0]: item['status'] for item in broadcasts_for_user(self.db, user_id or self.donor_id)}
+
+    def test_audience_matches_group_city_and_registration(self):
+        anywhere = self.broadcast()
+        pune = self.broadcast(cities=['Pune'])
+        self.broadcast(cities=['Agra'])
+        self.broadcast(blood_group='A+')
+        self.broadcast(created_at='2026-09-01T00:00:00') # before the donor registered
+        self.assertEqual(self.shown(), {anywhere: 'UNREAD', pune: 'UNREAD'})
+        legacy_donor = str(self.db.users.insert_one({"role": 'donor', "bloodGroup": 'O+'}).inserted_id)
+        self.assertEqual(len(self.shown(legacy_donor)), 2) # no createdAt: sees older alerts too
+
+    def test_states_drive_the_list_and_the_badge(self):
+        read = self.broadcast()
+        dismissed = self.broadcast()
+        self.broadcast()
+        self.assertEqual(unread_count(self.db, self.donor_id), 3)
+        set_broadcast_state(self.db, self.donor_id, read, 'READ')
+        set_broadcast_state(self.db, self.donor_id, dismissed, 'DISMISSED')
+        self.assertEqual(unread_count(self.db, self.donor_id), 1)
+        self.assertNotIn(dismissed, self.shown())
+        self.assertEqual(self.shown()[read], 'READ')
+
+    def test_accepted_broadcast_outlives_closing(self):
+        b_id = self.broadcast()
+        set_broadcast_state(self.db, self.donor_id, b_id, 'ACCEPTED')
+        close_broadcasts(self.db, self.req_id)
+        donor = self.db.users.find_one({"_id": ObjectId(self.donor_id)})
+        other = self.db.users.find_one({"_id": ObjectId(self.user())})
+        self.assertEqual(self.shown(), {b_id: 'ACCEPTED'})
+        self.assertIsNotNone(visible_broadcast(self.db, donor, b_id))
+        self.assertIsNone(visible_broadcast(self.db, other, b_id))
+        self.assertIsNone(visible_broadcast(self.db, donor, 'bad'))
+
+    def put(self, item_id, state, user_id=None):
+        headers = {}
+        if user_id:
+            token = jwt.encode({"id": user_id, "role": 'donor'}, settings.SECRET_KEY, algorithm='HS256')
+            headers["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        request = APIRequestFactory().put('/api/notifications/', {"id": item_id, "status": state}, format='json', **headers)
+        return NotificationView.as_view()(request)
+
+    def test_state_changes_are_authorized_by_the_token(self):
+        b_id = self.broadcast(cities=['Pune'])
+        outsider = self.user(location='Agra')
+        item_id = f"{b_id}:{self.donor_id}"
+        self.assertEqual(self.put(item_id, 'READ').status_code, 401)
+        self.assertEqual(self.put(item_id, 'READ', user_id=outsider).status_code, 403)
+        self.assertEqual(self.put(f"{b_id}:{outsider}", 'ACCEPTED', user_id=outsider).status_code, 404)
+        self.assertEqual(self.db.requests.find_one()['status'], 'Active')
+
+        self.assertEqual(self.put(item_id, 'ACCEPTED', user_id=self.donor_id).status_code, 200)
+        req = self.db.requests.find_one()
+        self.assertEqual((req['status'], req['acceptedBy']), ('Accepted', self.donor_id))
+        self.assertEqual(self.db.broadcasts.find_one()['status'], 'CLOSED')
+        self.assertEqual(self.db.outbox.find_one()['type'], 'notify')
+
+
+class CountingView(APIView):
+    authentication_classes = []
+    permission_classes = []
+    calls = 0
+    status_code = 201
+    nested = None
+
+    @idempotent
+    def post(self, request):
+        type(self).calls += 1
+        if self.nested:
+            return self.nested()
+        return Response({"call": self.calls, "echo": request.data}, status=self.status_code)
+
+
+class IdempotencyKeyTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = APIRequestFactory()
+        self.view = type('View', (CountingView,), {})
+
+    def post(self, data=None, key='k1', auth='Bearer a'):
+        headers = {"HTTP_AUTHORIZATION": auth}
+        if key:
+            headers["HTTP_IDEMPOTENCY_KEY"] = key
+        request = self.factory.post('/api/things/', data or {"units": 2}, format='json', **headers)
+        return self.view.as_view()(request)
+
+    def test_without_key_every_call_runs(self):
+        self.post(key=None)
+        self.post(key=None)
+        self.assertEqual(self.view.calls, 2)
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post()
+        second = self.post()
+        self.assertEqual(self.view.calls, 1)
+        self.assertEqual((second.status_code, second.data), (201, first.data))
+        self.assertEqual(second[REPLAYED_HEADER], 'true')
+        self.assertFalse(first.has_header(REPLAYED_HEADER))
+
+    def test_key_is_scoped_to_the_caller(self):
+        self.post(auth='Bearer a')
+        self.post(auth='Bearer b')
+        self.assertEqual(self.view.calls, 2)
+
+    def test_reuse_with_a_different_body_is_refused(self):
+        self.post({"units": 2})
+        self.assertEqual(self.post({"units": 3}).status_code, 422)
+        self.assertEqual(self.view.calls, 1)
+
+    def test_concurrent_retry_gets_409(self):
+        self.view.nested = staticmethod(lambda: self.post())
+        response = self.post()
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.view.calls, 1)
+
+    def test_server_error_releases_the_key(self):
+        self.view.status_code = 500
+        self.post()
+        self.view.status_code = 201
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.view.calls, 2)
+        self.assertEqual(self.post().data['call'], 2)
+
+    def test_overlong_key(self):
+        self.assertEqual(self.post(key='k' * 300).status_code, 400)
+        self.assertEqual(self.view.calls, 0)
+
+
+@override_settings(OUTBOX_WORKERS=0, OUTBOX_MAX_ATTEMPTS=3)
+class OutboxTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.outbox.send_push_multicast')
+        self.push = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def redeliver(self):
+        """Put every event back in the queue, as after a worker died mid-way"""
+        self.db.outbox.update_many({}, {
+            "$set": {"status": "pending", "availableAt": datetime.datetime.now(datetime.timezone.utc)},
+            "$unset": {"lockedUntil": ""}
+        })
+        return drain(self.db)
+
+    def test_redelivered_notification_is_applied_once(self):
+        user_id = str(self.db.users.insert_one({"name": "Ann", "fcmToken": "t1"}).inserted_id)
+        actor_id = str(self.db.users.insert_one({"name": "City Hospital"}).inserted_id)
+        record_event(self.db, *notify_event(
+            user_id, "REQUEST_ACCEPTED", "Accepted", "{actor} accepted", actor_id=actor_id,
+            push={"title": "Accepted", "body": "{actor} accepted"}
+        ))
+        self.assertEqual(drain(self.db), (1, 0))
+        self.assertEqual(self.redeliver(), (1, 0))
+
+        notifications = list(self.db.notifications.find())
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0]['message'], "City Hospital accepted")
+        self.assertEqual(self.db.notification_counters.find_one({"_id": user_id})['unread'], 1)
+        self.push.assert_called_once_with(['t1'], "Accepted", "City Hospital accepted", None)
+
+    def test_redelivered_completion_receives_stock_once(self):
+        req_id = str(self.db.requests.insert_one({
+            "type": "StockTransfer", "status": "Completed", "requesterId": 'h2', "acceptedBy": 'h1',
+            "bloodGroup": 'O+', "units": 3
+        }).inserted_id)
+        record_event(self.db, "request_completed", {"requestId": req_id})
+        drain(self.db)
+        self.redeliver()
+        self.assertEqual(self.db.batches.count_documents({"hospitalId": 'h2'}), 1)
+        self.assertEqual(self.db.inventory.find_one({"hospitalId": 'h2'})['units'], 3)
+
+    def test_failures_back_off_then_give_up(self):
+        record_event(self.db, "no_such_type", {})
+        self.assertEqual(drain(self.db), (0, 1))
+        event = self.db.outbox.find_one()
+        self.assertEqual((event['status'], event['attempts']), ('pending', 1))
+        self.assertGreater(event['availableAt'], event['createdAt'])
+        self.assertEqual(drain(self.db), (0, 0)) # not due yet
+
+        self.redeliver()
+        self.redeliver()
+        self.assertEqual(self.db.outbox.find_one()['status'], 'failed')
+
+    def test_stale_worker_cannot_overwrite_the_new_lease(self):
+        with mock.patch.dict(HANDLERS, {"noop": lambda db, event_id, payload: None}):
+            record_event(self.db, "noop", {})
+            event = claim(self.db)
+            # Our lease runs out and another worker re-claims the event
+            later = event['lockedUntil'] + datetime.timedelta(seconds=30)
+            self.db.outbox.update_one({"_id": event['_id']}, {"$set": {"lockedUntil": later}})
+            process(self.db, event)
+        stored = self.db.outbox.find_one()
+        self.assertEqual(stored['status'], 'processing')
+        self.assertNotIn('processedAt', stored)
+
+
+class AuditCursorTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        base = issued_on('2026-03-01T08:00:00')
+        # Three rows share each timestamp, so pages split inside a tie
+        self.db.outgoing_batches.insert_many([
+            {"hospitalId": 'h1', "type": 'transfer' if i % 2 else 'patient_usage',
+             "issuedOn": base + datetime.timedelta(hours=i // 3)}
+            for i in range(10)
+        ])
+
+    def pages(self, limit, **filters):
+        rows, cursor, pages = [], None, 0
+        while True:
+            page, cursor = query_outgoing(self.db, 'h1', filters, cursor=cursor, limit=limit)
+            rows += page
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        rows, pages = self.pages(3)
+        self.assertEqual(pages, 4)
+        self.assertEqual(len({r['_id'] for r in rows}), 10)
+        keys = [(r['issuedOn'], r['_id']) for r in rows]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_exact_last_page_has_no_cursor(self):
+        rows, pages = self.pages(5)
+        self.assertEqual((len(rows), pages), (10, 2))
+
+    def test_cursor_keeps_filters(self):
+        rows, _pages = self.pages(2, type='transfer')
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(r['type'] == 'transfer' for r in rows))
+
+    def test_new_rows_do_not_shift_later_pages(self):
+        first, cursor = query_outgoing(self.db, 'h1', {}, limit=4)
+        self.db.outgoing_batches.insert_one({"hospitalId": 'h1', "issuedOn": issued_on()})
+        second, _cursor = query_outgoing(self.db, 'h1', {}, cursor=cursor, limit=4)
+        self.assertFalse({r['_id'] for r in first} & {r['_id'] for r in second})
+        self.assertLess((second[0]['issuedOn'], second[0]['_id']), (first[-1]['issuedOn'], first[-1]['_id']))
+
+    def test_malformed_cursor(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.group = singleflight.Group('test')
+        self.release = threading.Event()
+        self.runs = 0
+
+    def slow(self, result='rows'):
+        def fn():
+            self.runs += 1
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return fn
+
+    def call_concurrently(self, fn, callers=5):
+        results = [None] * callers
+
+        def run(i):
+            try:
+                results[i] = self.group.do(singleflight.key('O+', 2), fn)
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(callers)]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while self.group.stats()['coalesced'] < callers - 1 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads:
+            t.join(5)
+        return results
+
+    def test_identical_calls_share_one_run(self):
+        results = self.call_concurrently(self.slow())
+        self.assertEqual(results, ['rows'] * 5)
+        self.assertEqual(self.runs, 1)
+        stats = self.group.stats()
+        self.assertEqual((stats['executed'], stats['coalesced'], stats['inFlight']), (1, 4, 0))
+        self.assertEqual(stats['maxWaiters'], 4)
+
+    def test_every_waiter_gets_the_error(self):
+        results = self.call_concurrently(self.slow(LookupError('down')), callers=3)
+        self.assertTrue(all(isinstance(r, LookupError) for r in results))
+        self.assertEqual((self.runs, self.group.stats()['errors']), (1, 1))
+
+    def test_nothing_is_kept_after_the_call(self):
+        self.release.set()
+        self.group.do('k', self.slow('a'))
+        self.assertEqual(self.group.do('k', self.slow('b')), 'b')
+        self.assertEqual(self.runs, 2)
+
+    def test_key_normalizes_params(self):
+        self.assertEqual(
+            singleflight.key('O+', cities=['Pune', 'Agra'], units=2),
+            singleflight.key('O+', units=2, cities=('Agra', 'Pune'))
+        )
+        self.assertNotEqual(singleflight.key('O+', units=2), singleflight.key('O+', units=3))
+
+    def test_stats_lists_groups(self):
+        self.assertIn('test', singleflight.stats())
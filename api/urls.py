@@ -2,13 +2,14 @@ from django.urls import path # type: ignore
 from .views import ( # type: ignore
     RegisterView, LoginView, ForgotPasswordView,
     DonorStatsView, DonationHistoryView, BloodInventoryView, HospitalRequestsView, HospitalSearchView,
-    ActiveRequestsView, HospitalListView, HospitalAppointmentsView, 
-    AlertResponseView, NotificationView, ProfileUpdateView,
-    ActiveLocationsView, LocationCountView, HospitalDonorSearchView,
-    BatchView, BatchActionView, OutgoingBatchView,
-    HospitalReportsView, BloodDispatchView, BloodReceiveView,
+    ActiveRequestsView, HospitalListView, HospitalAppointmentsView, HospitalAppointmentsBulkView,
+    AlertResponseView, NotificationView, NotificationUnreadCountView, ProfileUpdateView,
+    ActiveLocationsView, LocationCountView, StockMapView, HospitalDonorSearchView,
+    BatchView, BatchIntakeView, BatchActionView, BatchBulkActionView, OutgoingBatchView, HospitalExportView, AllocationPlanView, StockHoldsView,
+    InventoryHistoryView, InventoryAtView, LineageLookbackView,
+    HospitalReportsView, HospitalReportsTimeseriesView, BloodDispatchView, BloodReceiveView,
     DonorIgnoreRequestView, DonorP2PView, AcceptRequestView,
-    DonorProfileView, FCMTokenView, EligibilityView
+    DonorProfileView, FCMTokenView, EligibilityView, SingleFlightStatsView
 )
 
 urlpatterns = [
@@ -21,13 +22,21 @@ urlpatterns = [
     path('donor/history/', DonationHistoryView.as_view(), name='donor-history'),
     
     path('hospital/inventory/', BloodInventoryView.as_view(), name='hospital-inventory'),
+    path('hospital/inventory/history/', InventoryHistoryView.as_view(), name='hospital-inventory-history'),
+    path('hospital/inventory/at/', InventoryAtView.as_view(), name='hospital-inventory-at'),
     path('hospital/requests/', HospitalRequestsView.as_view(), name='hospital-requests'),
     path('hospital/search/', HospitalSearchView.as_view(), name='hospital-search'),
     
     # Batch Management
     path('hospital/batches/', BatchView.as_view(), name='hospital-batches'),
+    path('hospital/batches/bulk/', BatchIntakeView.as_view(), name='hospital-batches-bulk'),
     path('hospital/batches/action/', BatchActionView.as_view(), name='hospital-batch-action'),
+    path('hospital/batches/action/bulk/', BatchBulkActionView.as_view(), name='hospital-batch-action-bulk'),
+    path('hospital/batches/allocation-plan/', AllocationPlanView.as_view(), name='hospital-batch-allocation-plan'),
+    path('hospital/holds/', StockHoldsView.as_view(), name='hospital-holds'),
     path('hospital/outgoing-batches/', OutgoingBatchView.as_view(), name='hospital-outgoing-batches'),
+    path('hospital/export/', HospitalExportView.as_view(), name='hospital-export'),
+    path('hospital/lineage/lookback/', LineageLookbackView.as_view(), name='hospital-lineage-lookback'),
 
     # Donor Urgent Requests
     path('donor/active-requests/', ActiveRequestsView.as_view(), name='donor-urgent'),
@@ -35,18 +44,23 @@ urlpatterns = [
 
     # Hospital Appointments
     path('hospital/appointments/', HospitalAppointmentsView.as_view(), name='hospital-appointments'),
+    path('hospital/appointments/bulk/', HospitalAppointmentsBulkView.as_view(), name='hospital-appointments-bulk'),
 
     # Shared API (Notifications/Profile)
     path('donor/respond-alert/', AlertResponseView.as_view(), name='respond-alert'),
     path('notifications/', NotificationView.as_view(), name='notifications'),
+    path('notifications/unread-count/', NotificationUnreadCountView.as_view(), name='notifications-unread-count'),
     path('profile/update/', ProfileUpdateView.as_view(), name='profile-update'),
     
     path('locations/active/', ActiveLocationsView.as_view(), name='locations-active'),
     path('locations/count/', LocationCountView.as_view(), name='locations-count'),
+    path('locations/stock-map/', StockMapView.as_view(), name='locations-stock-map'),
     path('hospital/donors/', HospitalDonorSearchView.as_view(), name='hospital-donors'),
+    path('ops/singleflight/', SingleFlightStatsView.as_view(), name='ops-singleflight'),
 
     # New Logic: Reports & P2P Dispatch
     path('hospital/reports/', HospitalReportsView.as_view(), name='hospital-reports'),
+    path('hospital/reports/timeseries/', HospitalReportsTimeseriesView.as_view(), name='hospital-reports-timeseries'),
     path('hospital/dispatch/', BloodDispatchView.as_view(), name='hospital-dispatch'),
     path('hospital/receive/', BloodReceiveView.as_view(), name='hospital-receive'),
 
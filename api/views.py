@@ -1,50 +1,49 @@
 from rest_framework.views import APIView # type: ignore
 from rest_framework.response import Response # type: ignore
 from rest_framework import status # type: ignore
-from .db import get_db # type: ignore
+from .db import get_db, run_in_transaction, supports_transactions # type: ignore
 from .auth_utils import authenticate_request, require_role # type: ignore
+from .idempotency import idempotent # type: ignore
+from .allocation import plan_allocation, restore_batches, STRATEGIES # type: ignore
+from .inventory import ( # type: ignore
+    BLOOD_GROUPS, adjust_stock, adjust_stock_many, set_stock, units_by_component,
+    get_levels, get_stock, hospitals_with_stock
+)
+from .ledger import stock_at, movement_history # type: ignore
+from .reports import get_report, invalidate_reports # type: ignore
+from .rollups import timeseries, GRANULARITIES # type: ignore
+from .audit import issued_on, query_outgoing # type: ignore
+from .appointments import BULK_STATUSES, MAX_BULK_APPOINTMENTS, donation_batch, donation_type, transition_appointments # type: ignore
+from .request_states import STATUSES as REQUEST_STATUSES, OPEN_STATUSES, transition, explain_failure # type: ignore
+from .donor_stats import record_donation, stats_response # type: ignore
+from .batch_intake import MAX_INTAKE_ROWS, parse_ndjson, intake_batches # type: ignore
+from .batch_issue import plan_bulk_action, apply_bulk_action # type: ignore
+from .lineage import record_issue, forget_issue, lookback, batch_donor_id # type: ignore
+from .regional_stock import stock_map, refresh_hospital # type: ignore
+from .export import DATASETS as EXPORT_DATASETS, FORMATS as EXPORT_FORMATS, export_cursor, stream_rows # type: ignore
+from .reservations import HoldUnavailable, place_hold, release_holds, convert_holds, list_holds, expire_holds # type: ignore
+from .push import send_push_multicast # type: ignore
+from .cache import get_or_set as cache_get_or_set, hospital_list, donor_locations, user_summaries, invalidate_user # type: ignore
+from .singleflight import Group as SingleFlight, key as singleflight_key, stats as singleflight_stats # type: ignore
+from .outbox import record_event, transition_with_events, notify_event, kick # type: ignore
+from .notifications import ( # type: ignore
+    create_broadcast, close_broadcasts, set_broadcast_state,
+    mark_request_broadcasts, parse_broadcast_item_id, broadcasts_for_user, visible_broadcast,
+    notify, record_notifications, update_notification_status,
+    mark_notifications_read, delete_notifications, unread_count
+)
 from bson import ObjectId # type: ignore
 import datetime
 import math
 import jwt # type: ignore
-import os
 from django.conf import settings # type: ignore
+from django.http import StreamingHttpResponse # type: ignore
 from typing import Any
 
-# Firebase Imports
-import firebase_admin # type: ignore
-from firebase_admin import credentials, messaging # type: ignore
-
-# Initialize Firebase App (Lazy Singleton)
-try:
-    if not firebase_admin._apps:
-        cred_path = os.getenv('FIREBASE_CREDENTIALS', 'serviceAccountKey.json')
-        if os.path.exists(cred_path):
-             cred = credentials.Certificate(cred_path)
-             firebase_admin.initialize_app(cred)
-        else:
-             print("Warning: Firebase Credentials not found. Push Notifications will not send.")
-except Exception as e:
-    print(f"Firebase Init Error: {e}")
-
-# Push Notification Helper
-def send_push_multicast(tokens, title, body, data=None):
-    if not tokens or not firebase_admin._apps:
-        return
-    try:
-        message = messaging.MulticastMessage(
-            notification=messaging.Notification(title=title, body=body),
-            data=data or {},
-            tokens=tokens,
-        )
-        # Use send_each_for_multicast (correct method for firebase-admin v6+)
-        response = messaging.send_each_for_multicast(message)
-        print(f"Push sent successfully: {response.success_count} succeeded, {response.failure_count} failed")
-        return response
-    except Exception as e:
-        print(f"Push Error: {e}")
-        import traceback
-        traceback.print_exc()
+# Request coalescing for the expensive reads everyone makes at once in an emergency (api/singleflight.py)
+hospital_search_flight = SingleFlight('hospital_search')
+location_count_flight = SingleFlight('location_count')
+active_requests_flight = SingleFlight('active_requests')
 
 # Haversine Formula for Distance (km)
 def calculate_distance(lat1, lon1, lat2, lon2):
@@ -66,90 +65,6 @@ def serialize_doc(doc: Any) -> Any:
         del doc['password']
     return doc
 
-def consume_batches_fifo(db, hospital_id, blood_group, units_needed):
-    """
-    Deduct units from batches using FIFO (First-In, First-Out) strategy.
-    Automatically skips expired batches and only consumes from valid units.
-    
-    Returns:
-        {
-            "consumed": int,
-            "source_batches": [{"batchId": str, "unitsUsed": int}, ...]
-        }
-    """
-    consumed = 0
-    source_batches = []
-    current_time = datetime.datetime.now(datetime.timezone.utc)
-    
-    try:
-        # Fetch batches sorted by date (Oldest first)
-        # Only fetch batches with units > 0 and status not expired/depleted
-        batches = db.batches.find({
-            "hospitalId": hospital_id, 
-            "bloodGroup": blood_group,
-            "units": {"$gt": 0},
-            "status": {"$nin": ["Expired", "Depleted", "Discarded"]}  # Skip invalid batches
-        }).sort("collectedDate", 1)
-        
-        for batch in batches:
-            if consumed >= units_needed:
-                break
-            
-            # Check expiry date before consuming
-            expiry_date_str = batch.get('expiryDate')
-            if expiry_date_str:
-                try:
-                    if isinstance(expiry_date_str, str):
-                        expiry_date = datetime.datetime.fromisoformat(expiry_date_str.replace('Z', '+00:00'))
-                    else:
-                        expiry_date = expiry_date_str
-                    
-                    # Skip expired batch and mark it
-                    if expiry_date.replace(tzinfo=datetime.timezone.utc) < current_time:
-                        db.batches.update_one(
-                            {"_id": batch['_id']},
-                            {"$set": {"status": "Expired"}}
-                        )
-                        print(f"Skipping expired batch {batch['_id']}")
-                        continue  # Skip this batch
-                except Exception as e:
-                    print(f"Expiry check error: {e}")
-                    # Continue with this batch if expiry check fails
-            
-            available = batch.get('units', 0)
-            to_take = min(available, units_needed - consumed)
-            
-            # Track source batch
-            source_batches.append({
-                "batchId": str(batch['_id']),
-                "unitsUsed": to_take,
-                "collectedDate": batch.get('collectedDate'),
-                "donorId": batch.get('donorId')
-            })
-            
-            # Atomic update for safety
-            db.batches.update_one(
-                {"_id": batch['_id']},
-                {"$inc": {"units": -to_take}}
-            )
-            
-            # Mark as depleted if no units remain
-            if available == to_take:
-                db.batches.update_one(
-                    {"_id": batch['_id']},
-                    {"$set": {"status": "Depleted", "depletedAt": datetime.datetime.now().isoformat()}}
-                )
-            
-            consumed += to_take
-            
-    except Exception as e:
-        print(f"Batch Consumption Error: {e}")
-        
-    return {
-        "consumed": consumed,
-        "source_batches": source_batches
-    }
-
 class RegisterView(APIView):
     def post(self, request):
         db = get_db()
@@ -202,6 +117,7 @@ class RegisterView(APIView):
             data.setdefault('fcmToken', "") # Store FCM Token
             
         result = db.users.insert_one(data)
+        invalidate_user(result.inserted_id, data.get('role'))
         
         return Response({
             "success": True, 
@@ -275,116 +191,9 @@ class DonorStatsView(APIView):
     @authenticate_request
     @require_role('donor')
     def get(self, request):
-        db = get_db()
-        # Use validated user_id from JWT token instead of trusting query params
-        user_id = request.user_id
-        
-        # 1. Fetch User Profile for Total Donations (Source of Truth)
-        try:
-            user = db.users.find_one({"_id": ObjectId(user_id)})
-        except:
-            user = None
-        
-        # Use explicit counter from User profile
-        profile_count = user.get('totalDonations', 0) if user else 0
-        
-        # Calculate from DB for verification/self-healing
-        # Support both String and ObjectId query
-        query_id = {"$in": [user_id, ObjectId(user_id)]}
-        db_count = db.appointments.count_documents({"donorId": query_id, "status": "Completed"})
-        
-        # Use the higher value (Self-Healing)
-        donations = max(profile_count, db_count)
-        
-        # Optionally update profile if out of sync (Lazy Correction)
-        if user and db_count > profile_count:
-             try:
-                 db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"totalDonations": db_count}})
-             except: pass
-             
-        lives_saved = donations * 3
-        
-        # Calculate Next Donation Date
-        try:
-            # 2. Check Appointment History for Calculation
-            last_appt = db.appointments.find_one(
-                {"donorId": {"$in": [user_id, ObjectId(user_id)]}, "status": "Completed"},
-                sort=[("date", -1)]
-            )
-            
-            user_last_date_str = user.get('lastDonationDate') if user else None
-
-            # Determine most recent date
-            latest_date = None
-            
-            if last_appt:
-                d_str = last_appt['date'].replace('Z', '+00:00')
-                latest_date = datetime.datetime.fromisoformat(d_str)
-
-            if user_last_date_str:
-                try:
-                    u_date = datetime.datetime.fromisoformat(user_last_date_str.replace('Z', '+00:00'))
-                    
-                    # SELF-HEALING: If DB has a newer date than Profile, update Profile
-                    if latest_date and latest_date > u_date:
-                        # DB is fresher, use it and update profile
-                        try:
-                            db.users.update_one(
-                                {"_id": ObjectId(user_id)},
-                                {
-                                    "$set": {
-                                        "lastDonationDate": last_appt['date'],
-                                        "lastDonationType": last_appt.get('type', 'Voluntary')
-                                    }
-                                }
-                            )
-                            # print(f"Self-healed lastDonationDate for {user_id}")
-                        except: pass
-                    
-                    # If user profile date is more recent (or no appt yet), use it
-                    elif latest_date is None or u_date > latest_date:
-                        latest_date = u_date
-                        
-                except Exception as e:
-                    print(f"Date parse error: {e}")
-                    pass
-            elif latest_date:
-                # Profile has NO date, but DB does. Update Profile.
-                 try:
-                    db.users.update_one(
-                        {"_id": ObjectId(user_id)},
-                        {
-                            "$set": {
-                                "lastDonationDate": last_appt['date'],
-                                "lastDonationType": last_appt.get('type', 'Voluntary')
-                            }
-                        }
-                    )
-                 except: pass
-
-            next_date = "Available Now"
-            if latest_date:
-                # 120 Days Rule (User requested 4 months)
-                eligible_date = latest_date + datetime.timedelta(days=120)
-                now_utc = datetime.datetime.now(datetime.timezone.utc)
-                
-                # Make eligible_date offset-aware if it isn't
-                if eligible_date.tzinfo is None:
-                    eligible_date = eligible_date.replace(tzinfo=datetime.timezone.utc)
-                if now_utc.tzinfo is None:
-                    now_utc = now_utc.replace(tzinfo=datetime.timezone.utc)
-
-                if eligible_date > now_utc:
-                    next_date = eligible_date.strftime("%d %b %Y")
-        except Exception as e:
-            print(f"Error calculating next date: {e}")
-            pass
-
-        return Response({
-            "livesSaved": lives_saved,
-            "bloodUnits": donations,
-            "nextDonationDate": next_date
-        })
+        # Stats are maintained on the profile whenever a donation is recorded
+        # (api/donor_stats.py), and the auth decorator has already loaded it
+        return Response(stats_response(request.user_data))
 
 class DonationHistoryView(APIView):
     @authenticate_request
@@ -516,8 +325,6 @@ class BloodInventoryView(APIView):
         if not user_id:
              return Response({"error": "userId required"}, status=400)
              
-        inventory: dict[str, Any] = db.inventory.find_one({"hospitalId": user_id}) or {}
-        
         # Lazy Sync: Check for expired batches and update inventory
         try:
             now_iso = datetime.datetime.now().isoformat()
@@ -529,33 +336,29 @@ class BloodInventoryView(APIView):
                 "expiryDate": {"$lt": now_iso}
             }))
             
-            if expired_batches:
-                for batch in expired_batches:
-                    qty = batch.get('units', 0)
-                    bg = batch.get('bloodGroup')
-                    
-                    if qty > 0 and bg:
-                        # Decrement Inventory
-                        db.inventory.update_one(
-                            {"hospitalId": user_id},
-                            {"$inc": {bg: -qty}}
-                        )
-                        # Mark Batch as Expired (Units 0)
-                        db.batches.update_one(
-                            {"_id": batch['_id']},
-                            {"$set": {"units": 0, "status": "Expired"}}
-                        )
-                        print(f"Expired Batch {batch['_id']}: Removed {qty} units of {bg}")
+            for batch in expired_batches:
+                qty = batch.get('units', 0)
+                bg = batch.get('bloodGroup')
                 
-                # Re-fetch inventory after updates
-                inventory: dict[str, Any] = db.inventory.find_one({"hospitalId": user_id}) or {}
+                if qty > 0 and bg:
+                    # Decrement Inventory
+                    adjust_stock(db, user_id, bg, -qty, batch.get('componentType'), source='expiry', batch_id=batch['_id'])
+                    # Mark Batch as Expired (Units 0)
+                    db.batches.update_one(
+                        {"_id": batch['_id']},
+                        {"$set": {"units": 0, "status": "Expired"}}
+                    )
+                    print(f"Expired Batch {batch['_id']}: Removed {qty} units of {bg}")
         except Exception as e:
             print(f"Batch Expiry Sync Error: {e}")
 
+        levels = get_levels(db, user_id)
+
         # Logic: Determine Status on Backend
         items = []
-        for bg in ['A+', 'A-', 'B+', 'B-', 'O+', 'O-', 'AB+', 'AB-']:
-            count = inventory.get(bg, 0) # type: ignore
+        for bg in BLOOD_GROUPS:
+            level = levels.get(bg, {"total": 0, "held": 0, "components": {}})
+            count = level['total']
             status_label = "Good"
             if count < 5:
                 status_label = "Critical"
@@ -565,23 +368,90 @@ class BloodInventoryView(APIView):
             items.append({
                 "type": bg,
                 "total": max(0, count), # Ensure no negative
-                "status": status_label
+                "held": level['held'],
+                "status": status_label,
+                "components": level['components']
             })
             
         return Response(items)
 
     def post(self, request):
+        """Manual stock entry: {hospitalId, componentType?, "A+": 5, "O-": 2, ...}"""
         db = get_db()
         data = request.data
         user_id = data.get('hospitalId')
+        if not user_id:
+             return Response({"error": "hospitalId required"}, status=400)
         
-        db.inventory.update_one(
-            {"hospitalId": user_id},
-            {"$set": data},
-            upsert=True
-        )
+        for bg in BLOOD_GROUPS:
+            if bg in data:
+                try:
+                    set_stock(db, user_id, bg, int(data[bg]), data.get('componentType'), actor=user_id)
+                except (ValueError, TypeError):
+                    return Response({"error": f"Invalid units for {bg}"}, status=400)
         return Response({"success": True})
 
+def settle_transfer_hold(db, req, req_id, session=None):
+    """
+    Convert the sender's stock hold for a transfer into batch consumption and
+    record the source batches on the outgoing record. No-op once settled.
+    Pass the session of the status change (transition_with_events writes=)
+    so a failed draw aborts it and the hold stays with an Accepted request.
+    """
+    sender_id = req.get('acceptedBy')
+    bg = req.get('bloodGroup')
+    if not sender_id or not bg:
+        return None
+
+    result = convert_holds(db, sender_id, bg, req_id, session=session)
+    if result['source_batches']:
+        outgoing = db.outgoing_batches.find_one_and_update(
+            {"type": "transfer", "dispatchDetails.requestId": req_id},
+            {"$set": {"sourceBatchIds": result['source_batches']}},
+            return_document=True,
+            session=session
+        )
+        if outgoing:
+            record_issue(db, outgoing, session=session)
+    return result
+
+
+def accept_with_hold(db, req_id, responder_id, dataset, guard):
+    """
+    Accept a request and, for a StockTransfer or P2P, reserve the responder's
+    stock in the same transaction. The hold is one guarded update, so
+    concurrent acceptances can't promise the same units twice; batches are
+    drawn on dispatch. The requester's REQUEST_ACCEPTED notification is
+    queued in the same transaction. Returns (post-image, hold) - (None, None)
+    when the guard didn't match. Raises HoldUnavailable when the stock isn't
+    there, which aborts the acceptance.
+    """
+    def apply(session):
+        req = transition(db, req_id, 'Accepted', set_fields=dataset, session=session, **guard)
+        if req is None:
+            return None, None
+        hold = None
+        if req.get('type') in ['P2P', 'StockTransfer']:
+            hold = place_hold(db, responder_id, req.get('bloodGroup'), int(req.get('units', 1)), req_id, session=session)
+            if not hold:
+                raise HoldUnavailable(req)
+
+        requester_id = req.get('requesterId')
+        if requester_id:
+            body = f"{{actor}} has accepted your request for {req.get('units')} units."
+            record_event(db, *notify_event(
+                requester_id, "REQUEST_ACCEPTED", "Request Accepted", body,
+                related_request_id=req_id, actor_id=responder_id, actor_fallback="A Hospital",
+                push={"title": "Request Accepted", "body": body, "data": {"type": "REQUEST_ACCEPTED", "requestId": req_id}}
+            ), session=session)
+        return req, hold
+
+    req, hold = run_in_transaction(apply)
+    if req is not None:
+        kick()
+    return req, hold
+
+
 class HospitalRequestsView(APIView):
     def get(self, request):
         db = get_db()
@@ -632,11 +502,16 @@ class HospitalRequestsView(APIView):
         # Combine
         combined = []
         
+        # Names / locations of every party in one cached lookup instead of one read per request
+        parties = user_summaries(db, [r.get('acceptedBy') for r in my_requests] + [
+            r.get('requesterId') or r.get('hospitalId') for r in incoming_requests
+        ])
+        
         # Process Outgoing
         for req in my_requests:
             req['isOutgoing'] = True
             if req.get('acceptedBy'):
-                donor = db.users.find_one({"_id": ObjectId(req['acceptedBy'])})
+                donor = parties.get(str(req['acceptedBy']))
                 req['donorName'] = donor.get('name') if donor else "Unknown Donor"
             combined.append(req)
             
@@ -648,7 +523,7 @@ class HospitalRequestsView(APIView):
                 continue 
             requester_id = req.get('requesterId') or req.get('hospitalId')
             if requester_id:
-                requester = db.users.find_one({"_id": ObjectId(requester_id)})
+                requester = parties.get(str(requester_id))
                 req['hospitalName'] = requester.get('name') if requester else "Unknown Hospital"
                 req['location'] = requester.get('location') if requester else "Unknown"
             combined.append(req)
@@ -671,6 +546,7 @@ class HospitalRequestsView(APIView):
             
         return Response(final_results)
         
+    @idempotent
     def post(self, request):
         db = get_db()
         data = request.data
@@ -743,22 +619,21 @@ class HospitalRequestsView(APIView):
              if data.get('cities'):
                  query['location'] = {"$in": data.get('cities')}
                  
-             donors = list(db.users.find(query))
+             donors = list(db.users.find(query, {"fcmToken": 1}))
         
         # 3. Create Request (ONCE)
         res = db.requests.insert_one(data)
         
         if data.get('type') == 'P2P' and data.get('hospitalId'):
             # Notify Target Hospital
-            db.notifications.insert_one({
-                "recipientId": data.get('hospitalId'),
-                "type": "P2P_REQUEST",
-                "title": "New Blood Request",
-                "message": f"{data.get('requesterName', 'A Hospital')} requested {data.get('units')} units of {data.get('bloodGroup')}.",
-                "relatedRequestId": str(res.inserted_id),
-                "timestamp": datetime.datetime.now().isoformat(),
-                "status": "UNREAD"
-            })
+            notify(
+                db,
+                data.get('hospitalId'),
+                "P2P_REQUEST",
+                "New Blood Request",
+                f"{data.get('requesterName', 'A Hospital')} requested {data.get('units')} units of {data.get('bloodGroup')}.",
+                related_request_id=str(res.inserted_id)
+            )
             
         elif data.get('type') == 'EMERGENCY_ALERT':
              # Send Push to Donors
@@ -774,25 +649,27 @@ class HospitalRequestsView(APIView):
                      }
                  )
                  
-             # Create notifications in DB for history
-             notifs = []
-             for d in donors:
-                 notifs.append({
-                     "recipientId": str(d['_id']),
-                     "type": "EMERGENCY_ALERT",
-                     "title": "Emergency Blood Needed!",
-                     "message": f"Urgent: {data.get('bloodGroup')} blood needed.",
-                     "relatedRequestId": str(res.inserted_id),
-                     "timestamp": datetime.datetime.now().isoformat(),
-                     "status": "UNREAD"
-                 })
-             if notifs:
-                 db.notifications.insert_many(notifs)
+             # Create ONE broadcast notification for history (fan-out on read)
+             # Donors see it through NotificationView.get via audience matching.
+             if donors:
+                 create_broadcast(
+                     db,
+                     "EMERGENCY_ALERT",
+                     "Emergency Blood Needed!",
+                     f"Urgent: {data.get('bloodGroup')} blood needed.",
+                     str(res.inserted_id),
+                     {
+                         "role": "donor",
+                         "bloodGroup": data.get('bloodGroup'),
+                         "cities": data.get('cities')
+                     }
+                 )
 
         return Response({"success": True, "id": str(res.inserted_id)})
         
 
 
+    @idempotent
     def put(self, request):
         db = get_db()
         data = request.data
@@ -803,101 +680,80 @@ class HospitalRequestsView(APIView):
         
         if not req_id or not new_status:
             return Response({"error": "id and status are required"}, status=400)
-            
-        # Fetch Request First
-        req = db.requests.find_one({"_id": ObjectId(req_id)})
-        if not req:
-             return Response({"error": "Request not found"}, status=404)
-             
-        # GUARD: Immutability check
-        current_status = req.get('status', '')
-        if current_status == 'Completed':
-             return Response({"error": "Cannot modify a completed request"}, status=status.HTTP_409_CONFLICT)
+        if new_status not in REQUEST_STATUSES:
+            return Response({"error": f"Unknown status '{new_status}'"}, status=400)
+        if new_status == 'Accepted' and not responder_id:
+            return Response({"error": "hospitalId required for acceptance"}, status=400)
 
-        # Update Request
-        dataset = {"status": new_status}
+        # Update Request: one guarded write, side effects below only run if it won
+        dataset = {}
+        guard: dict[str, Any] = {}
         
         # Save optional response message
         if data.get('responseMessage'):
             dataset['responseMessage'] = data.get('responseMessage')
         
         if new_status == 'Accepted':
-            # GUARD: Prevent Re-Acceptance (Side effects are not idempotent)
-            if req.get('status') == 'Accepted':
-                 return Response({"error": "Request is already accepted."}, status=409)
+            # CONCURRENCY: only an open, unexpired request that isn't someone else's can be accepted
+            now_iso = datetime.datetime.now().isoformat()
+            dataset['acceptedBy'] = responder_id
+            dataset['acceptedAt'] = now_iso
+            guard = {
+                "acceptor": responder_id,
+                "match": {"$or": [{"expiresAt": None}, {"expiresAt": {"$gt": now_iso}}]}
+            }
+        if new_status == 'Completed':
+            dataset["completedAt"] = datetime.datetime.now().isoformat()
+        
+        # Completion queues the receiver's batch / stock and the donor's history in the same write
+        def completion_events(_req):
+            return [("request_completed", {"requestId": req_id})] if new_status == 'Completed' else []
 
-            # 1. EXPIRY CHECK
-            if req.get('expiresAt'):
+        # Transfers completed without a dispatch step: the sender's hold becomes consumption,
+        # committed with the completion (a failed draw leaves the request as it was)
+        def completion_writes(completed, session):
+            if new_status == 'Completed' and completed.get('type') in ['P2P', 'StockTransfer'] and completed.get('acceptedBy'):
+                settle_transfer_hold(db, completed, req_id, session=session)
+
+        hold = None
+        try:
+            if new_status == 'Accepted':
+                req, hold = accept_with_hold(db, req_id, responder_id, dataset, guard)
+            else:
+                req = transition_with_events(
+                    db, req_id, new_status, completion_events, writes=completion_writes, set_fields=dataset, **guard
+                )
+        except HoldUnavailable as e:
+            if not supports_transactions():
+                # No transaction to abort: the acceptance was written, give the request back
+                transition(
+                    db, req_id, e.request['previousStatus'], from_statuses=['Accepted'], acceptor=responder_id,
+                    unset_fields=['acceptedBy', 'acceptedAt']
+                )
+            bg = e.request.get('bloodGroup')
+            current_stock = get_stock(db, responder_id, bg)
+            return Response({"error": f"Insufficient {bg} stock ({current_stock} available)."}, status=400)
+        if req is None:
+            message, code, current = explain_failure(db, req_id, new_status, guard.get('acceptor'))
+            # EXPIRY CHECK: an open request past its deadline is expired instead of accepted
+            if new_status == 'Accepted' and current and current.get('status') in OPEN_STATUSES and current.get('expiresAt'):
                 try:
-                    exp_date = datetime.datetime.fromisoformat(req['expiresAt'].replace('Z', ''))
+                    exp_date = datetime.datetime.fromisoformat(current['expiresAt'].replace('Z', ''))
                     if exp_date < datetime.datetime.now():
-                         # Auto-expire it instead of just erroring?
-                         db.requests.update_one({"_id": ObjectId(req_id)}, {"$set": {"status": "Expired"}})
-                         return Response({"error": "This request has expired."}, status=400)
-                except:
+                        transition(db, req_id, 'Expired', from_statuses=OPEN_STATUSES)
+                        return Response({"error": "This request has expired."}, status=400)
+                except ValueError:
                     pass
-
-            if not responder_id:
-                return Response({"error": "hospitalId required for acceptance"}, status=400)
-            
-            # CONCURRENCY CHECK: Prevent Double Acceptance
-            if req.get('acceptedBy') and req.get('acceptedBy') != responder_id:
-                 return Response({"error": "Request already accepted by another hospital"}, status=status.HTTP_409_CONFLICT)
-                 
-            dataset['acceptedBy'] = responder_id
-            dataset['acceptedAt'] = datetime.datetime.now().isoformat()
-            
-            # NOTIFY REQUESTER (Hospital)
-            requester_id = req.get('requesterId')
-            if requester_id:
-                requester = db.users.find_one({"_id": ObjectId(requester_id)})
-                if requester:
-                    responder = db.users.find_one({"_id": ObjectId(responder_id)})
-                    resp_name = responder.get('name') if responder else "A Hospital"
-                    
-                    title = "Request Accepted"
-                    body = f"{resp_name} has accepted your request for {req.get('units')} units."
-                    
-                    # DB Notification
-                    db.notifications.insert_one({
-                        "recipientId": str(requester['_id']),
-                        "title": title,
-                        "message": body,
-                        "type": "REQUEST_ACCEPTED",
-                        "relatedRequestId": req_id,
-                        "status": "UNREAD",
-                        "timestamp": datetime.datetime.now().isoformat()
-                    })
-                    
-                    # FCM Push
-                    if requester.get('fcmToken'):
-                        send_push_multicast([requester['fcmToken']], title, body, {"type": "REQUEST_ACCEPTED", "requestId": req_id})
-
-            # CRITICAL: If StockTransfer or P2P, Decrement Responder's Inventory immediately on Acceptance
-            # This prevents double-booking (promising same stock to multiple people)
-            if req.get('type') in ['P2P', 'StockTransfer']:
+            return Response({"error": message}, status=code)
+        current_status = req['previousStatus']
+        
+        if new_status == 'Accepted':
+            if hold:
                 bg = req.get('bloodGroup')
                 units = int(req.get('units', 1))
-                
-                # Check Responder Stock
-                responder_inv = db.inventory.find_one({"hospitalId": responder_id})
-                current_stock = int(responder_inv.get(bg, 0)) if responder_inv else 0
-                
-                if current_stock < units:
-                     return Response({"error": f"Insufficient {bg} stock ({current_stock} available)."}, status=400)
-                
-                # Decrement Inventory (Aggregate)
-                db.inventory.update_one(
-                    {"hospitalId": responder_id},
-                    {"$inc": {bg: -units}}
-                )
-                
-                # CRITICAL: Also Consume Batches (Physical Stock) to match Inventory
-                # This prevents "Double Spending" of the same blood units
-                consumption_result = consume_batches_fifo(db, responder_id, bg, units)
-                
+
                 # Create Outgoing Batch Record for Sender (Responder)
-                # This ensures it shows up in "Outgoing Batches" UI
+                # This ensures it shows up in "Outgoing Batches" UI. Source batches are filled in on dispatch.
                 try:
                     outgoing_batch_data = {
                         "type": "transfer", # Distinct from 'patient_usage'
@@ -906,8 +762,10 @@ class HospitalRequestsView(APIView):
                         "bloodGroup": bg,
                         "quantity": units,
                         "issuedAt": datetime.datetime.now().isoformat(),
+                        "issuedOn": issued_on(),
                         "status": "Transferred",
-                        "sourceBatchIds": consumption_result.get('source_batches', []),
+                        "holdId": hold['holdId'],
+                        "sourceBatchIds": [],
                         "dispatchDetails": {
                             "requestId": str(req['_id']),
                             "tracker": f"TRK-{str(req['_id'])[-6:].upper()}" # type: ignore
@@ -918,136 +776,43 @@ class HospitalRequestsView(APIView):
                 except Exception as e:
                     print(f"Failed to create outgoing batch record: {e}")
 
-
-        if new_status == 'Cancelled' and current_status == 'Accepted':
-             # REFUND LOGIC: If it was a StockTransfer/P2P that was accepted, the responder lost stock. Refund it.
+        if new_status == 'Cancelled' and current_status in ['Accepted', 'Dispatched']:
+             # REFUND LOGIC: If it was a StockTransfer/P2P that was accepted, the responder reserved
+             # (or, once dispatched, consumed) stock. Give it back.
              if req.get('type') in ['P2P', 'StockTransfer'] and req.get('acceptedBy'):
                  responder_id = req.get('acceptedBy')
                  bg = req.get('bloodGroup')
                  units = int(req.get('units', 1))
                  
                  if responder_id and bg:
-                     db.inventory.update_one(
-                         {"hospitalId": responder_id},
-                         {"$inc": {bg: units}}
+                     outgoing = db.outgoing_batches.find_one(
+                         {"type": "transfer", "dispatchDetails.requestId": req_id},
+                         {"sourceBatchIds": 1}
                      )
+                     
+                     def refund_stock(session):
+                         # Still on hold: just release it
+                         if release_holds(db, req_id, session=session):
+                             return
+                         # Already drawn: refund the same components and refill the batches
+                         source_batches = outgoing.get('sourceBatchIds', []) if outgoing else []
+                         adjust_stock_many(
+                             db, responder_id, units_by_component(bg, source_batches, units),
+                             session=session, source='refund', request_id=req_id
+                         )
+                         restore_batches(db, source_batches, session=session)
+                     
+                     run_in_transaction(refund_stock)
+                     if outgoing:
+                         db.outgoing_batches.update_one({"_id": outgoing['_id']}, {"$set": {"status": "Cancelled"}})
+                         forget_issue(db, outgoing['_id'])
                      print(f"Refunded {units} units of {bg} to {responder_id}")
 
-             # CLEANUP: Remove pending notifications so donors don't see dead alerts
-             db.notifications.delete_many({"relatedRequestId": req_id})
+             # CLEANUP: Close broadcasts and remove pending notifications so donors don't see dead alerts
+             close_broadcasts(db, req_id)
+             delete_notifications(db, {"relatedRequestId": req_id})
 
-        if new_status == 'Completed':
-            dataset["completedAt"] = datetime.datetime.now().isoformat()
-            
-        db.requests.update_one(
-            {"_id": ObjectId(req_id)},
-            {"$set": dataset}
-        )
-        
-        # If successfully completed, update inventory logic
-        if new_status == 'Completed':
-            req = db.requests.find_one({"_id": ObjectId(req_id)})
-            if req:
-                req_type = req.get('type')
-                units = int(req.get('units', 1))
-                bg = req.get('bloodGroup')
-                
-                # Determine Who is Who
-                # Determine Who is Who
-                if req_type == 'P2P':
-                    # P2P: Requester is the Hospital receiving blood. acceptedBy is the Donor.
-                    donor_id = req.get('acceptedDonorId') or req.get('acceptedBy')
-                    requester_id = req.get('requesterId')
-                elif req_type == 'StockTransfer':
-                     # Transfer: Requester is Receiver. acceptedBy is the Sending Hospital.
-                     donor_id = req.get('acceptedBy')
-                     requester_id = req.get('requesterId')
-                else:
-                    # Emergency/Broadcast: hospitalId is the SOURCE (Need), acceptedBy is the DONOR
-                    donor_id = req.get('acceptedBy')
-                    requester_id = req.get('hospitalId') or req.get('requesterId')
-
-                # Fetch Source/Donor Name for consistent records
-                source_name = "External Source"
-                donor_details = {}
-                
-                if donor_id:
-                     donor_obj = db.users.find_one({"_id": ObjectId(donor_id)})
-                     if donor_obj:
-                         source_name = donor_obj.get('name', 'Unknown')
-                         donor_details = {
-                             "donorId": str(donor_obj['_id']),
-                             "name": donor_obj.get('name'),
-                             "email": donor_obj.get('email'),
-                             "phone": donor_obj.get('phone'),
-                             "bloodGroup": donor_obj.get('bloodGroup')
-                         }
-
-                # 1. Increment Stock for Requester (They received it)
-                if requester_id and bg:
-                    db.inventory.update_one(
-                        {"hospitalId": requester_id},
-                        {"$inc": {bg: units}}, 
-                        upsert=True
-                    )
-                    # AUTO-CREATE BATCH for Requester
-                    try:
-                        batch_data = {
-                            "hospitalId": requester_id,
-                            "bloodGroup": bg,
-                            "componentType": "Whole Blood",
-                            "units": units,
-                            "collectedDate": datetime.datetime.now().isoformat(),
-                            "expiryDate": (datetime.datetime.now() + datetime.timedelta(days=35)).isoformat(),
-                            "sourceType": "Transfer" if req_type in ['P2P', 'StockTransfer'] else "Donation",
-                            "sourceName": source_name,
-                            "donorDetails": donor_details, # Added detailed info
-                            "location": "Incoming Setup", 
-                            "createdAt": datetime.datetime.now().isoformat(),
-                            "status": "Active"
-                        }
-                        db.batches.insert_one(batch_data)
-                    except Exception as e:
-                        print(f"Failed to auto-create batch: {e}")
-                    
-                # 2. Decrement Logic moved to 'Accepted' block for StockTransfer.
-                # For standard donors, no inventory to decrement.
-                pass
-                
-                # 3. Add to Donation History (Appointments Collection for consistency)
-                # This ensures it appears in Donor's dashboard stats which now uses 'appointments'
-                if donor_id:
-                     # Check if it's a user (Donor role)
-                    donor_user = db.users.find_one({"_id": ObjectId(donor_id)})
-                    
-                    if donor_user and donor_user.get('role') == 'donor':
-                        history_record = {
-                            "donorId": donor_id,
-                            "hospitalId": requester_id,
-                            "hospitalName": req.get('hospitalName') or 'Emergency Request',
-                            "date": datetime.datetime.now().isoformat(),
-                            "units": units,
-                            "bloodGroup": bg,
-                            "type": "Emergency Donation", 
-                            "status": "Completed"
-                        }
-                        db.appointments.insert_one(history_record)
-                        
-                        # Explicitly Update User Stats (Immediate Feedback)
-                        # Self-healing will backup this, but direct write is faster/safer
-                        try:
-                            db.users.update_one(
-                                {"_id": ObjectId(donor_id)},
-                                {
-                                    "$inc": {"totalDonations": 1},
-                                    "$set": {
-                                        "lastDonationDate": datetime.datetime.now().isoformat(),
-                                        "lastDonationType": "Emergency Request"
-                                    }
-                                }
-                            )
-                        except Exception as e:
-                            print(f"Failed to update user stats for emergency request: {e}")
+        invalidate_reports(db, [req.get('acceptedBy')])
 
         return Response({"success": True})
 
@@ -1066,61 +831,136 @@ class HospitalSearchView(APIView):
         if not blood_group:
              return Response({"error": "bloodGroup required"}, status=400)
 
-        # 1. Find inventories with stock >= Requested Units (Logic Verification)
-        # Frontend previously filtered this. Now Backend does it.
-        inventory_query = {blood_group: {"$gte": min_units}}
-        
-        # Optimization: We could also filter by hospitalId != requester_id here if we query users...
-        # But inventory links to hospitalId.
-        if requester_id:
-             inventory_query["hospitalId"] = {"$ne": requester_id}
-
-        inventories = list(db.inventory.find(inventory_query))
+        def find_stocked():
+            # 1. Find hospitals with stock >= Requested Units (Logic Verification)
+            # Frontend previously filtered this. Now Backend does it.
+            # Index seek on (bloodGroup, units).
+            stock_rows = hospitals_with_stock(db, blood_group, min_units)
+            
+            # 2. Get Hospital Details (one round trip)
+            hospital_ids = [ObjectId(h) for h, _units in stock_rows if ObjectId.is_valid(str(h))]
+            hospitals = {str(h['_id']): h for h in db.users.find(
+                {"_id": {"$in": hospital_ids}}, {"name": 1, "location": 1, "phone": 1, "coordinates": 1}
+            )}
+            return [(dict(hospitals[h], _id=h), units) for h, units in stock_rows if h in hospitals]
+        
+        # Cached per (bloodGroup, units) until stock of that group or a hospital profile changes;
+        # on a miss, identical searches in flight share one computation (api/cache.py, api/singleflight.py).
+        # The requester and the distances are per caller.
+        stocked = cache_get_or_set(
+            f"hospital_search:{blood_group}:{min_units}",
+            lambda: hospital_search_flight.do(singleflight_key(blood_group, min_units), find_stocked),
+            tags=(f"stock:{blood_group}", "users:hospital"),
+            ttl=settings.HOSPITAL_SEARCH_CACHE_TTL_SECONDS
+        )
         
         results = []
-        for inv in inventories:
-            hospital_id = inv.get('hospitalId')
-            units = inv.get(blood_group)
+        for hospital, units in stocked:
+            if requester_id and str(hospital['_id']) == requester_id:
+                continue
             
-            # 2. Get Hospital Details
-            if hospital_id:
+            # Calculate Distance
+            dist_text = "Unknown Distance"
+            dist_val = 999999
+            
+            if user_lat and user_lng and hospital.get('coordinates'):
                 try:
-                    hospital = db.users.find_one({"_id": ObjectId(hospital_id)})
-                    if hospital:
-                        # Calculate Distance
-                        dist_text = "Unknown Distance"
-                        dist_val = 999999
-                        
-                        if user_lat and user_lng and hospital.get('coordinates'):
-                            try:
-                                h_lat = float(hospital['coordinates']['latitude'])
-                                h_lng = float(hospital['coordinates']['longitude'])
-                                u_lat = float(user_lat)
-                                u_lng = float(user_lng)
-                                
-                                dist = calculate_distance(u_lat, u_lng, h_lat, h_lng)
-                                dist_val = dist
-                                dist_text = f"{dist:.1f} km"
-                            except:
-                                pass
-                        
-                        results.append({
-                            "id": str(hospital['_id']),
-                            "name": hospital.get('name'),
-                            "location": hospital.get('location', 'Unknown'),
-                            "phone": hospital.get('phone', 'N/A'),
-                            "units": units,
-                            "distance": dist_text,
-                            "sort_dist": dist_val
-                        })
+                    h_lat = float(hospital['coordinates']['latitude'])
+                    h_lng = float(hospital['coordinates']['longitude'])
+                    u_lat = float(user_lat)
+                    u_lng = float(user_lng)
+                    
+                    dist = calculate_distance(u_lat, u_lng, h_lat, h_lng)
+                    dist_val = dist
+                    dist_text = f"{dist:.1f} km"
                 except:
-                    continue  
+                    pass
+            
+            results.append({
+                "id": str(hospital['_id']),
+                "name": hospital.get('name'),
+                "location": hospital.get('location', 'Unknown'),
+                "phone": hospital.get('phone', 'N/A'),
+                "units": units,
+                "distance": dist_text,
+                "sort_dist": dist_val
+            })
 
         # Sort by distance
         results.sort(key=lambda x: x['sort_dist'])
         
         return Response(results)
 
+def active_request_feed(db, blood_group=None):
+    """
+    Active, unexpired requests (newest first) for a blood group, or every
+    group when None, with requester details filled in. Shared between
+    callers by ActiveRequestsView, so it must not depend on who asks.
+    """
+    params: dict[str, Any] = {"status": "Active"}
+    if blood_group:
+        params["bloodGroup"] = blood_group
+    
+    requests = list(db.requests.find(params).sort("createdAt", -1))
+    
+    # Requesters of the whole feed in one round trip
+    requester_ids = {str(r.get('requesterId') or r.get('hospitalId')) for r in requests if r.get('requesterId') or r.get('hospitalId')}
+    requesters = {str(u['_id']): u for u in db.users.find(
+        {"_id": {"$in": [ObjectId(u) for u in requester_ids if ObjectId.is_valid(u)]}},
+        {"name": 1, "phone": 1, "bloodGroup": 1, "location": 1}
+    )}
+    
+    feed = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    
+    for r in requests:
+        # Check Expiry if exists
+        if r.get('expiresAt'):
+             try:
+                 # Handle formats (ISO with/without Z)
+                 exp_str = str(r['expiresAt']).replace('Z', '')
+                 exp_date = datetime.datetime.fromisoformat(exp_str)
+                 if exp_date.tzinfo is None: exp_date = exp_date.replace(tzinfo=datetime.timezone.utc)
+                 
+                 if exp_date < now:
+                     continue # Expired
+             except:
+                 pass # If bad date, ignore expiry check or safe fail
+
+        # Populate Requester Details (name, all form fields)
+        requester_id = r.get('requesterId') or r.get('hospitalId')
+        if requester_id:
+            requester = requesters.get(str(requester_id))
+            if requester:
+                r['requesterName'] = requester.get('name', 'Anonymous')
+                r['requesterPhone'] = requester.get('phone')
+                r['requesterBloodGroup'] = requester.get('bloodGroup')
+                
+                # If hospitalName not provided, use requester's location
+                if not r.get('hospitalName'):
+                    r['hospitalName'] = r.get('hospitalName', 'Unknown Hospital')
+                if not r.get('location'):
+                    r['location'] = requester.get('location', 'Unknown Location')
+            else:
+                r['requesterName'] = "Unknown Requester"
+        
+        # Ensure all form fields are present (patient details, attender, etc.)
+        req_data = serialize_doc(r)
+        req_data['patientName'] = r.get('patientName', 'N/A')
+        req_data['patientNumber'] = r.get('patientNumber')
+        req_data['attenderName'] = r.get('attenderName')
+        req_data['attenderNumber'] = r.get('attenderNumber')
+        req_data['hospitalName'] = r.get('hospitalName', 'Unknown Hospital')
+        req_data['location'] = r.get('location', 'Unknown Location')
+        req_data['bloodGroup'] = r.get('bloodGroup')
+        req_data['units'] = r.get('units', 1)
+        req_data['urgency'] = r.get('urgency', 'Moderate')
+        req_data['requiredTime'] = r.get('requiredTime')
+        req_data['requesterName'] = r.get('requesterName', 'Anonymous')
+        
+        feed.append(req_data)
+    return feed
+
 class ActiveRequestsView(APIView):
     def get(self, request):
         db = get_db()
@@ -1137,86 +977,19 @@ class ActiveRequestsView(APIView):
             except:
                 pass
             
-        params = {"status": "Active"}
-        
-        requests = list(db.requests.find(params).sort("createdAt", -1))
-        
-        valid_requests = []
-        now = datetime.datetime.now(datetime.timezone.utc)
+        # Strict Blood Group Match: the feed is shared per group (all groups without a user)
+        feed_group = user.get('bloodGroup') if user else None # type: ignore
+        feed = active_requests_flight.do(singleflight_key(feed_group), lambda: active_request_feed(db, feed_group))
         
-        for r in requests:
-            # 0. Check Ignored
-            if str(r['_id']) in ignored_ids: # type: ignore
-                continue
-            # Check Expiry if exists
-            if r.get('expiresAt'):
-                 try:
-                     # Handle formats (ISO with/without Z)
-                     exp_str = str(r['expiresAt']).replace('Z', '')
-                     exp_date = datetime.datetime.fromisoformat(exp_str)
-                     if exp_date.tzinfo is None: exp_date = exp_date.replace(tzinfo=datetime.timezone.utc)
-                     
-                     if exp_date < now:
-                         continue # Expired
-                 except:
-                     pass # If bad date, ignore expiry check or safe fail
-            
-            # 2. Strict Blood Group Match
-            if user and user.get('bloodGroup'): # type: ignore
-                if r.get('bloodGroup') != user['bloodGroup']: # type: ignore
-                    continue
-
-            # Populate Requester Details (name, all form fields)
-            requester_id = r.get('requesterId') or r.get('hospitalId')
-            if requester_id:
-                 try:
-                    requester = db.users.find_one({"_id": ObjectId(requester_id)})
-                    if requester:
-                        r['requesterName'] = requester.get('name', 'Anonymous')
-                        r['requesterPhone'] = requester.get('phone')
-                        r['requesterBloodGroup'] = requester.get('bloodGroup')
-                        
-                        # If hospitalName not provided, use requester's location
-                        if not r.get('hospitalName'):
-                            r['hospitalName'] = r.get('hospitalName', 'Unknown Hospital')
-                        if not r.get('location'):
-                            r['location'] = requester.get('location', 'Unknown Location')
-                    else:
-                        r['requesterName'] = "Unknown Requester"
-                 except:
-                    r['requesterName'] = "Unknown Requester"
-            
-            # Ensure all form fields are present (patient details, attender, etc.)
-            req_data = serialize_doc(r)
-            req_data['patientName'] = r.get('patientName', 'N/A')
-            req_data['patientNumber'] = r.get('patientNumber')
-            req_data['attenderName'] = r.get('attenderName')
-            req_data['attenderNumber'] = r.get('attenderNumber')
-            req_data['hospitalName'] = r.get('hospitalName', 'Unknown Hospital')
-            req_data['location'] = r.get('location', 'Unknown Location')
-            req_data['bloodGroup'] = r.get('bloodGroup')
-            req_data['units'] = r.get('units', 1)
-            req_data['urgency'] = r.get('urgency', 'Moderate')
-            req_data['requiredTime'] = r.get('requiredTime')
-            req_data['requesterName'] = r.get('requesterName', 'Anonymous')
-            
-            valid_requests.append(req_data)
-            
+        # Check Ignored (per caller)
+        valid_requests = [req_data for req_data in feed if req_data['id'] not in ignored_ids]
         return Response(valid_requests)
 
 class HospitalListView(APIView):
     def get(self, request):
         db = get_db()
-        cursor = db.users.find({"role": "hospital"})
-        hospitals = []
-        for h in cursor:
-            hospitals.append({
-                "id": str(h['_id']),
-                "name": h.get('name'),
-                "location": h.get('location'),
-                "phone": h.get('phone')
-            })
-        return Response(hospitals)
+        # Cached until a hospital registers / updates its profile (api/cache.py)
+        return Response(hospital_list(db))
 
 class HospitalAppointmentsView(APIView):
     def get(self, request):
@@ -1287,58 +1060,48 @@ class HospitalAppointmentsView(APIView):
                 
                 if bg:
                     # 1. Update Inventory Count
-                    db.inventory.update_one(
-                        {"hospitalId": hospital_id},
-                        {"$inc": {bg: units}},
-                        upsert=True
-                    )
+                    adjust_stock(db, hospital_id, bg, units, source='donation', request_id=appt_id, actor=donor_id)
                     
                     # 2. AUTO-CREATE BATCH (Physical Stock)
                     try:
-                        batch_data = {
-                            "hospitalId": hospital_id,
-                            "bloodGroup": bg,
-                            "componentType": "Whole Blood", # Default from donation
-                            "units": units,
-                            "collectedDate": datetime.datetime.now().isoformat(),
-                            "expiryDate": (datetime.datetime.now() + datetime.timedelta(days=35)).isoformat(), # Default 35 days
-                            "sourceType": "Donation",
-                            "sourceName": donor.get('name') if donor else "Walk-in Donor",
-                            "donorDetails": {
-                                "donorId": str(donor['_id']) if donor else None,
-                                "name": donor.get('name') if donor else "Walk-in",
-                                "email": donor.get('email') if donor else None,
-                                "phone": donor.get('phone') if donor else None,
-                            },
-                            "location": "In-House",
-                            "createdAt": datetime.datetime.now().isoformat(),
-                            "status": "Active"
-                        }
+                        batch_data = donation_batch(hospital_id, bg, units, donor)
                         db.batches.insert_one(batch_data)
                     except Exception as e:
                         print(f"Failed to auto-create batch for appointment: {e}")
 
                 # Update Donor's Stats (Cached on User Profile)
                 if donor_id:
-                     # Determine donation type from appointment type
-                     appt_type = appt.get('type', 'Voluntary')
-                     donation_type = "Hospital Request" if "Emergency" in appt_type else "Voluntary"
-                     
-                     db.users.update_one(
-                        {"_id": ObjectId(donor_id)},
-                        {
-                            "$set": {
-                                "lastDonationDate": datetime.datetime.now().isoformat(),
-                                "lastDonationType": donation_type
-                            },
-                            "$inc": {"totalDonations": 1}
-                        }
-                     )
+                     record_donation(db, donor_id, donation_type(appt))
         
         return Response({"success": True})
                     
 
 
+class HospitalAppointmentsBulkView(APIView):
+    """
+    Close out a donation session: complete, reject or cancel many
+    appointments in one call.
+    POST {"hospitalId", "ids": [...], "status": "Completed"|"Rejected"|"Cancelled", "reason"?}
+    """
+    def post(self, request):
+        db = get_db()
+        data = request.data
+        hospital_id = data.get('hospitalId')
+        ids = data.get('ids')
+        new_status = data.get('status')
+        
+        if not hospital_id or not isinstance(ids, list) or not ids:
+            return Response({"error": "hospitalId and ids required"}, status=400)
+        if new_status not in BULK_STATUSES:
+            return Response({"error": f"status must be one of {', '.join(BULK_STATUSES)}"}, status=400)
+        if len(ids) > MAX_BULK_APPOINTMENTS:
+            return Response({"error": f"At most {MAX_BULK_APPOINTMENTS} appointments per request"}, status=400)
+        
+        result = transition_appointments(db, hospital_id, ids, new_status, data.get('reason'))
+        result['success'] = not result['errors']
+        return Response(result)
+
+
 # Admin-related views removed - admin role no longer exists in the application
 
 class NotificationView(APIView):
@@ -1350,7 +1113,14 @@ class NotificationView(APIView):
             return Response({"error": "userId required"}, status=400)
             
         cursor = db.notifications.find({"recipientId": user_id}).sort("timestamp", -1)
-        return Response([serialize_doc(n) for n in cursor])
+        items = [serialize_doc(n) for n in cursor]
+        
+        # Merge shared broadcasts (fan-out on read) with personal notifications
+        broadcast_items = broadcasts_for_user(db, user_id)
+        if broadcast_items:
+            items.extend(broadcast_items)
+            items.sort(key=lambda n: n.get('timestamp') or '', reverse=True)
+        return Response(items)
 
     def post(self, request):
         """Create notifications (System sending to users)"""
@@ -1361,7 +1131,7 @@ class NotificationView(APIView):
              return Response({"error": "Invalid data format"}, status=400)
              
         # Insert all
-        db.notifications.insert_many(data)
+        record_notifications(db, data)
         return Response({"success": True, "count": len(data)})
 
     def put(self, request):
@@ -1369,79 +1139,89 @@ class NotificationView(APIView):
         db = get_db()
         notif_id = request.data.get('id')
         notif_status = request.data.get('status')
-        
-        # 1. Update Notification
-        result = db.notifications.find_one_and_update(
-            {"_id": ObjectId(notif_id)},
-            {"$set": {"status": notif_status}},
-            return_document=True
-        )
-        
+
+        # 1. Update Notification (personal doc, or per-user state of a broadcast)
+        broadcast_ref = parse_broadcast_item_id(notif_id)
+        if broadcast_ref:
+            return self.put_broadcast(request, *broadcast_ref)
+        result = update_notification_status(db, notif_id, notif_status)
+        return self.apply_status(db, request, result, notif_id)
+
+    @authenticate_request
+    def put_broadcast(self, request, broadcast_id, item_user_id):
+        """
+        Broadcast state is per user: the user comes from the token, never
+        from the item id, and must be in the broadcast's audience.
+        """
+        db = get_db()
+        if item_user_id != request.user_id:
+            return Response({"error": "Notification belongs to another user"}, status=status.HTTP_403_FORBIDDEN)
+        broadcast = visible_broadcast(db, request.user_data, broadcast_id)
+        if not broadcast:
+            return Response({"error": "Notification not found"}, status=404)
+        set_broadcast_state(db, request.user_id, broadcast_id, request.data.get('status'))
+        result = {
+            "relatedRequestId": broadcast.get('relatedRequestId'),
+            "recipientId": request.user_id
+        }
+        return self.apply_status(db, request, result, request.data.get('id'), is_broadcast=True)
+
+    def apply_status(self, db, request, result, notif_id, is_broadcast=False):
+        notif_status = request.data.get('status')
+
         # 2. If Accepted, update the original Request/Alert
         if notif_status == 'ACCEPTED' and result and result.get('relatedRequestId'):
             req_id = result.get('relatedRequestId')
             recipient_id = result.get('recipientId') # The donor
             
-            # Check if request is still active/pending
-            # We update it to 'Accepted' and assign the donor
-            original_req = db.requests.find_one({"_id": ObjectId(req_id)})
+            # NOTIFY REQUESTER (Hospital): queued with the acceptance
+            def response_events(accepted):
+                requester_id = accepted.get('requesterId') or accepted.get('hospitalId')
+                if not requester_id:
+                    return []
+                title = "Donor Responded!"
+                body = "{actor} is on their way for your emergency request!"
+                return [notify_event(
+                    requester_id, "DONOR_RESPONSE", title, body,
+                    related_request_id=req_id, actor_id=recipient_id, actor_fallback="A Donor",
+                    push={"title": title, "body": body, "data": {"type": "DONOR_RESPONSE", "requestId": req_id}}
+                )]
+
+            # SAFETY CHECK: only an Active, unassigned request can be accepted, in one guarded write
+            original_req = transition_with_events(
+                db, req_id, 'Accepted', response_events, from_statuses=['Active'], unaccepted=True,
+                set_fields={"acceptedBy": recipient_id, "acceptedAt": datetime.datetime.now().isoformat()}
+            )
+            if original_req is None:
+                _message, _code, current = explain_failure(db, req_id, 'Accepted')
+                if current:
+                    if current.get('acceptedBy'):
+                        return Response({"error": "Request already accepted"}, status=status.HTTP_409_CONFLICT)
+                    return Response({"error": "Request is no longer active"}, status=status.HTTP_409_CONFLICT)
             
             if original_req:
-                # SAFETY CHECK: Only accept valid, active requests
-                if original_req.get('status') != 'Active':
-                     return Response({"error": "Request is no longer active"}, status=status.HTTP_409_CONFLICT)
-                
-                # Double Check AcceptedBy
-                if original_req.get('acceptedBy'):
-                     return Response({"error": "Request already accepted"}, status=status.HTTP_409_CONFLICT)
-
-                db.requests.update_one(
-                    {"_id": ObjectId(req_id)},
-                    {
-                        "$set": {
-                            "status": "Accepted",
-                            "acceptedBy": recipient_id,
-                            "acceptedAt": datetime.datetime.now().isoformat()
-                        }
-                    }
-                )
-                
-                # NOTIFY REQUESTER (Hospital)
-                requester_id = original_req.get('requesterId') or original_req.get('hospitalId')
-                if requester_id:
-                    requester = db.users.find_one({"_id": ObjectId(requester_id)})
-                    if requester:
-                        # Get Donor Name
-                        donor = db.users.find_one({"_id": ObjectId(recipient_id)})
-                        donor_name = donor.get('name') if donor else "A Donor"
-                        
-                        title = "Donor Responded!"
-                        body = f"{donor_name} is on their way for your emergency request!"
-                        
-                        # DB Notification
-                        db.notifications.insert_one({
-                            "recipientId": str(requester['_id']),
-                            "title": title,
-                            "message": body,
-                            "type": "DONOR_RESPONSE",
-                            "relatedRequestId": req_id,
-                            "status": "UNREAD",
-                            "timestamp": datetime.datetime.now().isoformat()
-                        })
-                        
-                        # FCM Push
-                        if requester.get('fcmToken'):
-                             send_push_multicast([requester['fcmToken']], title, body, {"type": "DONOR_RESPONSE", "requestId": req_id})
+                invalidate_reports(db, [recipient_id])
             
-            # 3. Mutual Exclusion: Delete all other notifications for this request
-            # So other donors don't see it anymore
-            db.notifications.delete_many({
-                "relatedRequestId": req_id,
-                "_id": {"$ne": ObjectId(notif_id)}
-            })
+            # 3. Mutual Exclusion: Close the broadcast (one write) so other donors don't see it anymore.
+            # Legacy per-donor rows (created before broadcasts) are still cleaned up.
+            close_broadcasts(db, req_id)
+            legacy_filter: dict[str, Any] = {"relatedRequestId": req_id}
+            if not is_broadcast:
+                legacy_filter["_id"] = {"$ne": ObjectId(notif_id)}
+            delete_notifications(db, legacy_filter)
             
         return Response({"success": True})
 
+class NotificationUnreadCountView(APIView):
+    def get(self, request):
+        """Badge count without fetching the notification list"""
+        db = get_db()
+        user_id = request.query_params.get('userId')
+        if not user_id:
+            return Response({"error": "userId required"}, status=400)
+            
+        return Response({"count": unread_count(db, user_id)})
+
 class AlertResponseView(APIView):
     def post(self, request):
         db = get_db()
@@ -1454,26 +1234,21 @@ class AlertResponseView(APIView):
             return Response({"error": "Missing data"}, status=400)
             
         if alert_status == 'Accepted':
-            # 1. Fetch Request to check current status
-            req = db.requests.find_one({"_id": ObjectId(alert_id)})
-            if not req:
-                 return Response({"error": "Request not found"}, status=404)
-            
-            # 2. Concurrency Check
-            if req.get('acceptedBy') and req.get('acceptedBy') != donor_id:
-                 return Response({"error": "This request has already been accepted by another donor."}, status=status.HTTP_409_CONFLICT)
-
-            # 3. Update request status and assign donor
-            db.requests.update_one(
-                {"_id": ObjectId(alert_id)},
-                {
-                    "$set": {
-                        "status": "Accepted",
-                        "acceptedBy": donor_id,
-                        "acceptedAt": datetime.datetime.now().isoformat()
-                    }
-                }
+            # 1. Accept and assign the donor in one guarded write (open request, not someone else's)
+            req = transition(
+                db, alert_id, 'Accepted', acceptor=donor_id,
+                set_fields={"acceptedBy": donor_id, "acceptedAt": datetime.datetime.now().isoformat()}
             )
+            if req is None:
+                message, code, current = explain_failure(db, alert_id, 'Accepted', donor_id)
+                if not current:
+                    return Response({"error": message}, status=code)
+                # 2. Concurrency Check
+                if current.get('acceptedBy') and current.get('acceptedBy') != donor_id:
+                    return Response({"error": "This request has already been accepted by another donor."}, status=status.HTTP_409_CONFLICT)
+                if current.get('status') == 'Accepted':
+                    return Response({"success": True}) # repeat of this donor's own acceptance
+                return Response({"error": message}, status=code)
             
             # 4. AUTO-BOOK APPOINTMENT
             # If a donor accepts an emergency, book them in immediately as 'Scheduled'.
@@ -1518,11 +1293,8 @@ class AlertResponseView(APIView):
 class ActiveLocationsView(APIView):
     def get(self, request):
         db = get_db()
-        # Get unique locations from donors
-        locations = db.users.find({"role": "donor"}).distinct("location")
-        # Filter out None/Empty
-        valid_locations = [loc for loc in locations if loc]
-        return Response(valid_locations)
+        # Unique non-empty donor cities, cached until a donor registers / moves (api/cache.py)
+        return Response(donor_locations(db))
 
 class LocationCountView(APIView):
     def get(self, request):
@@ -1539,30 +1311,48 @@ class LocationCountView(APIView):
             query["location"] = {"$in": cities}
             
         # Count only Eligible Donors
-        all_donors = db.users.find(query)
-        eligible_count = 0
-        now_naive = datetime.datetime.now() # Local Naive for consistency
-
-        for doc in all_donors:
-            if 'lastDonationDate' not in doc:
-                eligible_count += 1
-                continue
-                
-            last_date_str = doc['lastDonationDate']
-            try:
-                if last_date_str.endswith('Z'): last_date_str = last_date_str[:-1]
-                last_date = datetime.datetime.fromisoformat(last_date_str)
-                # Strip TZ to compare naive-to-naive
-                if last_date.tzinfo is not None: last_date = last_date.replace(tzinfo=None)
-                
-                if (now_naive - last_date).days >= 60:
-                     eligible_count += 1
-            except:
-                # If date parse fails, assume eligible (fail open for counting)
-                eligible_count += 1
+        def count_eligible():
+            all_donors = db.users.find(query, {"lastDonationDate": 1})
+            eligible_count = 0
+            now_naive = datetime.datetime.now() # Local Naive for consistency
+
+            for doc in all_donors:
+                if 'lastDonationDate' not in doc:
+                    eligible_count += 1
+                    continue
+                    
+                last_date_str = doc['lastDonationDate']
+                try:
+                    if last_date_str.endswith('Z'): last_date_str = last_date_str[:-1]
+                    last_date = datetime.datetime.fromisoformat(last_date_str)
+                    # Strip TZ to compare naive-to-naive
+                    if last_date.tzinfo is not None: last_date = last_date.replace(tzinfo=None)
+                    
+                    if (now_naive - last_date).days >= 60:
+                         eligible_count += 1
+                except:
+                    # If date parse fails, assume eligible (fail open for counting)
+                    eligible_count += 1
+            return eligible_count
                 
+        # Concurrent counts for the same group / city set share one scan
+        eligible_count = location_count_flight.do(singleflight_key(blood_group, cities=cities), count_eligible)
         return Response({"count": eligible_count})
 
+class StockMapView(APIView):
+    """
+    Free stock per region (hospital city) x blood group, from the precomputed
+    regional aggregate (api/regional_stock.py).
+    GET ?region=Pune adds that region's hospitals (drill-down).
+    """
+    def get(self, request):
+        db = get_db()
+        region = request.query_params.get('region')
+        result = stock_map(db, BLOOD_GROUPS, region=region)
+        if result is None:
+            return Response({"error": f"No stock recorded for region '{region}'"}, status=404)
+        return Response(result)
+
 class HospitalDonorSearchView(APIView):
     def get(self, request):
         db = get_db()
@@ -1683,6 +1473,9 @@ class ProfileUpdateView(APIView):
                 {"_id": ObjectId(user_id)},
                 {"$set": update_fields}
             )
+            invalidate_user(user_id)
+            if 'location' in update_fields or 'name' in update_fields:
+                refresh_hospital(db, user_id) # stock map region / name (no-op for donors)
             return Response({"success": True})
         
         if not partial and not update_fields:
@@ -1710,6 +1503,7 @@ class ProfileUpdateView(APIView):
         
         # CASCADE CLEANUP:
         if result.deleted_count > 0:
+            invalidate_user(user_id)
             # 1. Cancel Active Requests by this user
             db.requests.update_many(
                 {"requesterId": user_id, "status": "Active"},
@@ -1720,13 +1514,16 @@ class ProfileUpdateView(APIView):
                 {"donorId": user_id, "status": "Pending"},
                 {"$set": {"status": "Cancelled"}}
             )
-            # 3. Delete Notifications
+            # 3. Delete Notifications (and per-user broadcast state)
             db.notifications.delete_many({"recipientId": user_id})
+            db.notification_states.delete_many({"userId": user_id})
+            db.notification_counters.delete_one({"_id": user_id})
             
             # 4. Hospital Specific Cleanup (If Hospital)
             # Remove Inventory & Batches
             db.inventory.delete_many({"hospitalId": user_id})
             db.batches.delete_many({"hospitalId": user_id})
+            refresh_hospital(db, user_id)
             
             # Cancel Appointments where they are the Host
             db.appointments.update_many(
@@ -1819,22 +1616,163 @@ class BatchView(APIView):
         data['createdAt'] = datetime.datetime.now().isoformat()
         data['units'] = units # CRITICAL: Ensure stored as INT for querying
         
-        # Ensure Expiry
+        # Ensure Expiry & Status (allocation only draws from Active batches)
         if 'expiryDate' not in data:
              data['expiryDate'] = (datetime.datetime.now() + datetime.timedelta(days=35)).isoformat()
+        data.setdefault('status', 'Active')
              
         res = db.batches.insert_one(data)
         
         # 2. Sync with Inventory (Aggregated)
-        db.inventory.update_one(
-            {"hospitalId": hospital_id},
-            {"$inc": {bg: units}},
-            upsert=True
-        )
+        adjust_stock(db, hospital_id, bg, units, data.get('componentType'), source='batch_intake', batch_id=res.inserted_id, actor=hospital_id)
         
         return Response({"success": True, "id": str(res.inserted_id)})
 
+class BatchIntakeView(APIView):
+    """
+    Register many batches at once (blood drives).
+    POST a JSON array of batches, {"hospitalId", "batches": [...]}, or an
+    NDJSON body (Content-Type: application/x-ndjson, ?hospitalId=).
+    Rows are validated individually; bad rows are reported by index and
+    the rest are still inserted.
+    """
+    def post(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        
+        if request.content_type and request.content_type.startswith('application/x-ndjson'):
+            rows = parse_ndjson(request.stream or [])
+        else:
+            data = request.data
+            if isinstance(data, dict):
+                hospital_id = data.get('hospitalId') or hospital_id
+                data = data.get('batches')
+            if not isinstance(data, list):
+                return Response({"error": "Expected a list of batches"}, status=400)
+            rows = [(row, None) for row in data]
+        
+        if not rows:
+            return Response({"error": "No batches"}, status=400)
+        if len(rows) > MAX_INTAKE_ROWS:
+            return Response({"error": f"At most {MAX_INTAKE_ROWS} batches per request"}, status=400)
+        
+        result = intake_batches(db, rows, hospital_id)
+        result['success'] = not result['errors']
+        return Response(result, status=200 if result['inserted'] else 400)
+
+class StockHoldsView(APIView):
+    """
+    Units reserved by accepted transfers that haven't been dispatched yet.
+    GET ?hospitalId=  (expired holds are released first)
+    """
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        if not hospital_id:
+            return Response({"error": "hospitalId required"}, status=400)
+        
+        expire_holds(db, hospital_id)
+        holds = list_holds(db, hospital_id)
+        return Response({
+            "totalHeld": sum(h['units'] for h in holds),
+            "holds": holds
+        })
+
+def parse_query_datetime(value):
+    """ISO-8601 query param -> aware UTC datetime (naive values are server local time)"""
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(datetime.timezone.utc)
+
+class InventoryHistoryView(APIView):
+    """
+    Ledger of stock movements, newest first.
+    GET ?hospitalId=&bloodGroup=&from=&to=&limit=
+    """
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        if not hospital_id:
+            return Response({"error": "hospitalId required"}, status=400)
+        try:
+            since = parse_query_datetime(request.query_params.get('from'))
+            until = parse_query_datetime(request.query_params.get('to'))
+            limit = min(int(request.query_params.get('limit', 100)), 500)
+        except ValueError:
+            return Response({"error": "Invalid from / to / limit"}, status=400)
+        
+        movements = movement_history(
+            db, hospital_id, request.query_params.get('bloodGroup'), since=since, until=until, limit=limit
+        )
+        return Response([serialize_doc(m) for m in movements])
+
+class InventoryAtView(APIView):
+    """
+    Stock as it was at a point in time.
+    GET ?hospitalId=&at=2026-01-31T02:00:00
+    """
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        if not hospital_id or not request.query_params.get('at'):
+            return Response({"error": "hospitalId and at required"}, status=400)
+        try:
+            when = parse_query_datetime(request.query_params.get('at'))
+        except ValueError:
+            return Response({"error": "at must be an ISO-8601 datetime"}, status=400)
+        
+        levels = stock_at(db, hospital_id, when)
+        items = []
+        for bg in BLOOD_GROUPS:
+            level = levels.get(bg, {"total": 0, "held": 0, "components": {}})
+            items.append({"type": bg, "total": level['total'], "held": level['held'], "components": level['components']})
+        return Response({"at": when.isoformat(), "items": items})
+
+class LineageLookbackView(APIView):
+    """
+    Recall lookback: the batches from a donor (or one batch), the patients
+    they were issued to and the hospitals they were transferred to,
+    following transfers downstream.
+    GET ?donorId= | ?batchId=
+    """
+    def get(self, request):
+        db = get_db()
+        donor_id = request.query_params.get('donorId')
+        batch_id = request.query_params.get('batchId')
+        if not donor_id and not batch_id:
+            return Response({"error": "donorId or batchId required"}, status=400)
+        if batch_id and not ObjectId.is_valid(batch_id):
+            return Response({"error": "Invalid batchId"}, status=400)
+        
+        return Response(lookback(db, donor_id=donor_id, batch_id=batch_id))
+
+class AllocationPlanView(APIView):
+    """
+    Dry-run of the batch allocator: which batches would supply N units,
+    without touching stock.
+    GET ?hospitalId=&bloodGroup=&units=&strategy=fifo|fefo|fefo_margin
+    """
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        blood_group = request.query_params.get('bloodGroup')
+        strategy = request.query_params.get('strategy')
+        
+        if not hospital_id or not blood_group:
+            return Response({"error": "hospitalId and bloodGroup required"}, status=400)
+        try:
+            units = int(request.query_params.get('units', 1))
+            if units < 1:
+                raise ValueError
+        except (ValueError, TypeError):
+            return Response({"error": "units must be a positive number"}, status=400)
+        if strategy and strategy not in STRATEGIES:
+            return Response({"error": f"strategy must be one of {', '.join(STRATEGIES)}"}, status=400)
+            
+        return Response(plan_allocation(db, hospital_id, blood_group, units, strategy))
+
 class BatchActionView(APIView):
+    @idempotent
     def post(self, request):
         db = get_db()
         batch_id = request.data.get('batchId')
@@ -1947,6 +1885,7 @@ class BatchActionView(APIView):
                 "bloodGroup": bg,
                 "quantity": qty,
                 "issuedAt": issue_datetime if issue_datetime else datetime.datetime.now().isoformat(),
+                "issuedOn": issued_on(issue_datetime),
                 "patientId": patient_id,
                 "referenceId": reference_id,
                 "ward": ward,
@@ -1955,13 +1894,14 @@ class BatchActionView(APIView):
                     "batchId": str(batch_id),
                     "unitsUsed": qty,
                     "collectedDate": updated_batch.get('collectedDate'),
-                    "donorId": updated_batch.get('donorId')
+                    "donorId": batch_donor_id(updated_batch)
                 }],
                 "createdAt": datetime.datetime.now().isoformat(),
                 "performedBy": hospital_id,  # Audit trail
                 "action": "use_unit"  # Action type for logging
             }
             db.outgoing_batches.insert_one(outgoing_batch)
+            record_issue(db, outgoing_batch)
         elif action == 'discard_unit':
             # Log discard action for audit trail
             discard_record = {
@@ -1970,6 +1910,7 @@ class BatchActionView(APIView):
                 "bloodGroup": bg,
                 "quantity": qty,
                 "discardedAt": datetime.datetime.now().isoformat(),
+                "issuedOn": issued_on(),
                 "batchId": str(batch_id),
                 "reason": request.data.get('reason', 'Not specified'),  # Optional reason
                 "performedBy": hospital_id,
@@ -1981,9 +1922,9 @@ class BatchActionView(APIView):
         
         # Decrement Inventory (Sync)
         if hospital_id and bg:
-             db.inventory.update_one(
-                {"hospitalId": hospital_id},
-                {"$inc": {bg: -qty}}
+             adjust_stock(
+                 db, hospital_id, bg, -qty, updated_batch.get('componentType'),
+                 source='use' if action == 'use_unit' else 'discard', batch_id=batch_id, actor=hospital_id
              )
         
         # ========== BATCH STATUS UPDATE ==========
@@ -2017,6 +1958,61 @@ class BatchActionView(APIView):
         
 
 
+class BatchBulkActionView(APIView):
+    """
+    Issue or discard units from several batches in one call.
+    POST {"hospitalId", "action": "use_unit"|"discard_unit", "strategy"?,
+          "lines": [{"batchId", "quantity"} | {"bloodGroup", "quantity", "componentType"?}],
+          "patientId"?, "referenceId"?, "ward"?, "doctorName"?, "issueDateTime"?, "reason"?}
+    All lines are validated first; any invalid line rejects the whole request.
+    """
+    @idempotent
+    def post(self, request):
+        db = get_db()
+        data = request.data
+        hospital_id = data.get('hospitalId')
+        action = data.get('action')
+        if not hospital_id:
+            return Response({"error": "hospitalId required"}, status=400)
+        
+        draws, errors, warnings = plan_bulk_action(db, hospital_id, action, data.get('lines'), data.get('strategy'))
+        if errors:
+            return Response({"error": "Invalid lines", "lines": errors}, status=400)
+        
+        applied, failed, outgoing = run_in_transaction(
+            lambda session: apply_bulk_action(db, hospital_id, action, draws, data, session=session)
+        )
+        
+        results = {}
+        for draw in draws:
+            line = results.setdefault(draw['line'], {"line": draw['line'], "success": True, "batches": []})
+            ok = draw in applied
+            line['success'] = line['success'] and ok
+            line['batches'].append({"batchId": draw['batchId'], "units": draw['units'], "applied": ok})
+        
+        response_data = {
+            "success": not failed,
+            "action": action,
+            "quantity": sum(d['units'] for d in applied),
+            "outgoingId": str(outgoing['_id']) if outgoing else None,
+            "lines": [results[i] for i in sorted(results)]
+        }
+        if warnings:
+            response_data['warnings'] = warnings
+        # 409 when a concurrent writer took units between validation and the write
+        return Response(response_data, status=200 if not failed else 409)
+
+
+class SingleFlightStatsView(APIView):
+    """
+    Request coalescing counters for this worker process: per endpoint, how many
+    calls ran a query and how many shared one already in flight.
+    """
+    @authenticate_request
+    @require_role('hospital', 'admin')
+    def get(self, request):
+        return Response(singleflight_stats())
+
 class HospitalReportsView(APIView):
     def get(self, request):
         db = get_db()
@@ -2024,78 +2020,52 @@ class HospitalReportsView(APIView):
         
         if not hospital_id:
             return Response({"error": "hospitalId required"}, status=400)
-            
-        # 1. Total Units Collected (From Batches)
-        pipeline_collected = [
-            {"$match": {"hospitalId": hospital_id}},
-            {"$group": {"_id": None, "total": {"$sum": "$units"}}}
-        ]
-        res_collected = list(db.batches.aggregate(pipeline_collected))
-        total_collected = res_collected[0]['total'] if res_collected else 0
-        
-        # 2. Total Units Dispatched (From Completed Outgoing Requests)
-        # Note: This is a simplification. Real dispatch might track specific batch usage.
-        # But we can look at "Requests Fulfilled" by this hospital.
-        pipeline_dispatched = [
-            {"$match": {
-                "hospitalId": hospital_id, # As Responder/Source
-                "type": {"$in": ["P2P", "StockTransfer", "EMERGENCY_ALERT"]}, # Outgoing types
-                "status": "Completed"
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$units"}}}
-        ]
-        # Note: In P2P, if 'hospitalId' is the TARGET (Donor), then they dispatched it.
-        # But wait, in P2P creation: 'hospitalId' is target donor. 'requesterId' is source.
-        # So if I am 'hospitalId', I received the request and fulfilled it.
-        # If I am 'requesterId', I asked for it.
-        
-        # Fixing Logic:
-        # Dispatched = requests where I was the 'acceptedBy' (Donor) OR 'hospitalId' (Target in P2P).
-        
-        # Let's count 'Batches Used' instead? 
-        # Actually simplest is to count requests where I am the provider.
-        
-        # A simpler proxy for "Dispatched" is counting how many units are NOT present compared to batches created?
-        # No, "Dispatched" usually means "Sent out".
-        
-        # Let's query requests where acceptedBy == hospitalId and status == Completed
-        pipeline_dispatched = [
-            {"$match": {
-                "acceptedBy": hospital_id, 
-                "status": "Completed"
-            }},
-            {"$group": {"_id": None, "total": {"$sum": "$units"}}}
-        ]
-        res_dispatched = list(db.requests.aggregate(pipeline_dispatched))
-        total_dispatched = res_dispatched[0]['total'] if res_dispatched else 0
-
-        # 3. Batches Expiring Soon (7 Days)
-        now = datetime.datetime.now()
-        next_week = (now + datetime.timedelta(days=7)).isoformat()
-        now_iso = now.isoformat()
-        
-        expiring_soon = db.batches.count_documents({
-            "hospitalId": hospital_id,
-            "units": {"$gt": 0},
-            "expiryDate": {"$gt": now_iso, "$lt": next_week}
-        })
+        
+        # total_units_collected, total_units_dispatched, batches_expiring_soon,
+        # emergency_requests_fulfilled (see api/reports.py; cached per hospital)
+        return Response(get_report(db, hospital_id))
 
-        # 4. Emergency Requests Fulfilled
-        emergency_count = db.requests.count_documents({
-            "acceptedBy": hospital_id,
-            "type": "EMERGENCY_ALERT",
-            "status": {"$in": ["Accepted", "Completed"]}
-        })
+class HospitalReportsTimeseriesView(APIView):
+    """
+    Collected / issued / transferred / received / discarded / expired units per period.
+    GET ?hospitalId=&from=YYYY-MM-DD&to=YYYY-MM-DD&granularity=day|week|month&bloodGroup=
+    """
+    MAX_BUCKETS = 400
 
-        report_data = {
-            "total_units_collected": total_collected,
-            "total_units_dispatched": total_dispatched,
-            "batches_expiring_soon": expiring_soon,
-            "emergency_requests_fulfilled": emergency_count
-        }
-        return Response(report_data)
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        granularity = request.query_params.get('granularity', 'day')
+        if not hospital_id:
+            return Response({"error": "hospitalId required"}, status=400)
+        if granularity not in GRANULARITIES:
+            return Response({"error": f"granularity must be one of {', '.join(GRANULARITIES)}"}, status=400)
+        
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        try:
+            end = datetime.date.fromisoformat(request.query_params.get('to') or today.isoformat())
+            start = datetime.date.fromisoformat(
+                request.query_params.get('from') or (end - datetime.timedelta(days=29)).isoformat()
+            )
+        except ValueError:
+            return Response({"error": "from / to must be YYYY-MM-DD"}, status=400)
+        if start > end:
+            return Response({"error": "from must be on or before to"}, status=400)
+        
+        days_per_bucket = {"day": 1, "week": 7, "month": 28}[granularity]
+        if ((end - start).days + 1) / days_per_bucket > self.MAX_BUCKETS:
+            return Response({"error": f"Range too large for {granularity} granularity"}, status=400)
+        
+        series = timeseries(db, hospital_id, start, end, granularity, request.query_params.get('bloodGroup'))
+        return Response({
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "granularity": granularity,
+            "series": series
+        })
 
 class BloodDispatchView(APIView):
+    @idempotent
     def post(self, request):
         db = get_db()
         data = request.data
@@ -2106,24 +2076,40 @@ class BloodDispatchView(APIView):
         if not req_id:
              return Response({"error": "Request ID required for dispatch"}, status=400)
              
-        # Fetch Request
-        req = db.requests.find_one({"_id": ObjectId(req_id)})
-        if not req:
-                return Response({"error": "Request not found"}, status=404)
-        
-        # Update Request Status
-        db.requests.update_one(
-            {"_id": ObjectId(req_id)},
-            {"$set": {
-                "status": "Dispatched",
+        # Notify Receiver: queued with the status change
+        def dispatch_events(dispatched):
+            if not dispatched.get('requesterId'):
+                return []
+            return [notify_event(
+                dispatched['requesterId'], "BLOOD_DISPATCHED", "Blood Dispatched",
+                f"{dispatched.get('units')} units of {dispatched.get('bloodGroup')} dispatched by {{actor}}. Track: {data.get('trackingId')}",
+                related_request_id=str(req_id),
+                actor_id=dispatched.get('acceptedBy') or dispatched.get('hospitalId'), # Responder
+                actor_fallback='Partner Hospital',
+                push={"title": "Blood Dispatched", "body": "Shipment incoming from {actor}",
+                      "data": {"type": "BLOOD_DISPATCHED", "requestId": str(req_id)}}
+            )]
+
+        # The reserved units leave the building now: the hold becomes batch consumption
+        # in the same transaction as the status change
+        def settle(dispatched, session):
+            settle_transfer_hold(db, dispatched, str(req_id), session=session)
+
+        # Update Request Status (only an accepted request can be dispatched, and only once)
+        req = transition_with_events(
+            db, req_id, 'Dispatched', dispatch_events, writes=settle,
+            set_fields={
                 "dispatchDetails": {
                     "mode": data.get('transportMode'),
                     "tracker": data.get('trackingId'),
                     "date": data.get('dispatchDate'),
                     "dispatchedBy": data.get('dispatchedBy')
                 }
-            }}
+            }
         )
+        if req is None:
+            message, code, _current = explain_failure(db, req_id, 'Dispatched')
+            return Response({"error": message}, status=code)
 
         # Update Existing Outgoing Batch Record (Created at Acceptance)
         # We find it by the unique requestId stored in dispatchDetails
@@ -2144,33 +2130,6 @@ class BloodDispatchView(APIView):
             # Ideally, the Clean Workflow ensures it exists.
             print(f"Warning: No outgoing batch found for Request {req_id} to update.")
         
-        # Notify Receiver
-        target_id = req.get('requesterId')
-        sender_id = req.get('acceptedBy') or req.get('hospitalId') # Responder
-        
-        sender_doc = db.users.find_one({"_id": ObjectId(sender_id)})
-        sender_name = sender_doc.get('name', 'Partner Hospital') if sender_doc else 'Partner Hospital'
-        
-        db.notifications.insert_one({
-                "recipientId": target_id,
-                "type": "BLOOD_DISPATCHED",
-                "title": "Blood Dispatched",
-                "message": f"{req.get('units')} units of {req.get('bloodGroup')} dispatched by {sender_name}. Track: {data.get('trackingId')}",
-                "relatedRequestId": str(req_id),
-                "status": "UNREAD",
-                "timestamp": datetime.datetime.now().isoformat()
-        })
-        
-        # Send Push
-        recipient_user = db.users.find_one({"_id": ObjectId(target_id)})
-        if recipient_user and recipient_user.get('fcmToken'):
-             send_push_multicast(
-                 [recipient_user['fcmToken']], 
-                 "Blood Dispatched", 
-                 f"Shipment incoming from {sender_name}",
-                 {"type": "BLOOD_DISPATCHED", "requestId": str(req_id)}
-             )
-        
         return Response({"success": True, "message": "Dispatch details updated successfully"})
 
 
@@ -2188,12 +2147,29 @@ class BloodReceiveView(APIView):
         receiver_id = data.get('hospitalId')
         units = int(data.get('units'))
         bg = data.get('bloodGroup')
+        if not bg:
+             return Response({"error": "bloodGroup required"}, status=400)
+        
+        # Create the physical batch so inventory and batches stay in step
+        batch = {
+            "hospitalId": receiver_id,
+            "bloodGroup": bg,
+            "componentType": data.get('componentType') or "Whole Blood",
+            "units": units,
+            "collectedDate": datetime.datetime.now().isoformat(),
+            "expiryDate": data.get('expiryDate') or (datetime.datetime.now() + datetime.timedelta(days=35)).isoformat(),
+            "sourceType": "Transfer",
+            "sourceName": data.get('sourceName', 'External Source'),
+            "sourceRequestId": data.get('requestId'), # lineage link to the sender's issue
+            "createdAt": datetime.datetime.now().isoformat(),
+            "status": "Active"
+        }
+        res = db.batches.insert_one(batch)
         
         # Increment Receiver Inventory
-        db.inventory.update_one(
-            {"hospitalId": receiver_id},
-            {"$inc": {bg: units}},
-            upsert=True
+        adjust_stock(
+            db, receiver_id, bg, units, batch['componentType'], source='receive',
+            batch_id=res.inserted_id, request_id=data.get('requestId'), actor=receiver_id
         )
         
         return Response({"success": True, "message": "Blood received into inventory"})
@@ -2201,28 +2177,79 @@ class BloodReceiveView(APIView):
 
 class OutgoingBatchView(APIView):
     """
-    API for viewing outgoing batch cards (patient usage and transfers)
-    GET: List outgoing batches for a hospital
+    API for viewing outgoing batch cards (patient usage, transfers and discards)
+    GET: Audit log for a hospital, newest first
+        ?hospitalId=&type=&ward=&doctorName=&patientId=&referenceId=&sourceBatchId=
+         &from=&to=&limit=&cursor=
+    The body is the list of records; when there are more, the X-Next-Cursor
+    header carries the cursor for the next page.
     """
     def get(self, request):
         db = get_db()
         hospital_id = request.query_params.get('hospitalId')
-        batch_type = request.query_params.get('type')  # Optional: 'patient_usage' or 'transfer_out'
         
         if not hospital_id:
             return Response({"error": "hospitalId required"}, status=400)
-            
-        # Build query
-        query = {"hospitalId": hospital_id}
-        if batch_type:
-            query["type"] = batch_type
-            
-        # Fetch and sort by issue date (newest first)
-        outgoing_batches = list(
-            db.outgoing_batches.find(query).sort("issuedAt", -1).limit(100)
-        )
         
-        return Response([serialize_doc(b) for b in outgoing_batches])
+        try:
+            since = parse_query_datetime(request.query_params.get('from'))
+            until = parse_query_datetime(request.query_params.get('to'))
+            limit = int(request.query_params.get('limit', 100))
+            outgoing_batches, next_cursor = query_outgoing(
+                db, hospital_id, request.query_params,
+                since=since, until=until,
+                cursor=request.query_params.get('cursor'),
+                limit=limit
+            )
+        except ValueError as e:
+            return Response({"error": f"Invalid query: {e}"}, status=400)
+        
+        response = Response([serialize_doc(b) for b in outgoing_batches])
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
+
+
+class HospitalExportView(APIView):
+    """
+    Streaming audit export (constant memory, starts sending immediately).
+    GET ?hospitalId=&dataset=outgoing_batches|batches|appointments&from=&to=&output=ndjson|csv
+    from / to are ISO dates or datetimes; a date-only `to` includes that whole day.
+    """
+    def get(self, request):
+        db = get_db()
+        hospital_id = request.query_params.get('hospitalId')
+        dataset = request.query_params.get('dataset', 'outgoing_batches')
+        output = request.query_params.get('output', 'ndjson')
+        
+        if not hospital_id:
+            return Response({"error": "hospitalId required"}, status=400)
+        if dataset not in EXPORT_DATASETS:
+            return Response({"error": f"dataset must be one of {', '.join(EXPORT_DATASETS)}"}, status=400)
+        if output not in EXPORT_FORMATS:
+            return Response({"error": f"output must be one of {', '.join(EXPORT_FORMATS)}"}, status=400)
+        
+        date_from = request.query_params.get('from')
+        date_to = request.query_params.get('to')
+        try:
+            if date_from:
+                date_from = datetime.datetime.fromisoformat(date_from).isoformat()
+            if date_to:
+                parsed_to = datetime.datetime.fromisoformat(date_to)
+                if len(date_to) == 10: # YYYY-MM-DD: up to the end of that day
+                    parsed_to += datetime.timedelta(days=1)
+                date_to = parsed_to.isoformat()
+        except ValueError:
+            return Response({"error": "from / to must be ISO dates"}, status=400)
+        
+        cursor = export_cursor(db, dataset, hospital_id, date_from, date_to)
+        response = StreamingHttpResponse(
+            stream_rows(cursor, dataset, output),
+            content_type="text/csv" if output == 'csv' else "application/x-ndjson"
+        )
+        filename = f"{dataset}-{hospital_id}.{'csv' if output == 'csv' else 'ndjson'}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
 
 
 class ForgotPasswordView(APIView):
@@ -2307,42 +2334,34 @@ class DonorIgnoreRequestView(APIView):
             {"$addToSet": {"ignoredRequests": req_id}}
         )
         
-        # 2. Track rejection in the request document
-        result = db.requests.update_one(
+        # 2. Track rejection in the request document (post-image in the same round trip)
+        req = db.requests.find_one_and_update(
             {"_id": ObjectId(req_id)},
-            {"$addToSet": {"rejectedBy": user_id}}
+            {"$addToSet": {"rejectedBy": user_id}},
+            return_document=True
         )
         
         # 3. Check if ALL notified donors have now rejected
-        req = db.requests.find_one({"_id": ObjectId(req_id)})
         if req:
             notified_count = req.get('notifiedDonorCount', 0)
             rejected_count = len(req.get('rejectedBy', []))
             
-            # If all donors rejected, update status to 'Rejected'
-            if notified_count > 0 and rejected_count >= notified_count:
-                db.requests.update_one(
-                    {"_id": ObjectId(req_id)},
-                    {"$set": {"status": "Rejected", "rejectedAt": datetime.datetime.now().isoformat()}}
-                )
+            # Notify the requester: queued with the status change
+            def rejected_events(rejected):
+                if not rejected.get('requesterId'):
+                    return []
+                return [notify_event(
+                    rejected['requesterId'], "REQUEST_REJECTED", "Request Update",
+                    "Unfortunately, no donors were available to help with your request.",
+                    related_request_id=req_id
+                )]
+
+            # If all donors rejected, update status to 'Rejected' (only the caller whose write wins notifies)
+            if notified_count > 0 and rejected_count >= notified_count and transition_with_events(
+                db, req_id, 'Rejected', rejected_events, from_statuses=OPEN_STATUSES,
+                set_fields={"rejectedAt": datetime.datetime.now().isoformat()}
+            ):
                 print(f"Request {req_id} auto-rejected: {rejected_count}/{notified_count} donors rejected")
-                
-                # Optional: Send notification to requester
-                try:
-                    requester_id = req.get('requesterId')
-                    if requester_id:
-                        db.notifications.insert_one({
-                            "recipientId": requester_id,
-                            "type": "REQUEST_REJECTED",
-                            "title": "Request Update",
-                            "message": "Unfortunately, no donors were available to help with your request.",
-                            "relatedRequestId": req_id,
-                            "timestamp": datetime.datetime.now().isoformat(),
-                            "status": "UNREAD"
-                        })
-                except Exception as e:
-                    print(f"Failed to notify requester: {e}")
-                
                 return Response({"success": True, "requestStatusChanged": True, "newStatus": "Rejected"})
         
         return Response({"success": True, "requestStatusChanged": False})
@@ -2383,6 +2402,7 @@ class DonorP2PView(APIView):
         
         return Response(result)
 
+    @idempotent
     def post(self, request):
         """Create P2P Request"""
         db = get_db()
@@ -2496,37 +2516,32 @@ class DonorP2PView(APIView):
         if not request_id or not user_id:
              return Response({"status": "error", "msg": "Missing requestId or userId"}, status=400)
 
-        # 1. Verify Ownership
-        req = db.requests.find_one({"_id": ObjectId(request_id)})
-        if not req:
-             return Response({"status": "error", "msg": "Request not found"}, status=404)
-        
-        if str(req.get('requesterId')) != str(user_id):
-             return Response({"status": "error", "msg": "Unauthorized"}, status=403)
-
-        if req.get('status') == 'Cancelled':
-             return Response({"status": "error", "msg": "Request is already cancelled"})
-             
-        # 2. Update Status
-        db.requests.update_one(
-            {"_id": ObjectId(request_id)},
-            {"$set": {"status": "Cancelled", "cancelledAt": datetime.datetime.now().isoformat()}}
+        # Notify the accepted donor (if any) that it's off: queued with the cancellation
+        def cancelled_events(cancelled):
+            if not cancelled.get('acceptedDonorId'):
+                return []
+            return [notify_event(
+                cancelled['acceptedDonorId'], "info", "Request Cancelled",
+                f"The blood request from {cancelled.get('hospitalName', 'Unknown')} has been cancelled by the requester.",
+                related_request_id=request_id
+            )]
+
+        # 1. Cancel in one guarded write, only by the requester
+        req = transition_with_events(
+            db, request_id, 'Cancelled', cancelled_events,
+            match={"requesterId": {"$in": [str(user_id), ObjectId(user_id) if ObjectId.is_valid(str(user_id)) else str(user_id)]}},
+            set_fields={"cancelledAt": datetime.datetime.now().isoformat()}
         )
-        
-        # 3. Notify Accepted Donor (if any)
-        # If someone had accepted it, they need to know it's off.
-        accepted_donor_id = req.get('acceptedDonorId')
-        if accepted_donor_id:
-            # Create a notification for the donor
-            db.notifications.insert_one({
-                "userId": accepted_donor_id,
-                "title": "Request Cancelled",
-                "message": f"The blood request from {req.get('hospitalName', 'Unknown')} has been cancelled by the requester.",
-                "type": "info",
-                "date": datetime.datetime.now().isoformat(),
-                "read": False
-            })
-            
+        if req is None:
+            message, code, current = explain_failure(db, request_id, 'Cancelled')
+            if not current:
+                 return Response({"status": "error", "msg": message}, status=code)
+            if str(current.get('requesterId')) != str(user_id):
+                 return Response({"status": "error", "msg": "Unauthorized"}, status=403)
+            if current.get('status') == 'Cancelled':
+                 return Response({"status": "error", "msg": "Request is already cancelled"})
+            return Response({"status": "error", "msg": message}, status=code)
+
         return Response({"status": "success", "msg": "Request Cancelled Successfully"})
 
 
@@ -2535,52 +2550,39 @@ class DonorP2PView(APIView):
         db = get_db()
         req_id = request.data.get('requestId')
         
-        # 1. Get the request to find accepted donor
-        p2p_request = db.requests.find_one({"_id": ObjectId(req_id)})
-        if not p2p_request:
-            return Response({"error": "Request not found"}, status=404)
-        
-        accepted_donor_id = p2p_request.get('acceptedDonorId') or p2p_request.get('acceptedBy')
-        if not accepted_donor_id:
-            return Response({"error": "No donor accepted this request"}, status=400)
-        
         now = datetime.datetime.now().isoformat()
         
-        # 2. Create donation history record for the donor
-        # 2. Add to APPOINTMENTS collection (so it shows in History/Stats)
-        donation_record = {
-            "donorId": str(accepted_donor_id), # Ensure String for query matching
-            "hospitalId": str(p2p_request.get('requesterId')),
-            "bloodGroup": p2p_request.get('bloodGroup'),
-            "units": int(p2p_request.get('units', 1)),
-            "date": now,
-            "status": "Completed", 
-            "type": "P2P Donation",
-            "center": p2p_request.get('location') or p2p_request.get('hospitalName') or "P2P Request",
-            "requestId": req_id
-        }
-        db.appointments.insert_one(donation_record)
-        
-        # 3. Update donor stats
-        donor = db.users.find_one({"_id": ObjectId(accepted_donor_id)})
-        if donor:
-            current_total = donor.get('totalDonations', 0)
-            db.users.update_one(
-                {"_id": ObjectId(accepted_donor_id)},
-                {
-                    "$set": {
-                        "totalDonations": current_total + 1,
-                        "lastDonationDate": now,
-                        "lastDonationType": "P2P"
-                    }
-                }
-            )
-        
-        # 4. Mark request as completed
-        db.requests.update_one(
-             {"_id": ObjectId(req_id)},
-             {"$set": {"status": "Completed", "completedAt": now}}
+        # 2. Donation history record + stats for the donor, queued with the completion
+        # (added to APPOINTMENTS so it shows in History/Stats)
+        def donation_events(completed):
+            accepted_donor_id = completed.get('acceptedDonorId') or completed.get('acceptedBy')
+            return [("donation_recorded", {
+                "record": {
+                    "donorId": str(accepted_donor_id), # Ensure String for query matching
+                    "hospitalId": str(completed.get('requesterId')),
+                    "bloodGroup": completed.get('bloodGroup'),
+                    "units": int(completed.get('units', 1)),
+                    "date": now,
+                    "status": "Completed",
+                    "type": "P2P Donation",
+                    "center": completed.get('location') or completed.get('hospitalName') or "P2P Request",
+                    "requestId": req_id
+                },
+                "statsType": "P2P"
+            })]
+
+        # 1. Complete in one guarded write; only an accepted request can be, and only once
+        p2p_request = transition_with_events(
+            db, req_id, 'Completed', donation_events, from_statuses=['Accepted', 'Dispatched'],
+            set_fields={"completedAt": now}
         )
+        if p2p_request is None:
+            message, code, current = explain_failure(db, req_id, 'Completed')
+            if current and not (current.get('acceptedDonorId') or current.get('acceptedBy')):
+                return Response({"error": "No donor accepted this request"}, status=400)
+            return Response({"error": message}, status=code)
+        
+        accepted_donor_id = p2p_request.get('acceptedDonorId') or p2p_request.get('acceptedBy')
         
         return Response({"success": True, "donorId": accepted_donor_id, "donationCreated": True})
 
@@ -2596,6 +2598,7 @@ class DonorProfileView(APIView):
 
 class AcceptRequestView(APIView):
     """Endpoint for donor to accept a P2P request"""
+    @idempotent
     def post(self, request):
         db = get_db()
         user_id = request.data.get('userId')  # Donor accepting
@@ -2604,66 +2607,43 @@ class AcceptRequestView(APIView):
         if not user_id or not req_id:
             return Response({"error": "userId and requestId required"}, status=400)
         
-        # Get the request
         try:
-            req = db.requests.find_one({"_id": ObjectId(req_id)})
-            if not req:
-                return Response({"error": "Request not found"}, status=404)
-            
-            # Check if already accepted by someone else
-            if req.get('acceptedDonorId'):
-                return Response({"error": "Request already accepted by another donor"}, status=409)
-            
             # Get donor details
             donor = db.users.find_one({"_id": ObjectId(user_id)})
             if not donor:
                 return Response({"error": "Donor not found"}, status=404)
             
-            # Update request with standardized 'acceptedBy'
-            db.requests.update_one(
-                {"_id": ObjectId(req_id)},
-                {"$set": {
-                    "status": "Accepted",
+            # Notify requester: queued with the acceptance
+            def acceptance_events(accepted):
+                if not accepted.get('requesterId'):
+                    return []
+                return [notify_event(
+                    accepted['requesterId'], "REQUEST_ACCEPTED", "Great News!",
+                    f"{donor.get('name', 'A donor')} has accepted your blood request!",
+                    related_request_id=req_id,
+                    push={"title": "Request Accepted!",
+                          "body": f"{donor.get('name', 'A donor')} will help with your blood request.",
+                          "data": {"type": "REQUEST_ACCEPTED", "requestId": req_id}}
+                )]
+
+            # Accept in one guarded write: open request, not already taken by another donor
+            req = transition_with_events(
+                db, req_id, 'Accepted', acceptance_events, unaccepted=True,
+                set_fields={
                     "acceptedDonorId": user_id,
                     "acceptedBy": user_id, # Standardization for legacy compatibility
                     "acceptedAt": datetime.datetime.now().isoformat()
-                }}
+                }
             )
+            if req is None:
+                message, code, current = explain_failure(db, req_id, 'Accepted')
+                if current and (current.get('acceptedDonorId') or current.get('acceptedBy')):
+                    return Response({"error": "Request already accepted by another donor"}, status=409)
+                return Response({"error": message}, status=code)
             
             # 2. Mark the notification for this donor as READ so it doesn't show in dashboard popup
-            db.notifications.update_many(
-                {
-                    "recipientId": user_id,
-                    "relatedRequestId": req_id
-                },
-                {"$set": {"status": "READ"}}
-            )
-            
-            # Notify requester
-            requester_id = req.get('requesterId')
-            if requester_id:
-                try:
-                    db.notifications.insert_one({
-                        "recipientId": requester_id,
-                        "type": "REQUEST_ACCEPTED",
-                        "title": "Great News!",
-                        "message": f"{donor.get('name', 'A donor')} has accepted your blood request!",
-                        "relatedRequestId": req_id,
-                        "timestamp": datetime.datetime.now().isoformat(),
-                        "status": "UNREAD"
-                    })
-                    
-                    # Send push notification to requester
-                    requester = db.users.find_one({"_id": ObjectId(requester_id)})
-                    if requester and requester.get('fcmToken'):
-                        send_push_multicast(
-                            [requester['fcmToken']],
-                            "Request Accepted!",
-                            f"{donor.get('name', 'A donor')} will help with your blood request.",
-                            {"type": "REQUEST_ACCEPTED", "requestId": req_id}
-                        )
-                except Exception as e:
-                    print(f"Failed to notify requester: {e}")
+            mark_notifications_read(db, user_id, req_id)
+            mark_request_broadcasts(db, user_id, req_id, "READ")
             
             return Response({
                 "success": True,
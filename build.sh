@@ -6,3 +6,9 @@ pip install -r requirements.txt
 
 python manage.py collectstatic --no-input
 python manage.py migrate
+python scripts/migrate_inventory_documents.py
+python scripts/backfill_outgoing_issued_on.py
+python scripts/rebuild_regional_stock.py --if-empty
+python scripts/rebuild_donor_stats.py
+python scripts/migrate_notification_schema.py
+python scripts/ensure_indexes.py
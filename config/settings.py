@@ -15,6 +15,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 load_dotenv()
 
@@ -132,7 +133,55 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 CORS_ALLOW_ALL_ORIGINS = True 
 CORS_ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:5173').split(',') if origin.strip()]
 CSRF_TRUSTED_ORIGINS = CORS_ALLOWED_ORIGINS # Allow CSRF for the same origins (Django 4.0+)
+CORS_EXPOSE_HEADERS = [
+    'X-Next-Cursor', # Keyset paging cursor (outgoing batch audit log)
+    'Idempotent-Replayed', # Set on responses replayed for a repeated Idempotency-Key
+]
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 # MongoDB Configuration
 MONGO_URI = os.getenv('MONGO_URI', "mongodb://localhost:27017/")
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', "blood_donation_db")
+
+# Notifications: read / acted-on notifications are purged by a TTL index after this many days
+NOTIFICATION_RETENTION_DAYS = int(os.getenv('NOTIFICATION_RETENTION_DAYS', '30'))
+
+# Batch allocation strategy: 'fifo', 'fefo' or 'fefo_margin' (see api/allocation.py)
+BATCH_ALLOCATION_STRATEGY = os.getenv('BATCH_ALLOCATION_STRATEGY', 'fefo')
+# fefo_margin skips batches expiring within this many hours
+BATCH_EXPIRY_SAFETY_HOURS = int(os.getenv('BATCH_EXPIRY_SAFETY_HOURS', '24'))
+
+# Stock reserved by an accepted transfer is released if not dispatched within this many hours
+STOCK_HOLD_TTL_HOURS = int(os.getenv('STOCK_HOLD_TTL_HOURS', '48'))
+
+# Hospital report snapshots are recomputed at most this often (also invalidated on stock / request changes)
+REPORT_SNAPSHOT_TTL_SECONDS = int(os.getenv('REPORT_SNAPSHOT_TTL_SECONDS', '300'))
+
+# Streaming exports fetch this many documents per cursor round trip
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# Outbox (api/outbox.py): request side effects are applied by this many worker threads in the web
+# process (0 = leave them to scripts/outbox_worker.py), leased per event, retried with backoff
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '2'))
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# Seconds between in-process sweeps for retries that backed off (0 = only on kick / outbox_worker.py)
+OUTBOX_POLL_SECONDS = int(os.getenv('OUTBOX_POLL_SECONDS', '30'))
+# Applied events are purged by a TTL index after this many days
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+
+# Idempotency-Key (api/idempotency.py): first responses are replayed for retries for this many hours
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+# A claimed key whose request hasn't finished after this many seconds can be taken over by a retry
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))
+
+# Shared cache (api/cache.py): 'local' (in-process LRU) or 'redis' (any Redis-protocol server, needs `redis`)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+# Upper bound on staleness for anything a write path doesn't invalidate (and, with the local
+# backend, for invalidations made by other worker processes)
+CACHE_DEFAULT_TTL_SECONDS = int(os.getenv('CACHE_DEFAULT_TTL_SECONDS', '60'))
+# Hospital search results are cached per blood group / minimum units for at most this long
+# (invalidated earlier whenever stock of the group moves)
+HOSPITAL_SEARCH_CACHE_TTL_SECONDS = int(os.getenv('HOSPITAL_SEARCH_CACHE_TTL_SECONDS', '30'))
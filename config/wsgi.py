@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Periodic outbox sweep in each web worker (api/outbox.py)
+from api.outbox import start_poller  # noqa: E402
+
+start_poller()
@@ -0,0 +1,41 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/backfill_lineage.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.lineage import LINEAGE_TYPES, record_issue
+
+
+def backfill_lineage(db):
+    """
+    Index patient issues and transfers recorded before the lineage
+    collection existed. record_issue upserts, so it is safe to re-run.
+    Received batches created before sourceRequestId was stored cannot be
+    linked downstream; their lookback stops at the transfer row.
+    """
+    count = 0
+    cursor = db.outgoing_batches.find(
+        {
+            "type": {"$in": list(LINEAGE_TYPES)},
+            "sourceBatchIds.0": {"$exists": True},
+            "status": {"$ne": "Cancelled"}
+        }
+    ).batch_size(500)
+    for outgoing in cursor:
+        record_issue(db, outgoing)
+        count += 1
+    print(f"Indexed lineage for {count} outgoing record(s)")
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Backfilling Lineage ---")
+    backfill_lineage(db)
+    print("--- Backfill Complete ---")
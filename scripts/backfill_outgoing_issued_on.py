@@ -0,0 +1,35 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/backfill_outgoing_issued_on.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+
+
+def backfill_issued_on(db):
+    """
+    Give outgoing records created before the audit API a native issuedOn
+    date, parsed server-side from issuedAt / discardedAt, else createdAt.
+    Only touches records without one, so it is safe to re-run.
+    """
+    def parsed(field, fallback):
+        return {"$dateFromString": {"dateString": f"${field}", "onError": fallback, "onNull": fallback}}
+
+    result = db.outgoing_batches.update_many(
+        {"issuedOn": {"$exists": False}},
+        [{"$set": {"issuedOn": parsed("issuedAt", parsed("discardedAt", parsed("createdAt", "$$NOW")))}}]
+    )
+    print(f"Backfilled issuedOn on {result.modified_count} outgoing record(s)")
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Backfilling Outgoing Batch issuedOn ---")
+    backfill_issued_on(db)
+    print("--- Backfill Complete ---")
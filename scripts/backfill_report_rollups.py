@@ -0,0 +1,108 @@
+"""
+Rebuild db.report_rollups.
+
+History since the inventory ledger was introduced is replayed from the
+ledger (exactly what the live write paths record). Older days are derived
+from the raw collections:
+
+    collected / received  batches by createdAt (sourceType Transfer = received)
+    issued                outgoing_batches type patient_usage, by issuedAt
+    transferredOut        outgoing_batches type transfer (not cancelled), by issuedAt
+    discarded             outgoing_batches type discard, by discardedAt
+
+Pre-ledger batch quantities are their remaining units (the original amount
+wasn't recorded), and pre-ledger expiries can't be recovered because the
+expiry sync zeroed units without a record.
+
+    python scripts/backfill_report_rollups.py [--hospital <id>]
+"""
+import os
+import sys
+import argparse
+import django
+
+# Allow running as `python scripts/backfill_report_rollups.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.rollups import apply_increments, rollup_increments
+
+
+def raw_increments(db, match, before_iso):
+    """Increments for days before the ledger from batches / outgoing_batches"""
+    increments = {}
+
+    def add(rows, counter):
+        for row in rows:
+            key = (row['_id']['hospitalId'], row['_id']['day'], row['_id']['bloodGroup'])
+            if all(key):
+                counters = increments.setdefault(key, {})
+                counters[counter] = counters.get(counter, 0) + row['units']
+
+    def grouped(collection, extra_match, date_field, units_field):
+        return collection.aggregate([
+            {"$match": {**match, **extra_match, date_field: {"$lt": before_iso}}},
+            {"$group": {
+                "_id": {
+                    "hospitalId": "$hospitalId",
+                    "day": {"$substrBytes": [f"${date_field}", 0, 10]},
+                    "bloodGroup": "$bloodGroup"
+                },
+                "units": {"$sum": f"${units_field}"}
+            }}
+        ], allowDiskUse=True)
+
+    add(grouped(db.batches, {"sourceType": {"$ne": "Transfer"}}, "createdAt", "units"), 'collected')
+    add(grouped(db.batches, {"sourceType": "Transfer"}, "createdAt", "units"), 'received')
+    add(grouped(db.outgoing_batches, {"type": "patient_usage"}, "issuedAt", "quantity"), 'issued')
+    add(grouped(db.outgoing_batches, {"type": "transfer", "status": {"$ne": "Cancelled"}}, "issuedAt", "quantity"), 'transferredOut')
+    add(grouped(db.outgoing_batches, {"type": "discard"}, "discardedAt", "quantity"), 'discarded')
+    return increments
+
+
+def ledger_increments(db, match):
+    """Replay the ledger in chunks through the same mapping the live path uses"""
+    increments = {}
+    chunk = []
+    for entry in db.inventory_ledger.find(match, {"hospitalId": 1, "bloodGroup": 1, "source": 1, "delta": 1, "heldDelta": 1, "at": 1}).batch_size(5000):
+        chunk.append(entry)
+        if len(chunk) >= 5000:
+            _merge(increments, rollup_increments(chunk))
+            chunk = []
+    _merge(increments, rollup_increments(chunk))
+    return increments
+
+
+def _merge(into, increments):
+    for key, counters in increments.items():
+        target = into.setdefault(key, {})
+        for counter, n in counters.items():
+            target[counter] = target.get(counter, 0) + n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild daily report rollups")
+    parser.add_argument('--hospital', help="rebuild a single hospital")
+    opts = parser.parse_args()
+
+    db = get_db()
+    match = {"hospitalId": opts.hospital} if opts.hospital else {}
+
+    first = db.inventory_ledger.find_one(match, sort=[("at", 1)])
+    ledger_start = first['at'].isoformat() if first else "9999"
+    print(f"--- Rebuilding report rollups (ledger from {ledger_start[:19] if first else 'n/a'}) ---")
+
+    increments = raw_increments(db, match, ledger_start)
+    _merge(increments, ledger_increments(db, match))
+
+    db.report_rollups.delete_many(match)
+    apply_increments(db, increments)
+    print(f"--- Wrote {len(increments)} rollup document(s) ---")
+
+
+if __name__ == "__main__":
+    main()
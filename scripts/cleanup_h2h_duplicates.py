@@ -2,25 +2,22 @@
 import os
 import sys
 import datetime
-from pymongo import MongoClient
+import django
 from bson.objectid import ObjectId
-from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
+# Allow running as `python scripts/cleanup_h2h_duplicates.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# Configuration
-MONGO_URI = os.getenv('MONGO_URI', "mongodb://localhost:27017/")
-DB_NAME = os.getenv('MONGO_DB_NAME', "blood_donation_db")
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
 
-print(f"Connecting to MongoDB: {MONGO_URI} (DB: {DB_NAME})")
+from api.db import get_db
+from api.inventory import adjust_stock_many, units_by_component
 
-try:
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    print("Connected successfully.")
-except Exception as e:
-    print(f"Failed to connect to MongoDB: {e}")
+db = get_db()
+if db is None:
+    print("Failed to connect to MongoDB")
     sys.exit(1)
 
 def revert_stock_usage(hospital_id, bg, units, source_batch_ids):
@@ -31,12 +28,12 @@ def revert_stock_usage(hospital_id, bg, units, source_batch_ids):
     """
     print(f"  -> Reverting {units} units of {bg} for Hospital {hospital_id}...")
     
-    # 1. Revert Inventory
-    res_inv = db.inventory.update_one(
-        {"hospitalId": hospital_id},
-        {"$inc": {bg: units}}
-    )
-    print(f"     Inventory updated: {res_inv.modified_count} doc(s)")
+    # 1. Revert Inventory (one counter per bloodGroup + componentType), through the
+    # ledger so rollups, regional stock and cached searches follow
+    per_component = {key: qty for key, qty in units_by_component(bg, source_batch_ids, units).items() if qty > 0}
+    adjust_stock_many(db, hospital_id, per_component, source='cleanup', actor='cleanup_h2h_duplicates')
+    for (_bg, component), qty in per_component.items():
+        print(f"     Inventory {component} refunded: {qty} unit(s)")
 
     # 2. Revert Batches
     for batch_info in source_batch_ids:
@@ -0,0 +1,17 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/ensure_indexes.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import ensure_indexes
+
+if __name__ == "__main__":
+    print("--- Ensuring MongoDB Indexes ---")
+    ensure_indexes()
+    print("--- Indexes Ready ---")
@@ -0,0 +1,22 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/expire_stock_holds.py` from the project root (e.g. cron)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.reservations import expire_holds
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Releasing Expired Stock Holds ---")
+    released = expire_holds(db)
+    for request_id in released:
+        print(f"Released hold for request {request_id} (back to Pending)")
+    print(f"--- Released {len(released)} hold(s) ---")
@@ -0,0 +1,51 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/migrate_inventory_documents.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from pymongo import UpdateOne # type: ignore
+from api.db import get_db, run_in_transaction
+from api.inventory import BLOOD_GROUPS, stock_key
+
+
+def migrate_legacy_inventory(db):
+    """
+    Split legacy per-hospital documents ({"hospitalId", "A+": 5, "O-": 2, ...})
+    into one counter document per blood group. Legacy counts are attributed to
+    the default component and added to any per-group counter that already exists.
+    Each legacy document is deleted in the same transaction that adds its counts,
+    so a re-run (or a concurrent deploy) never converts the same document twice.
+    """
+    converted = 0
+    for legacy in db.inventory.find({"bloodGroup": {"$exists": False}}, {"_id": 1}):
+        def convert(session, legacy_id=legacy['_id']):
+            # Claim the legacy document first: whoever deletes it applies its counts
+            doc = db.inventory.find_one_and_delete(
+                {"_id": legacy_id, "bloodGroup": {"$exists": False}}, session=session
+            )
+            if not doc:
+                return False
+            hospital_id = doc.get('hospitalId')
+            ops = [
+                UpdateOne(stock_key(hospital_id, bg), {"$inc": {"units": int(doc.get(bg) or 0)}}, upsert=True)
+                for bg in BLOOD_GROUPS if bg in doc
+            ] if hospital_id else []
+            if ops:
+                db.inventory.bulk_write(ops, ordered=False, session=session)
+            return True
+
+        if run_in_transaction(convert):
+            converted += 1
+    print(f"Converted {converted} legacy inventory document(s)")
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Migrating Inventory Documents ---")
+    migrate_legacy_inventory(db)
+    print("--- Migration Complete ---")
@@ -0,0 +1,62 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/migrate_notification_schema.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.notifications import retention_expiry
+
+
+def migrate_legacy_notifications(db):
+    """
+    Rewrite legacy notifications (userId / date / read) into the canonical
+    recipientId / timestamp / status schema, server-side in one update.
+    """
+    result = db.notifications.update_many(
+        {"$or": [
+            {"userId": {"$exists": True}},
+            {"date": {"$exists": True}},
+            {"read": {"$exists": True}}
+        ]},
+        [
+            {"$set": {
+                "recipientId": {"$toString": {"$ifNull": ["$recipientId", "$userId"]}},
+                "timestamp": {"$ifNull": ["$timestamp", "$date"]},
+                "status": {"$ifNull": ["$status", {"$cond": ["$read", "READ", "UNREAD"]}]}
+            }},
+            {"$unset": ["userId", "date", "read"]}
+        ]
+    )
+    print(f"Rewrote {result.modified_count} legacy notification(s)")
+
+    # Read / acted-on notifications from before retention carry no expireAt, so the TTL index skips them
+    result = db.notifications.update_many(
+        {"status": {"$ne": "UNREAD"}, "expireAt": {"$exists": False}},
+        {"$set": {"expireAt": retention_expiry()}}
+    )
+    print(f"Scheduled {result.modified_count} read notification(s) for expiry")
+
+
+def rebuild_unread_counters(db):
+    """Recompute notification_counters from the (now uniform) notifications"""
+    db.notification_counters.update_many({}, {"$set": {"unread": 0}})
+    db.notifications.aggregate([
+        {"$match": {"status": "UNREAD"}},
+        {"$group": {"_id": "$recipientId", "unread": {"$sum": 1}}},
+        {"$merge": {"into": "notification_counters", "on": "_id", "whenMatched": "replace"}}
+    ])
+    print(f"Unread counters rebuilt for {db.notification_counters.count_documents({})} user(s)")
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Migrating Notification Schema ---")
+    migrate_legacy_notifications(db)
+    rebuild_unread_counters(db)
+    print("--- Migration Complete ---")
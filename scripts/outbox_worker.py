@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import argparse
+import django
+
+# Allow running as `python scripts/outbox_worker.py` from the project root (e.g. a worker dyno)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from concurrent.futures import ThreadPoolExecutor
+from api.db import get_db
+from api.outbox import drain
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply queued outbox events (notifications, pushes, stock, history)")
+    parser.add_argument('--workers', type=int, default=4, help="threads draining the outbox in parallel")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds to sleep when the outbox is empty")
+    parser.add_argument('--once', action='store_true', help="drain what is due and exit (cron)")
+    args = parser.parse_args()
+
+    db = get_db()
+    print(f"--- Outbox Worker ({args.workers} thread(s)) ---")
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            results = list(pool.map(lambda _: drain(db), range(args.workers)))
+            done = sum(r[0] for r in results)
+            failed = sum(r[1] for r in results)
+            if done or failed:
+                print(f"Applied {done} event(s), {failed} failed (will retry)")
+            if args.once:
+                break
+            if not done and not failed:
+                time.sleep(args.interval)
+    print("--- Outbox Worker Stopped ---")
@@ -0,0 +1,22 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/rebuild_donor_stats.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.donor_stats import rebuild_donor_stats
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Rebuilding Donor Stats ---")
+    # Optional donor ids to limit the rebuild: python scripts/rebuild_donor_stats.py <id> <id> ...
+    updated = rebuild_donor_stats(db, sys.argv[1:] or None)
+    print(f"Updated stats for {updated} donor(s)")
+    print("--- Rebuild Complete ---")
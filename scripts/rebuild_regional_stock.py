@@ -0,0 +1,24 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/rebuild_regional_stock.py` from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.regional_stock import rebuild_regional_stock
+
+
+if __name__ == "__main__":
+    # Seeds the stock map for existing data and repairs drift; stock movements keep it current afterwards
+    db = get_db()
+    if '--if-empty' in sys.argv and db.regional_stock.estimated_document_count():
+        print("--- Regional Stock Map already seeded ---")
+        sys.exit(0)
+    print("--- Rebuilding Regional Stock Map ---")
+    regions = rebuild_regional_stock(db)
+    print(f"--- {regions} region(s) rebuilt from inventory ---")
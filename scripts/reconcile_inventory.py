@@ -0,0 +1,151 @@
+"""
+Reconcile inventory counters against physical batches.
+
+For every hospital, the units still sitting in usable batches (grouped by
+bloodGroup + componentType) should equal the inventory counter's free
+`units` plus reserved `held` units. Differences are reported and, with
+--repair, corrected with one bulk_write per hospital (logged to the
+inventory ledger with source 'reconcile').
+
+Hospitals are processed in parallel worker processes. Finished hospitals
+are appended to a checkpoint file, so an interrupted run resumes where it
+stopped; delete it (or pass --restart) for a fresh pass.
+
+    python scripts/reconcile_inventory.py                # report only
+    python scripts/reconcile_inventory.py --repair --workers 8
+"""
+
+import os
+import sys
+import argparse
+import datetime
+import multiprocessing
+import django
+
+# Allow running as `python scripts/reconcile_inventory.py` from the project root (e.g. nightly cron)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.allocation import ALLOCATABLE_STATUSES
+from api.inventory import DEFAULT_COMPONENT, adjust_stock_many
+
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.reconcile_inventory.checkpoint')
+
+
+def batch_totals(db, hospital_id):
+    """{(bloodGroup, componentType): units} of usable batches, grouped server-side"""
+    rows = db.batches.aggregate([
+        {"$match": {"hospitalId": hospital_id, "status": {"$in": ALLOCATABLE_STATUSES}, "units": {"$gt": 0}}},
+        {"$group": {
+            "_id": {"bloodGroup": "$bloodGroup", "componentType": {"$ifNull": ["$componentType", DEFAULT_COMPONENT]}},
+            "units": {"$sum": "$units"}
+        }}
+    ])
+    return {(r['_id']['bloodGroup'], r['_id']['componentType']): r['units'] for r in rows if r['_id']['bloodGroup']}
+
+
+def counter_totals(db, hospital_id):
+    """{(bloodGroup, componentType): units + held} from the inventory counters"""
+    return {
+        (doc['bloodGroup'], doc.get('componentType') or DEFAULT_COMPONENT): doc.get('units', 0) + doc.get('held', 0)
+        for doc in db.inventory.find(
+            {"hospitalId": hospital_id, "bloodGroup": {"$ne": None}},
+            {"bloodGroup": 1, "componentType": 1, "units": 1, "held": 1}
+        )
+    }
+
+
+def diff(db, hospital_id):
+    """{(bloodGroup, componentType): expected - counted} for keys that disagree"""
+    expected = batch_totals(db, hospital_id)
+    counted = counter_totals(db, hospital_id)
+    return {
+        key: expected.get(key, 0) - counted.get(key, 0)
+        for key in set(expected) | set(counted)
+        if expected.get(key, 0) != counted.get(key, 0)
+    }
+
+
+def reconcile_hospital(args):
+    """Worker: returns (hospitalId, {key: delta}, {key: delta repaired})"""
+    hospital_id, repair = args
+    db = get_db()
+    deltas = diff(db, hospital_id)
+    if not deltas or not repair:
+        return hospital_id, deltas, {}
+
+    # Re-read once and only repair what is still off by the same amount,
+    # so a stock movement that landed between the two reads isn't "fixed".
+    confirmed = {key: delta for key, delta in diff(db, hospital_id).items() if deltas.get(key) == delta}
+    if confirmed:
+        refused = adjust_stock_many(db, hospital_id, confirmed, source='reconcile', actor='reconcile_inventory')
+        confirmed = {key: delta for key, delta in confirmed.items() if key not in refused}
+    return hospital_id, deltas, confirmed
+
+
+def hospital_ids(db):
+    """Every hospital with batches or counters, streamed from the server"""
+    seen = set()
+    for collection in (db.batches, db.inventory):
+        for row in collection.aggregate([{"$group": {"_id": "$hospitalId"}}], allowDiskUse=True):
+            if row['_id'] and row['_id'] not in seen:
+                seen.add(row['_id'])
+                yield row['_id']
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile inventory counters against batches")
+    parser.add_argument('--repair', action='store_true', help="correct the counters (default: report only)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint")
+    parser.add_argument('--hospital', help="reconcile a single hospital")
+    opts = parser.parse_args()
+
+    db = get_db()
+    if opts.restart and os.path.exists(opts.checkpoint):
+        os.remove(opts.checkpoint)
+    if opts.hospital:
+        opts.checkpoint = os.devnull # Single-hospital runs don't touch the nightly checkpoint
+    done = load_checkpoint(opts.checkpoint)
+
+    targets = [opts.hospital] if opts.hospital else [h for h in hospital_ids(db) if h not in done]
+    print(f"--- Reconciling {len(targets)} hospital(s) ({len(done)} already done), "
+          f"{'repair' if opts.repair else 'report only'} ---")
+    started = datetime.datetime.now()
+
+    drifted = repaired = 0
+    # spawn: each worker gets its own MongoClient (pymongo clients aren't fork-safe)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(max(1, opts.workers)) as pool, open(opts.checkpoint, 'a') as checkpoint:
+        work = ((hospital_id, opts.repair) for hospital_id in targets)
+        for hospital_id, deltas, fixed in pool.imap_unordered(reconcile_hospital, work, chunksize=8):
+            if deltas:
+                drifted += 1
+                repaired += int(bool(fixed))
+                for (bg, component), delta in sorted(deltas.items()):
+                    print(f"{hospital_id} {bg} {component}: counter off by {-delta:+d}"
+                          f"{' (repaired)' if (bg, component) in fixed else ''}")
+            checkpoint.write(hospital_id + "\n")
+            checkpoint.flush()
+
+    if not opts.hospital and os.path.exists(opts.checkpoint):
+        os.remove(opts.checkpoint) # Full pass finished
+    print(f"--- Done in {(datetime.datetime.now() - started).total_seconds():.1f}s: "
+          f"{drifted} hospital(s) drifted, {repaired} repaired ---")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+import django
+
+# Allow running as `python scripts/snapshot_inventory.py` from the project root (e.g. hourly cron)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Setup Django Environment
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from api.db import get_db
+from api.ledger import take_snapshot
+
+
+if __name__ == "__main__":
+    db = get_db()
+    print("--- Snapshotting Inventory ---")
+    hospital_ids = set(db.inventory.distinct("hospitalId")) | set(db.inventory_snapshots.distinct("hospitalId"))
+    for hospital_id in sorted(h for h in hospital_ids if h):
+        levels = take_snapshot(db, hospital_id)
+        print(f"{hospital_id}: {sum(l['units'] for l in levels.values())} units free, "
+              f"{sum(l['held'] for l in levels.values())} held")
+    print(f"--- Snapshotted {len(hospital_ids)} hospital(s) ---")
@@ -1,18 +1,17 @@
 import os
 import django
 import random
-from datetime import datetime
 
 # Setup Django Environment
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django.setup()
 
 from api.db import get_db
+from api.inventory import set_stock
 
 def seed_hospitals():
     db = get_db()
     users_collection = db.users
-    inventory_collection = db.inventory
     
     cities_nearby = ["Bangalore Central", "Indiranagar", "Koramangala", "Whitefield", "Jayanagar", "Malleswaram", "Yelahanka", "Electronic City", "Hebbal", "Banashankari"]
     cities_distant = ["New York", "London", "Tokyo", "Paris", "Berlin", "Sydney", "Toronto", "Dubai", "Singapore", "Mumbai"]
@@ -87,25 +86,13 @@ def seed_hospitals():
         saved_user = users_collection.find_one({"email": h["email"]})
         hospital_id = str(saved_user["_id"])
         
-        # Create/Update Inventory
-        inventory_data = {
-            "hospitalId": hospital_id,
-            "lastUpdated": datetime.now().isoformat()
-        }
-        
-        # Add random stock for each group
+        # Create/Update Inventory (one counter per blood group)
         stock_summary = []
         for bg in blood_groups:
             units = random.randint(0, 50) # 0 to 50 units
-            inventory_data[bg] = units
+            set_stock(db, hospital_id, bg, units)
             if units > 0:
                 stock_summary.append(f"{bg}:{units}")
-
-        inventory_collection.update_one(
-            {"hospitalId": hospital_id},
-            {"$set": inventory_data},
-            upsert=True
-        )
         
         count += 1
         print(f"Seeded {h['name']} ({h['location']}) - Inventory: {', '.join(stock_summary[:3])}...")